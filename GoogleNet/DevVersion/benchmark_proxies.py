@@ -0,0 +1,77 @@
+import argparse
+import copy
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from conf import settings
+from utils import get_CIFAR100_training_dataloader, get_CIFAR100_test_dataloader, recalibrate_batchnorm, rank_correlation
+from models.googlenet import GoogleNet
+from models.pruning import ImportanceCache
+from models.proxies import proxies
+
+
+@torch.no_grad()
+def evaluate(model, test_loader, device):
+    """ return the top1 accuracy of model on test_loader """
+    model.eval()
+    correct = 0
+    for inputs, labels in test_loader:
+        correct += (model(inputs.to(device)).argmax(dim=1) == labels.to(device)).sum().item()
+    return correct / len(test_loader.dataset)
+
+
+def fine_tune(model, training_loader, epochs, lr, device):
+    """ fine-tune model with SGD on training_loader for epochs epochs, as a candidate recovers from pruning """
+    optimizer = optim.SGD(model.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4)
+    loss_function = nn.CrossEntropyLoss()
+    model.train()
+    for epoch in range(epochs):
+        for inputs, labels in training_loader:
+            optimizer.zero_grad()
+            loss_function(model(inputs.to(device)), labels.to(device)).backward()
+            optimizer.step()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Rank correlation of the zero-cost proxies of pruned GoogleNet candidates with their accuracy after fine-tuning on CIFAR-100')
+    parser.add_argument('--net', '-n', type=str, default=None, help='The model to be pruned, a freshly initialized GoogleNet by default')
+    parser.add_argument('--modification_num', '-m', type=int, default=settings.MAX_MODIFICATION_NUM, help='How many modifications update_architecture makes')
+    parser.add_argument('--candidate_num', '-k', type=int, default=10, help='How many candidates are pruned and ranked')
+    parser.add_argument('--epochs', '-e', type=int, default=settings.DEV_NUM, help='How many epochs every candidate is fine-tuned')
+    parser.add_argument('--lr', '-l', type=float, default=0.01, help='The learning rate of the fine-tuning')
+    parser.add_argument('--batch_size', '-b', type=int, default=128, help='The batch size of the fine-tuning and of the proxies')
+    parser.add_argument('--recalibration_size', '-r', type=int, default=512, help='How many training samples the BatchNorm stats are recalibrated on before the accuracy is screened')
+    parser.add_argument('--seed', '-s', type=int, default=0, help='The random seed of the pruning plans')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    net = torch.load(args.net, map_location=device) if args.net is not None else GoogleNet()
+    net = net.to(device)
+    cifar100_training_loader = get_CIFAR100_training_dataloader(settings.CIFAR100_TRAIN_MEAN, settings.CIFAR100_TRAIN_STD, num_workers=4, batch_size=args.batch_size, shuffle=True)
+    cifar100_test_loader = get_CIFAR100_test_dataloader(settings.CIFAR100_TRAIN_MEAN, settings.CIFAR100_TRAIN_STD, num_workers=4, batch_size=args.batch_size, shuffle=False)
+
+    torch.manual_seed(args.seed)
+    importance = ImportanceCache(net)
+    # every candidate is scored on the same minibatch
+    screen_batch = [tensor.to(device) for tensor in next(iter(cifar100_training_loader))]
+    screen_scores = {name: [] for name in ['accuracy'] + list(proxies)}
+    accuracies = []
+    for candidate_id in range(args.candidate_num):
+        model = copy.deepcopy(net)
+        GoogleNet.update_architecture(model, args.modification_num, bulk=True, importance=importance)
+        model = model.to(device)
+        recalibrate_batchnorm(model, cifar100_training_loader, args.recalibration_size, device)
+        screen_scores['accuracy'].append(evaluate(model, cifar100_test_loader, device))
+        for name, proxy in proxies.items():
+            screen_scores[name].append(proxy(model, *screen_batch))
+        fine_tune(model, cifar100_training_loader, args.epochs, args.lr, device)
+        accuracies.append(evaluate(model, cifar100_test_loader, device))
+        print('Candidate %d: %s, fine-tuned top1 accuracy %.4f' %(candidate_id + 1, ', '.join('%s %.4g' %(name, scores[-1]) for name, scores in screen_scores.items()), accuracies[-1]))
+
+    for name, scores in screen_scores.items():
+        print('%s: rank correlation %.4f' %(name, rank_correlation(scores, accuracies)))
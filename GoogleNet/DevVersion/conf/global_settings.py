@@ -11,6 +11,45 @@ CIFAR100_TRAIN_STD = (0.2673342858792401, 0.2564384629170883, 0.2761504713256840
 MAX_GENERATE_NUM = 2        # for each updates, how many potential architecture we are going to generate
 MAX_TOLERANCE_TIMES = 3     # for each training, how many updates we are going to apply before we get the final architecture
 MAX_MODIFICATION_NUM = 400  # max update numbers, that is max modification we make to architecture in update_architecture
+BULK_PRUNING = True         # draw the whole pruning plan first and rebuild each affected layer only once in update_architecture
+VIRTUAL_CANDIDATES = False  # train the potential architectures as channel masks over one shared copy of the model, only the winner is compacted, SUCCESSIVE_HALVING, EARLY_STOPPING, CANDIDATE_WORKERS and PROXY_CHECK are ignored then
+IMPORTANCE_CRITERION = 'variance'  # how prune_channels ranks the channels of a layer: 'variance', 'l1', 'l2', 'bn_gamma', 'fpgm', or 'taylor', 'apoz', 'activation' recorded during training
+KEEP_OPTIMIZER_STATE = True # prune the momentum buffers along with the channels, so the pruned model keeps its optimizer state
+CHANNEL_ALIGNMENT = 1       # prune so every width lands on a multiple of this (8 / 16 / 32 suit oneDNN / MKL kernels), 1 disables it
+LATENCY_WEIGHT = 0.0        # share of the compression term of compute_score given to the measured CPU latency instead of FLOPs and parameter number
+LATENCY_BATCH_SIZE = 1      # batch size the layer latencies are measured for
+LATENCY_TABLE_PATH = 'models/latency_table.json'  # where the measured layer latencies are kept between runs
+MEMORY_WEIGHT = 0.0         # share of the compression term of compute_score given to the estimated peak activation memory
+MEMORY_BUDGET = 0           # peak activation memory in MB an architecture has to fit in, 0 disables the budget
+MEMORY_BATCH_SIZE = 1       # batch size the peak activation memory is estimated for
+CANDIDATE_WORKERS = 1       # how many candidates are trained at the same time in spawned CPU worker processes, 1 trains them one after another
+SUCCESSIVE_HALVING = False  # train a larger pool of candidates for a few epochs and keep only the best of them at each rung, within the same epoch budget
+HALVING_ETA = 2             # each successive halving rung keeps 1 / HALVING_ETA of the candidates and trains them HALVING_ETA times as many epochs
+HALVING_MIN_EPOCH = 2       # how many epochs the first successive halving rung trains every candidate
+EARLY_STOPPING = False      # stop the candidates whose learning curve extrapolated from the first CURVE_EPOCH epochs can not reach the best one
+CURVE_EPOCH = 5             # how many epochs of every candidate are evaluated to extrapolate its learning curve
+CURVE_CONFIDENCE = 2.0      # how many standard errors of the curve fit a candidate's predicted accuracy may still rise by
+EVALUATION_POLICY = 'final' # which epochs of a candidate are evaluated besides its last one: 'final' (none), 'interval' (every EVALUATION_INTERVAL) or 'half' (the whole second half)
+EVALUATION_INTERVAL = 5     # how many epochs apart the 'interval' evaluation policy evaluates a candidate
+VALIDATION_SIZE = 0         # how many training samples are held out to compare the architectures on, 0 compares them on the test set, the parent has to be trained without them, see README
+SEQUENTIAL_REJECTION = True # stop evaluating a candidate once its Wilson interval shows it can not compete with the best one
+VALIDATION_CONFIDENCE = 2.576   # z score of the Wilson intervals, 2.576 is a 99% confidence
+VALIDATION_MARGIN = 0.02    # between generations, eval_training stops once the top1 accuracy is known within this margin, at 99% confidence a 0.7 accuracy is known within 0.02 after about 3500 samples, the evaluation set must be larger to stop early
+PROXY_SUBSET_SIZE = 0       # fine-tune the candidates on a stratified subset of this many training samples instead of all of them, 0 uses all
+PROXY_CHECK = False         # also fine-tune copies of the candidates on all training samples and report the rank correlation with the subset
+DISTILLATION = False        # the candidates recover from pruning by distilling their parent, matching its logits softened by DISTILLATION_TEMPERATURE
+DISTILLATION_TEMPERATURE = 4.0  # temperature softening the logits of the parent and the candidates
+DISTILLATION_ALPHA = 0.9    # weight of the distillation loss, the cross entropy with the labels gets 1 - DISTILLATION_ALPHA
+FEATURE_DISTILLATION_WEIGHT = 0.0  # weight of matching the outputs of the pruned layers to the channels they kept of the parent, 0 disables it
+BN_RECALIBRATION_SIZE = 0   # re-estimate the BatchNorm running stats of every pruned candidate on this many training samples, 0 keeps the sliced ones
+PRESCREEN_FACTOR = 1        # prune this many times the candidates and fine-tune only the best scored right after pruning, 1 disables the pre-screen
+PRESCREEN_PROXY = 'accuracy'  # what the pre-screen ranks by: the accuracy after pruning or a zero-cost proxy, 'synflow', 'snip', 'grad_norm' or 'jacob_cov'
+SURROGATE_SAMPLES = 0       # draw this many pruning plans per generation and fine-tune those a surrogate of the accuracy scores best, 0 disables it
+SURROGATE_MIN_SAMPLES = 8   # fine-tuned candidates the surrogate learns from before it picks the plans
+ARCHIVE_PATH = 'models/architecture_archive.db'  # SQLite archive of every fine-tuned candidate and its results, shared by all runs, '' disables it
+ARCHIVE_WEIGHTS = False     # also archive the trained weights, so that a later run from the same parent skips training the architecture again
+DUPLICATE_RETRIES = 10      # how many times a candidate with the same architecture as another one of its generation is pruned again before it is dropped
+CHECKPOINT = False          # save the whole search after every epoch and during every generation, an interrupted run goes on with --resume, each save writes the model, the optimizer and all candidates
 DEV_NUM = 20                # for each potential architecture, how many epochs we are going to train it
 DEFAULT_ACCURACY_THRESHOLD = 0.705  # if current top1 accuracy is above the accuracy_threshold, then computation of architecture's score main focus on FLOPs and parameter #
 DEFAULT_COMPRESSION_THRESHOLD = 1   # if current top1 accuracy is above the accuracy_threshold, then computation of architecture's score main focus on FLOPs and parameter #
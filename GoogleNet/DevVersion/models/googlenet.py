@@ -1,15 +1,12 @@
 import torch
 import torch.nn as nn
 
+from models.pruning import add_to_plan, prune_channels, ImportanceCache, align_plan
+
 class Inception(nn.Module):
     def __init__(self, input_channels, n1x1, n3x3_reduce, n3x3, n5x5_reduce, n5x5, pool_proj):
         super().__init__()
 
-        self.branch1_out = n1x1
-        self.branch2_out = n3x3
-        self.branch3_out = n5x5
-        self.branch4_out = pool_proj
-
         #1x1conv branch
         self.b1 = nn.Sequential(
             nn.Conv2d(input_channels, n1x1, kernel_size=1, bias=False),
@@ -55,72 +52,41 @@ class Inception(nn.Module):
     def forward(self, x):
         return torch.cat([self.b1(x), self.b2(x), self.b3(x), self.b4(x)], dim=1)
     
-    def prune_kernel(self):
+    # the output width of each branch, i.e. where each branch starts in the concatenated output
+    @property
+    def branch1_out(self):
+        return self.b1[0].out_channels
+
+    @property
+    def branch2_out(self):
+        return self.b2[3].out_channels
+
+    @property
+    def branch3_out(self):
+        return self.b3[6].out_channels
+
+    @property
+    def branch4_out(self):
+        return self.b4[1].out_channels
+
+    # choose which conv layer inside inception to prune, return its name relative to the inception
+    def choose_kernel(self):
         branch_choices = torch.tensor([1, 2, 3, 4])
         target_branch = torch.randint(0, len(branch_choices), (1,)).item()
-        target_branch = branch_choices[target_branch]
+        target_branch = branch_choices[target_branch].item()
         if target_branch == 1:
-            target_branch = self.b1
             target_layer = 0
         elif target_branch == 2:
-            target_branch = self.b2
             layer_choices = torch.tensor([0, 3])
             target_layer = torch.randint(0, len(layer_choices), (1,)).item()
-            target_layer = layer_choices[target_layer]
+            target_layer = layer_choices[target_layer].item()
         elif target_branch == 3:
-            target_branch = self.b3
             layer_choices = torch.tensor([0, 3, 6])
             target_layer = torch.randint(0, len(layer_choices), (1,)).item()
-            target_layer = layer_choices[target_layer]
-        elif target_branch == 4:
-            target_branch = self.b4
-            target_layer = 1
-        
-        # prune target branch
-        new_conv1_kernel_num = target_branch[target_layer].out_channels - 1
-        if new_conv1_kernel_num == 0:
-            return None, None
-        if target_layer >= 3:
-            new_conv1 = nn.Conv2d(target_branch[target_layer].in_channels, new_conv1_kernel_num, kernel_size=target_branch[target_layer].kernel_size, padding=1, bias=False)
-        else:
-            new_conv1 = nn.Conv2d(target_branch[target_layer].in_channels, new_conv1_kernel_num, kernel_size=target_branch[target_layer].kernel_size, bias=False)
-        weight_variances = torch.var(target_branch[target_layer].weight.data, dim = [1, 2, 3])
-        target_kernel = torch.argmin(weight_variances).item()
-        with torch.no_grad():
-            new_conv1.weight.data = torch.cat([target_branch[target_layer].weight.data[:target_kernel], target_branch[target_layer].weight.data[target_kernel+1:]], dim=0)
-        target_branch[target_layer] = new_conv1
-
-        new_bn1 = nn.BatchNorm2d(new_conv1_kernel_num)
-        with torch.no_grad():
-            kept_indices = [i for i in range(target_branch[target_layer + 1].num_features) if i != target_kernel]
-            new_bn1.weight.data = target_branch[target_layer + 1].weight.data[kept_indices]
-            new_bn1.bias.data = target_branch[target_layer + 1].bias.data[kept_indices]
-            new_bn1.running_mean = target_branch[target_layer + 1].running_mean[kept_indices]
-            new_bn1.running_var = target_branch[target_layer + 1].running_var[kept_indices]
-        target_branch[target_layer + 1] = new_bn1
-        if target_branch == self.b1:
-            self.branch1_out -= 1
-            return 1, target_kernel
-        elif target_branch == self.b2 and target_layer == 3:
-            self.branch2_out -= 1
-            return 2, target_kernel
-        elif target_branch == self.b3 and target_layer == 6:
-            self.branch3_out -= 1
-            return 3, target_kernel
-        elif target_branch == self.b4:
-            self.branch4_out -= 1
-            return 4, target_kernel
+            target_layer = layer_choices[target_layer].item()
         else:
-            # else, we need to decrement next conv layer's input inside inception
-            if target_layer + 3 >= 3:
-                new_conv2 = nn.Conv2d(target_branch[target_layer + 3].in_channels - 1, target_branch[target_layer + 3].out_channels, kernel_size=target_branch[target_layer + 3].kernel_size, padding=1, bias=False)
-            else:
-                new_conv2 = nn.Conv2d(target_branch[target_layer + 3].in_channels - 1, target_branch[target_layer + 3].out_channels, kernel_size=target_branch[target_layer + 3].kernel_size, bias=False)
-            with torch.no_grad():
-                kept_indices = [i for i in range(target_branch[target_layer + 3].in_channels) if i != target_kernel]
-                new_conv2.weight.data = target_branch[target_layer + 3].weight.data[:, kept_indices, :, :]
-            target_branch[target_layer + 3] = new_conv2
-            return None, target_kernel
+            target_layer = 1
+        return 'b%d.%d' %(target_branch, target_layer)
     
     def change_activation_function(self):
         branch_choices = torch.tensor([1, 2, 3, 4])
@@ -156,9 +122,13 @@ class Inception(nn.Module):
 
 
 class GoogleNet(nn.Module):
+    input_size = (3, 32, 32)
+    inception_names = ['a3', 'b3', 'a4', 'b4', 'c4', 'd4', 'e4', 'a5', 'b5']
 
     def __init__(self, num_class=100):
         super().__init__()
+        # kept for ArchitectureSpec to rebuild the model
+        self.num_class = num_class
         self.prelayer = nn.Sequential(
             nn.Conv2d(3, 64, kernel_size=3, padding=1, bias=False),
             nn.BatchNorm2d(64),
@@ -227,156 +197,51 @@ class GoogleNet(nn.Module):
         return x
     
     # define the function to resize the architecture kernel number
-    def update_architecture(self, modification_num):
+    def update_architecture(self, modification_num, bulk=False, importance=None, criterion='variance', optimizer=None, align=1, plan=None):
         update_times = int(modification_num + 1)
-        for update_id in range(update_times):
-            if torch.rand(1).item() < 0.05:
-                self.prune_kernel()
-            else:
-                self.prune_inception()
+        # channel scores of the parent, shared by all candidates of a generation
+        importance = ImportanceCache(self, criterion) if importance is None else importance.copy()
+        if plan is not None:
+            # drawn beforehand, e.g. picked among many plans by the surrogate
+            prune_channels(self, plan, importance, optimizer)
+        elif bulk or align > 1:
+            # draw the whole pruning plan first, then rebuild every affected layer only once
+            # widths are aligned over the whole plan, single channel steps would all round to a multiple
+            prune_channels(self, align_plan(self, self.draw_pruning_plan(update_times), align), importance, optimizer)
+        else:
+            for update_id in range(update_times):
+                prune_channels(self, self.draw_pruning_plan(1), importance, optimizer)
         if torch.rand(1).item() < 0:
             if torch.rand(1).item() < 0.05:
                 self.change_activation_function()
             else:
                 self.change_inception_activation_function()
+        # the cache knows which channels of the parent the pruned model kept
+        return importance
+
+    # draw the random choices of update_architecture, and count how many channels each layer loses
+    def draw_pruning_plan(self, update_times):
+        plan = {}
+        for update_id in range(update_times):
+            if torch.rand(1).item() < 0.05:
+                self.prune_kernel(plan)
+            else:
+                self.prune_inception(plan)
+        return plan
     
-    def prune_kernel(self):
-        target_branch = self.prelayer
+    # add one kernel of a prelayer conv layer to plan, the least important kernel is chosen by prune_channels
+    def prune_kernel(self, plan):
         layer_choices = torch.tensor([0, 3, 6])
         target_layer = torch.randint(0, len(layer_choices), (1,)).item()
-        target_layer = layer_choices[target_layer]
-        
-        # prune target branch
-        new_conv1_kernel_num = target_branch[target_layer].out_channels - 1
-        if new_conv1_kernel_num == 0:
-            return
-        new_conv1 = nn.Conv2d(target_branch[target_layer].in_channels, new_conv1_kernel_num, kernel_size=target_branch[target_layer].kernel_size, padding=1, bias=False)
-        weight_variances = torch.var(target_branch[target_layer].weight.data, dim = [1, 2, 3])
-        target_kernel = torch.argmin(weight_variances).item()
-        with torch.no_grad():
-            new_conv1.weight.data = torch.cat([target_branch[target_layer].weight.data[:target_kernel], target_branch[target_layer].weight.data[target_kernel+1:]], dim=0)
-        target_branch[target_layer] = new_conv1
-
-        new_bn1 = nn.BatchNorm2d(new_conv1_kernel_num)
-        with torch.no_grad():
-            kept_indices = [i for i in range(target_branch[target_layer + 1].num_features) if i != target_kernel]
-            new_bn1.weight.data = target_branch[target_layer + 1].weight.data[kept_indices]
-            new_bn1.bias.data = target_branch[target_layer + 1].bias.data[kept_indices]
-            new_bn1.running_mean = target_branch[target_layer + 1].running_mean[kept_indices]
-            new_bn1.running_var = target_branch[target_layer + 1].running_var[kept_indices]
-        target_branch[target_layer + 1] = new_bn1
-
-        if target_layer == 6:
-            # if prone the last layer, we also need to modify a3
-            for target_branch_id in range(1, 4):
-                if target_branch_id == 1:
-                    target_branch = self.a3.b1
-                elif target_branch_id == 2:
-                    target_branch = self.a3.b2
-                elif target_branch_id == 3:
-                    target_branch = self.a3.b3
-                new_conv2 = nn.Conv2d(new_conv1_kernel_num, target_branch[0].out_channels, kernel_size=target_branch[0].kernel_size, bias=False)
-                with torch.no_grad():
-                    kept_indices = [i for i in range(target_branch[0].in_channels) if i != target_kernel]
-                    new_conv2.weight.data = target_branch[0].weight.data[:, kept_indices, :, :]
-                target_branch[0] = new_conv2
-            target_branch = self.a3.b4
-            new_conv2 = nn.Conv2d(new_conv1_kernel_num, target_branch[1].out_channels, kernel_size=target_branch[1].kernel_size, bias=False)
-            with torch.no_grad():
-                kept_indices = [i for i in range(target_branch[1].in_channels) if i != target_kernel]
-                new_conv2.weight.data = target_branch[1].weight.data[:, kept_indices, :, :]
-            target_branch[1] = new_conv2
-        else:
-            # else, decrement next conv input inside prelayer
-            new_conv2 = nn.Conv2d(target_branch[target_layer + 3].in_channels - 1, target_branch[target_layer + 3].out_channels, kernel_size=target_branch[target_layer + 3].kernel_size, padding=1, bias=False)
-            with torch.no_grad():
-                kept_indices = [i for i in range(target_branch[target_layer + 3].in_channels) if i != target_kernel]
-                new_conv2.weight.data = target_branch[target_layer + 3].weight.data[:, kept_indices, :, :]
-            target_branch[target_layer + 3] = new_conv2
+        target_layer = layer_choices[target_layer].item()
+        add_to_plan(self, plan, 'prelayer.' + str(target_layer))
     
-    def prune_inception(self):
+    # add one kernel of a conv layer inside an inception to plan, the concat offsets are handled by prune_channels
+    def prune_inception(self, plan):
         target_inception = torch.randint(0, 9, (1,)).item()
-        if target_inception == 0:
-            target_inception = self.a3
-        elif target_inception == 1:
-            target_inception = self.b3
-        elif target_inception == 2:
-            target_inception = self.a4
-        elif target_inception == 3:
-            target_inception = self.b4
-        elif target_inception == 4:
-            target_inception = self.c4
-        elif target_inception == 5:
-            target_inception = self.d4
-        elif target_inception == 6:
-            target_inception = self.e4
-        elif target_inception == 7:
-            target_inception = self.a5
-        else:
-            target_inception = self.b5
-        ret, target_kernel = target_inception.prune_kernel()
-        # if ret = none, no need to modify next layer's input
-        if ret == None:
-            return
-        # compute coresponding target_kernel
-        if ret == 1:
-            target_kernel = target_kernel
-        elif ret == 2:
-            target_kernel = target_inception.branch1_out + target_kernel
-        elif ret == 3:
-            target_kernel = target_inception.branch1_out + target_inception.branch2_out + target_kernel
-        else:
-            target_kernel = target_inception.branch1_out + target_inception.branch2_out + target_inception.branch3_out + target_kernel
-        # handle the last inception seperately as we need to modify FC layer
-        if target_inception != self.b5:
-            if target_inception == self.a3:
-                target_inception_2 = self.b3
-            elif target_inception == self.b3:
-                target_inception_2 = self.a4
-            elif target_inception == self.a4:
-                target_inception_2 = self.b4
-            elif target_inception == self.b4:
-                target_inception_2 = self.c4
-            elif target_inception == self.c4:
-                target_inception_2 = self.d4
-            elif target_inception == self.d4:
-                target_inception_2 = self.e4
-            elif target_inception == self.e4:
-                target_inception_2 = self.a5
-            else:
-                target_inception_2 = self.b5
-            
-            for target_branch_id in range(1, 4):
-                if target_branch_id == 1:
-                    target_branch = target_inception_2.b1
-                elif target_branch_id == 2:
-                    target_branch = target_inception_2.b2
-                elif target_branch_id == 3:
-                    target_branch = target_inception_2.b3
-                new_conv2 = nn.Conv2d(target_branch[0].in_channels - 1, target_branch[0].out_channels, kernel_size=target_branch[0].kernel_size, bias=False)
-                with torch.no_grad():
-                    kept_indices = [i for i in range(target_branch[0].in_channels) if i != target_kernel]
-                    new_conv2.weight.data = target_branch[0].weight.data[:, kept_indices, :, :]
-                target_branch[0] = new_conv2
-            target_branch = target_inception_2.b4
-            new_conv2 = nn.Conv2d(target_branch[1].in_channels - 1, target_branch[1].out_channels, kernel_size=target_branch[1].kernel_size, bias=False)
-            with torch.no_grad():
-                kept_indices = [i for i in range(target_branch[1].in_channels) if i != target_kernel]
-                new_conv2.weight.data = target_branch[1].weight.data[:, kept_indices, :, :]
-            target_branch[1] = new_conv2
-        else:
-            # update FC layer
-            new_fc1_intput_features = self.linear.in_features - 1
-            # update fc1
-            new_fc1 = nn.Linear(new_fc1_intput_features, self.linear.out_features)
-            output_length = 1 # gained by printing "output"
-            # prune the neuron with least variance weights
-            with torch.no_grad():
-                start_index = target_kernel * output_length ** 2
-                end_index = start_index + output_length ** 2
-                new_fc1.weight.data = torch.cat([self.linear.weight.data[:, :start_index], self.linear.weight.data[:, end_index:]], dim=1)
-                new_fc1.bias.data = self.linear.bias.data
-            self.linear = new_fc1
+        target_inception = GoogleNet.inception_names[target_inception]
+        target_layer = getattr(self, target_inception).choose_kernel()
+        add_to_plan(self, plan, target_inception + '.' + target_layer)
     
     def change_activation_function(self):
         target_branch = self.prelayer
@@ -0,0 +1,756 @@
+import bisect
+import copy
+import operator
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+import torch.fx as fx
+from torch.fx.passes.shape_prop import ShapeProp
+
+
+def adopt_tensors(module, **tensors):
+    """ give a module built on the meta device the real tensors for its parameters and buffers
+    Building the pruned layers on the meta device skips their random initialization, which would be
+    overwritten anyway, and the sliced tensors are adopted on the device they already live on.
+    """
+    for name, tensor in tensors.items():
+        if name in module._parameters:
+            setattr(module, name, nn.Parameter(tensor, requires_grad=module._parameters[name].requires_grad))
+        else:
+            setattr(module, name, tensor)
+    return module
+
+def prune_conv2d(conv, out_indices=None, in_indices=None):
+    """ return a new Conv2d that only keeps the given channels
+    Args:
+        conv: the nn.Conv2d to be pruned
+        out_indices: LongTensor of output channels to keep, None keeps all
+        in_indices: LongTensor of input channels to keep, None keeps all
+    Returns: new_conv: pruned nn.Conv2d
+    """
+    tensors = {'weight': conv.weight.data}
+    if conv.bias is not None:
+        tensors['bias'] = conv.bias.data
+    if out_indices is not None:
+        tensors = {name: tensor.index_select(0, out_indices) for name, tensor in tensors.items()}
+    if in_indices is not None:
+        tensors['weight'] = tensors['weight'].index_select(1, in_indices)
+    weight = tensors['weight']
+    new_conv = nn.Conv2d(weight.shape[1], weight.shape[0], kernel_size=conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                         dilation=conv.dilation, bias=conv.bias is not None, padding_mode=conv.padding_mode, device='meta')
+    return adopt_tensors(new_conv, **tensors)
+
+def prune_batchnorm2d(bn, indices):
+    """ return a new BatchNorm2d that only keeps the given channels
+    Args:
+        bn: the nn.BatchNorm2d to be pruned
+        indices: LongTensor of channels to keep
+    Returns: new_bn: pruned nn.BatchNorm2d
+    """
+    tensors = {}
+    if bn.affine:
+        tensors['weight'] = bn.weight.data.index_select(0, indices)
+        tensors['bias'] = bn.bias.data.index_select(0, indices)
+    if bn.track_running_stats:
+        tensors['running_mean'] = bn.running_mean.index_select(0, indices)
+        tensors['running_var'] = bn.running_var.index_select(0, indices)
+        tensors['num_batches_tracked'] = bn.num_batches_tracked.clone()
+    new_bn = nn.BatchNorm2d(len(indices), eps=bn.eps, momentum=bn.momentum, affine=bn.affine, track_running_stats=bn.track_running_stats, device='meta')
+    return adopt_tensors(new_bn, **tensors)
+
+def prune_linear(linear, out_indices=None, in_indices=None):
+    """ return a new Linear that only keeps the given neurons
+    Args:
+        linear: the nn.Linear to be pruned
+        out_indices: LongTensor of output neurons to keep, None keeps all
+        in_indices: LongTensor of input features to keep, None keeps all
+    Returns: new_linear: pruned nn.Linear
+    """
+    tensors = {'weight': linear.weight.data}
+    if linear.bias is not None:
+        tensors['bias'] = linear.bias.data
+    if out_indices is not None:
+        tensors = {name: tensor.index_select(0, out_indices) for name, tensor in tensors.items()}
+    if in_indices is not None:
+        tensors['weight'] = tensors['weight'].index_select(1, in_indices)
+    weight = tensors['weight']
+    new_linear = nn.Linear(weight.shape[1], weight.shape[0], bias=linear.bias is not None, device='meta')
+    return adopt_tensors(new_linear, **tensors)
+
+def slice_optimizer_state(optimizer, module, new_module, out_indices=None, in_indices=None):
+    """ hand the optimizer entries of module's parameters over to the pruned new_module
+    The momentum buffers, and any other state shaped like its parameter, keep the entries of the
+    kept channels, so the pruned model can continue training with the same optimizer.
+    """
+    for name, new_parameter in new_module.named_parameters(recurse=False):
+        parameter = getattr(module, name)
+        for group in optimizer.param_groups:
+            for position, group_parameter in enumerate(group['params']):
+                if group_parameter is parameter:
+                    group['params'][position] = new_parameter
+        if parameter not in optimizer.state:
+            continue
+        state = optimizer.state.pop(parameter)
+        for key, value in state.items():
+            if torch.is_tensor(value) and value.shape == parameter.shape:
+                if out_indices is not None:
+                    value = value.index_select(0, out_indices)
+                if in_indices is not None and value.dim() > 1:
+                    value = value.index_select(1, in_indices)
+                state[key] = value
+        optimizer.state[new_parameter] = state
+
+def load_optimizer_state(optimizer, state_dict):
+    """ load only the per parameter state (e.g. momentum buffers) of state_dict into optimizer
+    The learning rate and other hyperparameters of optimizer are kept. state_dict must come from an
+    optimizer over the same parameters in the same order, e.g. those of a deep copy of its model.
+    """
+    parameters = [parameter for group in optimizer.param_groups for parameter in group['params']]
+    parameter_ids = [parameter_id for group in state_dict['param_groups'] for parameter_id in group['params']]
+    for parameter_id, parameter in zip(parameter_ids, parameters):
+        if parameter_id in state_dict['state']:
+            state = state_dict['state'][parameter_id]
+            optimizer.state[parameter] = {}
+            for key, value in state.items():
+                if torch.is_tensor(value):
+                    # scalar state such as step counters stays where the optimizer keeps it
+                    value = value.to(parameter.device, copy=True) if value.dim() > 0 else value.clone()
+                optimizer.state[parameter][key] = value
+
+def get_width(module):
+    """ return the number of output channels / neurons of a Conv2d, BatchNorm2d or Linear """
+    if isinstance(module, nn.Conv2d):
+        return module.out_channels
+    elif isinstance(module, nn.BatchNorm2d):
+        return module.num_features
+    return module.out_features
+
+def get_input_width(module):
+    """ return the number of input channels / features of a Conv2d or Linear """
+    if isinstance(module, nn.Conv2d):
+        return module.in_channels
+    return module.in_features
+
+def set_submodule(model, module_name, new_module):
+    """ replace the submodule called module_name (e.g. 'features.Conv1' or 'classifier.0') with new_module """
+    parent_name, _, child_name = module_name.rpartition('.')
+    parent = model.get_submodule(parent_name) if parent_name != '' else model
+    setattr(parent, child_name, new_module)
+
+def remaining_width(model, plan, group):
+    """ return the width group will have after the channels already counted in plan are removed """
+    return get_width(model.get_submodule(group)) - plan.get(group, 0)
+
+def add_to_plan(model, plan, group):
+    """ count one more channel to remove from group, unless that would leave the layer empty
+    Args:
+        model: the model the plan is drawn for
+        plan: dict mapping a channel group name to the number of channels to remove
+        group: name of the module that produces the group's channels
+    """
+    if remaining_width(model, plan, group) - 1 > 0:
+        plan[group] = plan.get(group, 0) + 1
+
+def align_plan(model, plan, multiple):
+    """ round the removals of plan up so every pruned width lands on a multiple of multiple
+    Widths such as 509 or 4093 often run slower on oneDNN / MKL than the next multiple of 8, 16 or 32,
+    so a FLOPs win could be a latency loss. A layer never drops below one multiple, and layers narrower
+    than that are left as they are. The groups plan leaves out are rounded down too, so widths the model
+    starts with off a multiple, e.g. the 208 / 48 wide GoogleNet branches, are aligned by the first plan.
+    Args:
+        model: the model the plan is drawn for
+        plan: dict mapping a channel group name to the number of channels to remove
+        multiple: the width multiple to keep, 1 leaves plan unchanged
+    Returns: aligned_plan: dict mapping a channel group name to the number of channels to remove
+    """
+    if multiple <= 1:
+        return plan
+    graph = get_channel_graph(model)
+    planned_roots = {graph.groups[group] for group in plan}
+    groups = list(plan) + [group for group in get_channel_groups(model) if graph.groups[group] not in planned_roots]
+    aligned_plan = {}
+    for group in groups:
+        remove_num = plan.get(group, 0)
+        width = get_width(model.get_submodule(group))
+        aligned_width = max((width - remove_num) // multiple * multiple, min(width, multiple))
+        if aligned_width < width:
+            aligned_plan[group] = width - aligned_width
+    return aligned_plan
+
+def get_kept_indices(size, removed, device):
+    """ turn a list of removed index tensors into the sorted LongTensor of kept indices, None if nothing is removed """
+    if len(removed) == 0:
+        return None
+    mask = torch.ones(size, dtype=torch.bool, device=device)
+    mask[torch.cat(removed).to(device)] = False
+    return mask.nonzero().view(-1)
+
+def producer_weights(model, members):
+    """ yield the weight of every Conv2d / Linear among members that produces the group's channels, one row per channel """
+    for module_name, dim, offset, repeat in members:
+        weight = model.get_submodule(module_name).weight.data
+        if dim == 0 and weight.dim() >= 2:
+            yield weight.flatten(1)
+
+def add_group_scores(scores, group, group_scores):
+    # channels coupled through a residual add share one score
+    scores[group] = group_scores if group not in scores else scores[group] + group_scores
+
+def row_scores(model, dependencies, reduce):
+    """ score the channels of every group by reducing the rows of their weights with reduce
+    Weights whose kernels have the same length are stacked, so each length needs only one reduction.
+    """
+    buckets = {}
+    for group, members in dependencies.items():
+        for weight in producer_weights(model, members):
+            buckets.setdefault(weight.shape[1], []).append((group, weight))
+    scores = {}
+    for bucket in buckets.values():
+        bucket_scores = reduce(torch.cat([weight for _, weight in bucket]))
+        for (group, weight), group_scores in zip(bucket, torch.split(bucket_scores, [len(weight) for _, weight in bucket])):
+            add_group_scores(scores, group, group_scores)
+    return scores
+
+
+importance_criteria = {}
+statistics_criteria = set()
+
+def register_criterion(name, needs_statistics=False):
+    """ register a function(model, dependencies, statistics) -> scores as the importance criterion called name
+    dependencies maps every channel group name to its list of (module_name, dim, offset, repeat), statistics
+    is the ChannelStatistics recorded while training model, only given to criteria that need it. scores
+    maps every group name to the score of each of its channels, the lowest scored channels are pruned first
+    """
+    def register(criterion):
+        importance_criteria[name] = criterion
+        if needs_statistics:
+            statistics_criteria.add(name)
+        return criterion
+    return register
+
+@register_criterion('variance')
+def weight_variance_scores(model, dependencies, statistics=None):
+    """ variance of the weights of each channel """
+    return row_scores(model, dependencies, lambda rows: torch.var(rows, dim=1))
+
+@register_criterion('l1')
+def l1_norm_scores(model, dependencies, statistics=None):
+    """ l1 norm of the weights of each channel """
+    return row_scores(model, dependencies, lambda rows: rows.abs().sum(dim=1))
+
+@register_criterion('l2')
+def l2_norm_scores(model, dependencies, statistics=None):
+    """ l2 norm of the weights of each channel """
+    return row_scores(model, dependencies, lambda rows: rows.norm(dim=1))
+
+@register_criterion('bn_gamma')
+def bn_gamma_scores(model, dependencies, statistics=None):
+    """ |gamma| of the BatchNorm2d scaling each channel, groups without BatchNorm fall back to the l1 norm """
+    gammas = []
+    for group, members in dependencies.items():
+        for module_name, dim, offset, repeat in members:
+            module = model.get_submodule(module_name)
+            if dim == 0 and isinstance(module, nn.BatchNorm2d) and module.affine:
+                gammas.append((group, module.weight.data))
+    scores = {}
+    if len(gammas) > 0:
+        magnitudes = torch.cat([gamma for _, gamma in gammas]).abs()
+        for (group, gamma), group_scores in zip(gammas, torch.split(magnitudes, [len(gamma) for _, gamma in gammas])):
+            add_group_scores(scores, group, group_scores)
+    unnormalized = {group: members for group, members in dependencies.items() if group not in scores}
+    if len(unnormalized) > 0:
+        scores.update(l1_norm_scores(model, unnormalized))
+    return scores
+
+@register_criterion('fpgm')
+def geometric_median_scores(model, dependencies, statistics=None):
+    """ summed distance of each filter to the other filters of its layer (FPGM)
+    Filters near the geometric median of their layer are the easiest to replace by the others.
+    Layers of the same shape are stacked, so each shape needs only one batched cdist.
+    """
+    buckets = {}
+    for group, members in dependencies.items():
+        for weight in producer_weights(model, members):
+            buckets.setdefault(tuple(weight.shape), []).append((group, weight))
+    scores = {}
+    for bucket in buckets.values():
+        weights = torch.stack([weight for _, weight in bucket])
+        distances = torch.cdist(weights, weights).sum(dim=2)
+        for (group, _), group_scores in zip(bucket, distances):
+            add_group_scores(scores, group, group_scores)
+    return scores
+
+def get_monitored_modules(model, members):
+    """ return the names of the modules among members whose outputs ChannelStatistics records """
+    output_members = [module_name for module_name, dim, offset, repeat in members if dim == 0]
+    batchnorms = [module_name for module_name in output_members if isinstance(model.get_submodule(module_name), nn.BatchNorm2d)]
+    if len(batchnorms) > 0:
+        return batchnorms
+    return [module_name for module_name in output_members if isinstance(model.get_submodule(module_name), (nn.Conv2d, nn.Linear))]
+
+def statistics_scores(model, dependencies, statistics, kind):
+    # channels coupled through a residual add share one score
+    scores = {}
+    for group, members in dependencies.items():
+        for module_name in get_monitored_modules(model, members):
+            add_group_scores(scores, group, statistics.mean(model, module_name, kind))
+    return scores
+
+@register_criterion('taylor', needs_statistics=True)
+def taylor_scores(model, dependencies, statistics):
+    """ first order Taylor estimate |activation * gradient| of the loss change when each channel is removed """
+    return statistics_scores(model, dependencies, statistics, 'taylor')
+
+@register_criterion('apoz', needs_statistics=True)
+def apoz_scores(model, dependencies, statistics):
+    """ 1 - average percentage of zeros (APoZ) of each channel after the ReLU """
+    return statistics_scores(model, dependencies, statistics, 'nonzero')
+
+@register_criterion('activation', needs_statistics=True)
+def mean_activation_scores(model, dependencies, statistics):
+    """ mean activation of each channel after the ReLU """
+    return statistics_scores(model, dependencies, statistics, 'activation')
+
+
+class ChannelStatistics:
+    """ per channel statistics of the training steps, for the data driven importance criteria
+    Inside recording, forward hooks on the BatchNorm2d layers of every channel group, or on its
+    producers if it has none, add up the mean activation and the fraction of non-positive outputs
+    (zeros after ReLU) of each channel, and a hook on the output gradient adds up the Taylor
+    importance |sum(activation * gradient)|. The statistics of a module are reset when its width
+    changes, so they always describe the current architecture.
+    Args:
+        enabled: record nothing when False, so the hooks cost nothing unless a criterion needs them
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.sums = {}          # module_name -> {kind: per channel sum}
+        self.counts = {}        # module_name -> number of samples summed
+        self.handles = []
+
+    def attach(self, model):
+        for group in get_channel_groups(model):
+            for module_name in get_monitored_modules(model, get_channel_dependencies(model, group)):
+                hook = lambda module, input, output, module_name=module_name: self.record(module, module_name, output)
+                self.handles.append(model.get_submodule(module_name).register_forward_hook(hook))
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    @contextmanager
+    def recording(self, model):
+        """ add the statistics of every training step of model inside the with block """
+        if self.enabled:
+            self.attach(model)
+        try:
+            yield model
+        finally:
+            self.detach()
+
+    def record(self, module, module_name, output):
+        if not module.training or not output.requires_grad:
+            return
+        activation = output.detach()
+        spatial_dims = list(range(2, activation.dim()))
+        if module_name not in self.sums or len(self.sums[module_name]['activation']) != activation.shape[1]:
+            self.sums[module_name] = {kind: torch.zeros(activation.shape[1], device=activation.device) for kind in ('taylor', 'nonzero', 'activation')}
+            self.counts[module_name] = 0
+        sums = self.sums[module_name]
+        positive = activation.clamp(min=0)
+        if len(spatial_dims) > 0:
+            sums['nonzero'] += (activation > 0).float().mean(dim=spatial_dims).sum(dim=0)
+            sums['activation'] += positive.mean(dim=spatial_dims).sum(dim=0)
+        else:
+            sums['nonzero'] += (activation > 0).float().sum(dim=0)
+            sums['activation'] += positive.sum(dim=0)
+        self.counts[module_name] += activation.shape[0]
+
+        def record_gradient(gradient):
+            product = activation * gradient
+            if len(spatial_dims) > 0:
+                product = product.sum(dim=spatial_dims)
+            sums['taylor'] += product.abs().sum(dim=0)
+        output.register_hook(record_gradient)
+
+    def mean(self, model, module_name, kind):
+        """ return the per sample mean of the statistic kind of every output channel of module_name """
+        width = get_width(model.get_submodule(module_name))
+        if module_name not in self.sums or len(self.sums[module_name][kind]) != width or self.counts[module_name] == 0:
+            raise ValueError('no channel statistics recorded for %s, train the model inside ChannelStatistics.recording first' % module_name)
+        return self.sums[module_name][kind] / self.counts[module_name]
+
+
+def apply_channel_plan(model, removals, dependencies, optimizer=None):
+    """ remove all planned channels at once, with one index_select per affected tensor
+    Args:
+        model: the model to be pruned in place
+        removals: dict mapping a channel group name to the LongTensor of channels to remove
+        dependencies: function mapping a group name to its list of (module_name, dim, offset, repeat),
+            dim 0 means the group indexes the module's output channels, dim 1 its input channels,
+            input channel c of the group lives at (offset + c) * repeat ... (offset + c + 1) * repeat - 1
+        optimizer: optimizer over model's parameters, its state is sliced along with them
+    """
+    removed_indices = {}
+    for group, channels in removals.items():
+        for module_name, dim, offset, repeat in dependencies(group):
+            indices = (channels.view(-1, 1) + offset) * repeat + torch.arange(repeat, device=channels.device)
+            removed_indices.setdefault(module_name, {0: [], 1: []})[dim].append(indices.view(-1))
+
+    for module_name, dims in removed_indices.items():
+        module = model.get_submodule(module_name)
+        device = module.weight.device
+        out_indices = get_kept_indices(get_width(module), dims[0], device)
+        in_indices = None
+        if isinstance(module, nn.BatchNorm2d):
+            new_module = prune_batchnorm2d(module, out_indices)
+        else:
+            in_indices = get_kept_indices(get_input_width(module), dims[1], device)
+            if isinstance(module, nn.Conv2d):
+                new_module = prune_conv2d(module, out_indices, in_indices)
+            else:
+                new_module = prune_linear(module, out_indices, in_indices)
+        new_module.train(module.training)
+        if optimizer is not None:
+            slice_optimizer_state(optimizer, module, new_module, out_indices, in_indices)
+        set_submodule(model, module_name, new_module)
+
+
+class ChannelTracer(fx.Tracer):
+    """ torch.fx tracer that also traces through modules created inside forward,
+    e.g. nn.ReLU(inplace=True)(...) in BottleNeck.forward
+    """
+    def call_module(self, m, forward, args, kwargs):
+        try:
+            self.path_of_module(m)
+        except NameError:
+            return forward(*args, **kwargs)
+        return super().call_module(m, forward, args, kwargs)
+
+
+class ChannelGraph:
+    """ coupled channel groups of a model, found by tracing it once with torch.fx
+    Every Conv2d / Linear output starts a channel group. BatchNorm2d, activation, pooling and
+    dropout layers keep the group, residual adds merge the groups of both inputs, torch.cat
+    concatenates them and flatten repeats every channel by its spatial size. A group whose
+    channels reach the model output can not be pruned.
+    Args:
+        model: the model to be traced
+        input_size: size of one input sample, e.g. (3, 32, 32)
+    """
+    def __init__(self, model, input_size):
+        self.parents = []       # union find over the channel groups started by each producer
+        self.producers = []     # name of the Conv2d / Linear that started each group
+        self.members = []       # (module_name, dim, preceding_groups, repeat) indexed by each group
+        self.blocked = set()
+        graph_module = fx.GraphModule(model, ChannelTracer().trace(model))
+        # shape propagation runs a forward pass, so keep the BatchNorm running stats untouched
+        training = {module: module.training for module in model.modules()}
+        model.eval()
+        parameter = next(model.parameters())
+        with torch.no_grad():
+            ShapeProp(graph_module).propagate(torch.zeros((1,) + tuple(input_size), dtype=parameter.dtype, device=parameter.device))
+        for module, module_training in training.items():
+            module.training = module_training
+
+        layouts = {}
+        # spatial sizes never change when channels are pruned, so they are kept for counting the costs
+        self.shapes = {}            # module_name -> (input shape, output shape) for one sample
+        self.input_layouts = {}     # module_name -> layout of the module's input
+        # every tensor of the forward pass in execution order, kept for estimating the activation memory
+        self.tensors = []           # (module_name or None, shape for one sample, layout, input tensor ids, reuses_input)
+        self.output_tensors = []    # ids of the tensors returned by the model
+        tensor_ids = {}
+        for node in graph_module.graph.nodes:
+            layouts[node] = self.propagate(node, layouts, graph_module)
+            if node.op == 'call_module' and 'tensor_meta' in node.meta:
+                input_node = node.all_input_nodes[0]
+                self.shapes[node.target] = (tuple(input_node.meta['tensor_meta'].shape), tuple(node.meta['tensor_meta'].shape))
+                self.input_layouts[node.target] = layouts.get(input_node)
+            input_ids = [tensor_ids[input_node] for input_node in node.all_input_nodes if input_node in tensor_ids]
+            if node.op == 'output':
+                self.output_tensors = input_ids
+            elif hasattr(node.meta.get('tensor_meta'), 'shape'):
+                tensor_ids[node] = len(self.tensors)
+                module_name = node.target if node.op == 'call_module' else None
+                self.tensors.append((module_name, tuple(node.meta['tensor_meta'].shape), layouts[node], input_ids, len(input_ids) > 0 and self.reuses_input(node, graph_module)))
+
+        # gather the members of every merged group, named by its first producer
+        self.groups = {}
+        self.group_members = {}
+        blocked_roots = set(self.find(group) for group in self.blocked)
+        for group, producer in enumerate(self.producers):
+            root = self.find(group)
+            if root in blocked_roots:
+                continue
+            self.groups[producer] = root
+            self.group_members.setdefault(root, []).extend(self.members[group])
+
+    def find(self, group):
+        while self.parents[group] != group:
+            self.parents[group] = self.parents[self.parents[group]]
+            group = self.parents[group]
+        return group
+
+    def union(self, group1, group2):
+        root1, root2 = self.find(group1), self.find(group2)
+        if root1 != root2:
+            self.parents[max(root1, root2)] = min(root1, root2)
+
+    def block(self, layout):
+        if layout is not None:
+            self.blocked.update(group for group, repeat in layout)
+
+    def add_members(self, layout, module_name, dim):
+        for position, (group, repeat) in enumerate(layout):
+            preceding_groups = [preceding_group for preceding_group, _ in layout[:position]]
+            self.members[group].append((module_name, dim, preceding_groups, repeat))
+
+    def propagate(self, node, layouts, graph_module):
+        """ return the layout of node's output: list of (group, repeat) along the channel dimension,
+        None if the output is the model input or not a tensor
+        """
+        input_layouts = [layouts.get(arg) for arg in node.all_input_nodes]
+        layout = input_layouts[0] if len(input_layouts) > 0 else None
+        if node.op == 'output':
+            for input_layout in input_layouts:
+                self.block(input_layout)
+            return None
+        if node.op == 'placeholder' or 'tensor_meta' not in node.meta:
+            return None
+
+        if node.op == 'call_module':
+            module = graph_module.get_submodule(node.target)
+            if isinstance(module, (nn.Conv2d, nn.Linear)):
+                if layout is not None:
+                    if isinstance(module, nn.Conv2d) and module.groups != 1:
+                        self.block(layout)
+                    else:
+                        self.add_members(layout, node.target, 1)
+                group = len(self.producers)
+                self.parents.append(group)
+                self.producers.append(node.target)
+                self.members.append([(node.target, 0, [], 1)])
+                return [(group, 1)]
+            if isinstance(module, nn.BatchNorm2d) and layout is not None:
+                self.add_members(layout, node.target, 0)
+            return layout
+
+        if node.target in (operator.add, operator.iadd, torch.add, 'add', 'add_'):
+            if any(input_layout is None for input_layout in input_layouts):
+                return layout
+            if len(set(len(input_layout) for input_layout in input_layouts)) != 1:
+                for input_layout in input_layouts:
+                    self.block(input_layout)
+                return layout
+            # a residual add ties the channels of both inputs together
+            for input_layout in input_layouts[1:]:
+                for (group1, repeat1), (group2, repeat2) in zip(layout, input_layout):
+                    self.union(group1, group2)
+            return layout
+        if node.target == torch.cat:
+            dim = node.args[1] if len(node.args) > 1 else node.kwargs.get('dim', 0)
+            if dim != 1 or any(input_layout is None for input_layout in input_layouts):
+                for input_layout in input_layouts:
+                    self.block(input_layout)
+                return None
+            return [segment for input_layout in input_layouts for segment in input_layout]
+
+        input_shape = node.all_input_nodes[0].meta['tensor_meta'].shape if len(node.all_input_nodes) > 0 and 'tensor_meta' in node.all_input_nodes[0].meta else None
+        output_shape = node.meta['tensor_meta'].shape
+        if layout is None or input_shape == output_shape:
+            # element-wise operations keep the channel layout
+            return layout
+        if node.target in (torch.flatten, 'flatten', 'view', 'reshape') and len(input_shape) == 4 and len(output_shape) == 2 and input_shape[0] == output_shape[0]:
+            # every channel is repeated by its spatial size after flatten
+            spatial_size = input_shape[2] * input_shape[3]
+            return [(group, repeat * spatial_size) for group, repeat in layout]
+        self.block(layout)
+        return None
+
+    def reuses_input(self, node, graph_module):
+        """ return whether node's output is stored in the memory of its first input, i.e. in-place operations and views """
+        if node.op == 'call_module':
+            return getattr(graph_module.get_submodule(node.target), 'inplace', False)
+        if node.op == 'call_method':
+            return node.target.endswith('_') or node.target in ('view', 'flatten', 'reshape', 'squeeze', 'unsqueeze')
+        if node.op == 'call_function':
+            return node.kwargs.get('inplace', False) or node.target in (operator.iadd, torch.flatten, torch.reshape, torch.squeeze, torch.unsqueeze)
+        return False
+
+    def get_dependencies(self, model, group):
+        """ return the (module_name, dim, offset, repeat) of group with offsets computed from model's current widths """
+        dependencies = []
+        for module_name, dim, preceding_groups, repeat in self.group_members[self.groups[group]]:
+            offset = sum(get_width(model.get_submodule(self.producers[preceding_group])) for preceding_group in preceding_groups)
+            dependencies.append((module_name, dim, offset, repeat))
+        return dependencies
+
+
+channel_graph_cache = {}
+
+def get_channel_graph(model):
+    """ return the ChannelGraph of model, traced once per architecture
+    model.input_size gives the size of one input sample. Pruning only changes widths, never
+    which layers feed which, so the graph is cached by model class and submodule names.
+    """
+    key = (type(model), tuple(model.input_size), tuple(name for name, _ in model.named_modules()))
+    if key not in channel_graph_cache:
+        channel_graph_cache[key] = ChannelGraph(model, model.input_size)
+    return channel_graph_cache[key]
+
+def get_channel_groups(model):
+    """ return the names of all prunable channel groups of model, i.e. the first producer of each group """
+    graph = get_channel_graph(model)
+    return [producer for producer, root in graph.groups.items() if graph.producers[root] == producer]
+
+def get_channel_dependencies(model, group):
+    """ return every (module_name, dim, offset, repeat) whose channels are removed together with group's channels
+    group can be the name of any Conv2d / Linear that produces the group's channels
+    """
+    return get_channel_graph(model).get_dependencies(model, group)
+
+class ImportanceCache:
+    """ channels of every group in order of importance, scored once for a parent architecture
+    All candidates of a generation are pruned from the same parent, so the scores are computed for
+    it in one batched pass and each group is sorted once. Channels are then taken from the front of
+    the order: removing one costs O(1) and never reduces the weights again. The cache remembers which
+    of the parent's channels are gone, to translate its indices into those of the pruned model.
+    Args:
+        model: the parent model
+        criterion: name of the registered importance criterion ranking the channels
+        statistics: ChannelStatistics recorded while training model, needed by the data driven criteria
+    """
+    def __init__(self, model, criterion='variance', statistics=None):
+        graph = get_channel_graph(model)
+        groups = get_channel_groups(model)
+        if criterion in statistics_criteria and statistics is None:
+            raise ValueError('importance criterion %s needs the ChannelStatistics recorded while training' % criterion)
+        scores = importance_criteria[criterion](model, {group: get_channel_dependencies(model, group) for group in groups}, statistics)
+        self.names = {producer: graph.producers[root] for producer, root in graph.groups.items()}
+        self.orders = {group: torch.argsort(scores[group], stable=True).tolist() for group in groups}
+        self.heads = {group: 0 for group in groups}
+        self.removed = {group: [] for group in groups}
+
+    def copy(self):
+        """ return a cache that continues from the current state, the orders are shared """
+        importance = copy.copy(self)
+        importance.heads = dict(self.heads)
+        importance.removed = {group: list(removed) for group, removed in self.removed.items()}
+        return importance
+
+    def select(self, plan):
+        """ pop the least important channels of every group in plan
+        Args:
+            plan: dict mapping a channel group name to the number of channels to remove
+        Returns: removals: dict mapping a channel group name to the LongTensor of channels to remove,
+            indexed in the model that already lost the channels selected before
+        """
+        removals = {}
+        for plan_group, remove_num in plan.items():
+            group = self.names[plan_group]
+            head = self.heads[group]
+            channels = self.orders[group][head:head + remove_num]
+            self.heads[group] = head + remove_num
+            removed = self.removed[group]
+            removals[plan_group] = torch.tensor([channel - bisect.bisect_left(removed, channel) for channel in channels], dtype=torch.long)
+            for channel in channels:
+                bisect.insort(removed, channel)
+        return removals
+
+    def kept_channels(self, model):
+        """ return the dict mapping every group that lost channels to the LongTensor of the channels of the parent model it kept """
+        parameter = next(model.parameters())
+        return {group: get_kept_indices(get_width(model.get_submodule(group)), [torch.tensor(removed, dtype=torch.long)], parameter.device)
+                for group, removed in self.removed.items() if len(removed) > 0}
+
+
+def select_channels(model, plan, importance=None):
+    """ return the dict mapping each group of plan to the LongTensor of its least important channels
+    importance is the ImportanceCache of model's parent and is updated with the selected channels,
+    a fresh one is computed from model if it is None
+    """
+    if importance is None:
+        importance = ImportanceCache(model)
+    removals = importance.select(plan)
+    parameter = next(model.parameters())
+    return {group: channels.to(parameter.device) for group, channels in removals.items()}
+
+def prune_channels(model, plan, importance=None, optimizer=None):
+    """ remove the least important channels of every group in plan from model, in place
+    Args:
+        model: the model to be pruned
+        plan: dict mapping a channel group name to the number of channels to remove
+        importance: ImportanceCache of model's parent, updated with the removed channels
+        optimizer: optimizer over model's parameters, its momentum buffers are pruned along with them
+    """
+    apply_channel_plan(model, select_channels(model, plan, importance), lambda group: get_channel_dependencies(model, group), optimizer)
+
+
+class ChannelMask:
+    """ a virtual pruned candidate: masks the removed channels of model instead of rebuilding its layers
+    The inputs of every layer that reads a removed channel are zeroed by forward pre hooks, so the
+    masked model computes exactly what the compacted model would, while all candidates share the
+    parameters of model. Each candidate keeps its own BatchNorm running stats, because the stats
+    depend on which channels are masked upstream.
+    Args:
+        model: the model whose parameters are shared by the candidates
+        removals: dict mapping a channel group name to the LongTensor of channels to remove
+    """
+    def __init__(self, model, removals):
+        self.removals = removals
+        self.input_masks = {}
+        for group, channels in removals.items():
+            for module_name, dim, offset, repeat in get_channel_dependencies(model, group):
+                if dim != 1:
+                    continue
+                module = model.get_submodule(module_name)
+                if module_name not in self.input_masks:
+                    self.input_masks[module_name] = torch.ones(get_input_width(module), device=module.weight.device)
+                indices = (channels.view(-1, 1) + offset) * repeat + torch.arange(repeat, device=channels.device)
+                self.input_masks[module_name][indices.view(-1).to(module.weight.device)] = 0
+        self.bn_buffers = {}
+        for module_name, module in model.named_modules():
+            if isinstance(module, nn.BatchNorm2d) and module.track_running_stats:
+                self.bn_buffers[module_name] = [module.running_mean.clone(), module.running_var.clone(), module.num_batches_tracked.clone()]
+        self.handles = []
+
+    def swap_bn_buffers(self, model):
+        for module_name, buffers in self.bn_buffers.items():
+            module = model.get_submodule(module_name)
+            shared_buffers = [module.running_mean, module.running_var, module.num_batches_tracked]
+            module.running_mean, module.running_var, module.num_batches_tracked = buffers
+            self.bn_buffers[module_name] = shared_buffers
+
+    def attach(self, model):
+        self.swap_bn_buffers(model)
+        for module_name, input_mask in self.input_masks.items():
+            shape = (1, -1, 1, 1) if isinstance(model.get_submodule(module_name), nn.Conv2d) else (1, -1)
+            mask = input_mask.view(shape)
+            self.handles.append(model.get_submodule(module_name).register_forward_pre_hook(lambda module, input, mask=mask: (input[0] * mask,) + input[1:]))
+
+    def detach(self, model):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.swap_bn_buffers(model)
+
+    @contextmanager
+    def applied(self, model):
+        """ run model as this candidate inside the with block """
+        self.attach(model)
+        try:
+            yield model
+        finally:
+            self.detach(model)
+
+    def compact(self, model, optimizer=None):
+        """ physically remove the masked channels from model, which keeps this candidate's BatchNorm running stats
+        optimizer is the optimizer over model's parameters, its state is sliced along with them
+        """
+        for module_name, buffers in self.bn_buffers.items():
+            module = model.get_submodule(module_name)
+            module.running_mean, module.running_var, module.num_batches_tracked = [buffer.clone() for buffer in buffers]
+        apply_channel_plan(model, self.removals, lambda group: get_channel_dependencies(model, group), optimizer)
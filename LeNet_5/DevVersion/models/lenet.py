@@ -1,9 +1,16 @@
 import torch
 import torch.nn as nn
+
+from models.pruning import add_to_plan, remaining_width, prune_channels, ImportanceCache, align_plan
+
 class LeNet(nn.Module):
+    input_size = (1, 32, 32)
+
     # define internal methods inside the module
     def __init__(self, num_class=10):
         super(LeNet, self).__init__()
+        # kept for ArchitectureSpec to rebuild the model
+        self.num_class = num_class
         self.conv1 = nn.Conv2d(1, 6, 5)
         self.pool1 = nn.MaxPool2d(2)
         self.conv2 = nn.Conv2d(6, 16, 5)
@@ -39,100 +46,49 @@ class LeNet(nn.Module):
 
 
     # define the function to resize the architecture kernel number
-    def update_architecture(self, modification_num):
+    def update_architecture(self, modification_num, bulk=False, importance=None, criterion='variance', optimizer=None, align=1, plan=None):
         update_times = int(modification_num + 1)
+        # channel scores of the parent, shared by all candidates of a generation
+        importance = ImportanceCache(self, criterion) if importance is None else importance.copy()
+        if plan is not None:
+            # drawn beforehand, e.g. picked among many plans by the surrogate
+            prune_channels(self, plan, importance, optimizer)
+        elif bulk or align > 1:
+            # draw the whole pruning plan first, then rebuild every affected layer only once
+            # widths are aligned over the whole plan, single channel steps would all round to a multiple
+            prune_channels(self, align_plan(self, self.draw_pruning_plan(update_times), align), importance, optimizer)
+        else:
+            for update_id in range(update_times):
+                prune_channels(self, self.draw_pruning_plan(1), importance, optimizer)
+        # the cache knows which channels of the parent the pruned model kept
+        return importance
+
+
+    # draw the random choices of update_architecture, and count how many channels each layer loses
+    def draw_pruning_plan(self, update_times):
+        plan = {}
         for update_id in range(update_times):
             if torch.rand(1).item() < 0.1:
-                self.prune_kernel()
+                self.prune_kernel(plan)
             else:
-                self.prune_neuron()
-
+                self.prune_neuron(plan)
+        return plan
 
-    def prune_kernel(self):
-        if torch.rand(1).item() < 0.3 and self.conv1.out_channels - 1 > 0:
-            new_conv1_kernel_num = self.conv1.out_channels - 1
-            # update conv1
-            new_conv1 = nn.Conv2d(self.conv1.in_channels, new_conv1_kernel_num, kernel_size=5)
-            # prone the kernel with least variance weights
-            weight_variances = torch.var(self.conv1.weight.data, dim = [1, 2, 3])
-            target_kernel = torch.argmin(weight_variances).item()
-            with torch.no_grad():
-                new_conv1.weight.data = torch.cat([self.conv1.weight.data[:target_kernel], self.conv1.weight.data[target_kernel+1:]], dim=0)
-                new_conv1.bias.data = torch.cat([self.conv1.bias.data[:target_kernel], self.conv1.bias.data[target_kernel+1:]], dim=0)
-            self.conv1 = new_conv1
 
-            # update conv2
-            new_conv2 = nn.Conv2d(self.conv1.out_channels, self.conv2.out_channels, kernel_size=5)
-            with torch.no_grad():
-                kept_indices = [i for i in range(self.conv2.in_channels) if i != target_kernel]
-                new_conv2.weight.data = self.conv2.weight.data[:, kept_indices, :, :]
-                new_conv2.bias.data = self.conv2.bias.data
-            self.conv2 = new_conv2
+    # add one kernel of conv1 or conv2 to plan, the least important kernel is chosen by prune_channels
+    def prune_kernel(self, plan):
+        if torch.rand(1).item() < 0.3 and remaining_width(self, plan, 'conv1') - 1 > 0:
+            add_to_plan(self, plan, 'conv1')
         else:
-            new_conv2_kernel_num = self.conv2.out_channels - 1
-            if new_conv2_kernel_num == 0:
-                return
-            # update conv2
-            new_conv2 = nn.Conv2d(self.conv1.out_channels, new_conv2_kernel_num, kernel_size=5)
-            # prone the kernel with least variance weights
-            weight_variances = torch.var(self.conv2.weight.data, dim = [1, 2, 3])
-            target_kernel = torch.argmin(weight_variances).item()
-            with torch.no_grad():
-                new_conv2.weight.data = torch.cat([self.conv2.weight.data[:target_kernel], self.conv2.weight.data[target_kernel+1:]], dim=0)
-                new_conv2.bias.data = torch.cat([self.conv2.bias.data[:target_kernel], self.conv2.bias.data[target_kernel+1:]], dim=0)
-            self.conv2 = new_conv2
-
-            # update fc1
-            output_length = 5 # gained by printing "output"
-            new_fc1_input_features = new_conv2_kernel_num * output_length ** 2
-            new_fc1 = nn.Linear(new_fc1_input_features, self.fc1.out_features)
-            with torch.no_grad():
-                start_index = target_kernel * output_length ** 2
-                end_index = start_index + output_length ** 2
-                new_fc1.weight.data = torch.cat((self.fc1.weight.data[:, :start_index], self.fc1.weight.data[:, end_index:]), dim=1)
-                new_fc1.bias.data = self.fc1.bias.data
-            self.fc1 = new_fc1
+            add_to_plan(self, plan, 'conv2')
     
 
-    def prune_neuron(self):
-        if torch.rand(1).item() < 0.6 and self.fc1.out_features - 1 > 0:
-            new_fc1_output_features = self.fc1.out_features - 1
-            # update fc1
-            new_fc1 = nn.Linear(self.fc1.in_features, new_fc1_output_features)
-            # prune the neuron with least variance weights
-            weight_variances = torch.var(self.fc1.weight.data, dim = 1)
-            target_neuron = torch.argmin(weight_variances).item()
-            with torch.no_grad():
-                new_fc1.weight.data = torch.cat([self.fc1.weight.data[:target_neuron], self.fc1.weight.data[target_neuron+1:]], dim=0)
-                new_fc1.bias.data = torch.cat([self.fc1.bias.data[:target_neuron], self.fc1.bias.data[target_neuron+1:]])
-            self.fc1 = new_fc1
-
-            # update fc2
-            new_fc2 = nn.Linear(self.fc1.out_features, self.fc2.out_features)
-            with torch.no_grad():
-                new_fc2.weight.data = torch.cat([self.fc2.weight.data[:, :target_neuron], self.fc2.weight.data[:, target_neuron+1:]], dim=1)
-                new_fc2.bias.data = self.fc2.bias.data
-            self.fc2 = new_fc2
+    # add one neuron of fc1 or fc2 to plan
+    def prune_neuron(self, plan):
+        if torch.rand(1).item() < 0.6 and remaining_width(self, plan, 'fc1') - 1 > 0:
+            add_to_plan(self, plan, 'fc1')
         else:
-            new_fc2_output_features = self.fc2.out_features - 1
-            if new_fc2_output_features == 0:
-                return
-            # update fc2
-            new_fc2 = nn.Linear(self.fc2.in_features, new_fc2_output_features)
-            # prune the neuron with least variance weights
-            weight_variances = torch.var(self.fc2.weight.data, dim = 1)
-            target_neuron = torch.argmin(weight_variances).item()
-            with torch.no_grad():
-                new_fc2.weight.data = torch.cat([self.fc2.weight.data[:target_neuron], self.fc2.weight.data[target_neuron+1:]], dim=0)
-                new_fc2.bias.data = torch.cat([self.fc2.bias.data[:target_neuron], self.fc2.bias.data[target_neuron+1:]])
-            self.fc2 = new_fc2
-
-            # update fc3
-            new_fc3 = nn.Linear(self.fc2.out_features, self.fc3.out_features)
-            with torch.no_grad():
-                new_fc3.weight.data = torch.cat([self.fc3.weight.data[:, :target_neuron], self.fc3.weight.data[:, target_neuron+1:]], dim=1)
-                new_fc3.bias.data = self.fc3.bias.data
-            self.fc3 = new_fc3
+            add_to_plan(self, plan, 'fc2')
 
 
     # update the conv1 activation function
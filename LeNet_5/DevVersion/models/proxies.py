@@ -0,0 +1,83 @@
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+proxies = {}
+
+def register_proxy(name):
+    """ register a function(model, inputs, labels) -> score as the zero-cost proxy called name
+    The score tells how well model would train from one minibatch of inputs and labels, without training it,
+    higher is better. model itself is left untouched, the proxies work on a copy.
+    """
+    def register(proxy):
+        proxies[name] = proxy
+        return proxy
+    return register
+
+def weighted_layers(model):
+    return [module for module in model.modules() if isinstance(module, (nn.Conv2d, nn.Linear))]
+
+def train_copy(model):
+    """ return a copy of model in train mode, but with dropout off so that every candidate is scored alike """
+    model = copy.deepcopy(model).train()
+    for module in model.modules():
+        if isinstance(module, nn.modules.dropout._DropoutNd):
+            module.eval()
+    return model
+
+def loss_gradients(model, inputs, labels):
+    """ return a copy of model in train mode whose parameters hold the gradients of the cross entropy on the minibatch """
+    model = train_copy(model)
+    model.zero_grad()
+    F.cross_entropy(model(inputs), labels).backward()
+    return model
+
+@register_proxy('synflow')
+def synflow(model, inputs, labels=None):
+    """ sum of |theta * dR / dtheta| over the weights, R being the summed output of the network with every weight made
+    positive on an all ones input. BatchNorm is bypassed and double precision keeps deep products from overflowing
+    """
+    model = copy.deepcopy(model).double().eval()
+    with torch.no_grad():
+        for parameter in model.parameters():
+            parameter.abs_()
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.register_forward_hook(lambda module, input, output: input[0])
+    model.zero_grad()
+    model(torch.ones_like(inputs[:1], dtype=torch.float64)).sum().backward()
+    return sum((module.weight * module.weight.grad).abs().sum().item() for module in weighted_layers(model) if module.weight.grad is not None)
+
+@register_proxy('snip')
+def snip(model, inputs, labels):
+    """ sum of the SNIP saliency |theta * dL / dtheta| over the weights, L being the cross entropy on the minibatch """
+    model = loss_gradients(model, inputs, labels)
+    return sum((module.weight * module.weight.grad).abs().sum().item() for module in weighted_layers(model) if module.weight.grad is not None)
+
+@register_proxy('grad_norm')
+def grad_norm(model, inputs, labels):
+    """ sum of the l2 norms of dL / dtheta of every layer, L being the cross entropy on the minibatch """
+    model = loss_gradients(model, inputs, labels)
+    return sum(module.weight.grad.norm().item() for module in weighted_layers(model) if module.weight.grad is not None)
+
+@register_proxy('jacob_cov')
+def jacob_cov(model, inputs, labels=None):
+    """ how uncorrelated the input jacobians of the samples of the minibatch are, scored from the eigenvalues of
+    their correlation matrix. Networks that tell the samples apart before training score higher
+    """
+    model = train_copy(model)
+    inputs = inputs.clone().requires_grad_(True)
+    model(inputs).sum().backward()
+    jacobians = inputs.grad.flatten(1).cpu().numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlations = np.corrcoef(jacobians)
+    if not np.all(np.isfinite(correlations)):
+        # a sample without any gradient, the network is dead for it
+        return float('-inf')
+    eigenvalues = np.linalg.eigvalsh(correlations)
+    k = 1e-5
+    return float(-np.sum(np.log(eigenvalues + k) + 1 / (eigenvalues + k)))
@@ -0,0 +1,81 @@
+import torch
+import torch.nn as nn
+
+from models.pruning import get_channel_graph, get_channel_groups, get_width
+
+
+def get_widths(model):
+    """ return the dict mapping every channel group of model to its width """
+    return {group: get_width(model.get_submodule(group)) for group in get_channel_groups(model)}
+
+def get_planned_widths(model, plan):
+    """ return the dict mapping every channel group of model to its width once the channels counted in plan are removed
+    plan: dict mapping any producer of a channel group to the number of channels to remove
+    """
+    graph = get_channel_graph(model)
+    widths = get_widths(model)
+    for group, remove_num in plan.items():
+        widths[graph.producers[graph.groups[group]]] -= remove_num
+    return widths
+
+
+class AccuracySurrogate:
+    """ small MLP predicting how much top1 / top5 accuracy a candidate has after fine-tuning, relative to its parent
+    An architecture is encoded by the width of every channel group, both as a fraction of the original model and of
+    the parent it is pruned from. The pairs come from the candidates every generation fine-tunes, and the network is
+    fitted again from scratch whenever new ones arrive, which takes a moment on the few hundred pairs of a search.
+    Args:
+        reference_widths: dict mapping every channel group to its width in the original model, see get_widths
+        min_samples: number of pairs to learn from before the predictions are trusted, see ready()
+        hidden_size: width of the hidden layer
+        epochs: full batch Adam steps of every fit
+        seed: seeds the initialization of every fit, the global random state is left untouched
+    """
+    def __init__(self, reference_widths, min_samples=8, hidden_size=32, epochs=500, seed=0):
+        self.reference_widths = reference_widths
+        self.min_samples = min_samples
+        self.hidden_size = hidden_size
+        self.epochs = epochs
+        self.seed = seed
+        self.features = []
+        self.targets = []
+        self.network = None
+
+    def encode(self, widths, parent_widths):
+        return [widths[group] / self.reference_widths[group] for group in self.reference_widths] + \
+               [widths[group] / parent_widths[group] for group in self.reference_widths]
+
+    def add(self, widths, parent_widths, parent_accuracies, accuracies):
+        """ learn that the architecture of widths, pruned from that of parent_widths, reached (top1, top5) accuracies
+        after fine-tuning, while the parent had parent_accuracies
+        """
+        self.features.append(self.encode(widths, parent_widths))
+        self.targets.append([accuracy - parent_accuracy for accuracy, parent_accuracy in zip(accuracies, parent_accuracies)])
+        self.network = None
+
+    def ready(self):
+        return len(self.targets) >= self.min_samples
+
+    def fit(self):
+        features = torch.tensor(self.features)
+        targets = torch.tensor(self.targets)
+        self.target_mean = targets.mean(dim=0)
+        self.target_std = targets.std(dim=0, unbiased=False).clamp(min=1e-4)
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed)
+            self.network = nn.Sequential(nn.Linear(features.shape[1], self.hidden_size), nn.ReLU(), nn.Linear(self.hidden_size, targets.shape[1]))
+        optimizer = torch.optim.Adam(self.network.parameters(), lr=0.01, weight_decay=1e-3)
+        scaled_targets = (targets - self.target_mean) / self.target_std
+        for epoch in range(self.epochs):
+            optimizer.zero_grad()
+            loss = nn.functional.mse_loss(self.network(features), scaled_targets)
+            loss.backward()
+            optimizer.step()
+
+    def predict(self, widths_list, parent_widths):
+        """ return the FloatTensor of the predicted (top1, top5) accuracy change of every architecture of widths_list """
+        if self.network is None:
+            self.fit()
+        features = torch.tensor([self.encode(widths, parent_widths) for widths in widths_list])
+        with torch.no_grad():
+            return self.network(features) * self.target_std + self.target_mean
@@ -5,7 +5,7 @@ from PIL import Image
 from torchvision import transforms
 from tqdm import tqdm
 import matplotlib.pyplot as plt
-from thop import profile
+from models.profiler import count_ops
 from utils import get_CIFAR10_test_dataloader, get_MNIST_test_dataloader
 
 
@@ -94,7 +94,8 @@ def test():
     original_FLOPs_num = 0.0
     compressed_para_num = 0.0
     compressed_FLOPs_num = 0.0
-    input = torch.rand(256, 1, 32, 32).to(device)
+    # FLOPs are counted analytically for a batch of this size
+    profile_batch_size = 256
 
     # initialize the testing parameters
     top1_correct_num = 0.0
@@ -119,7 +120,7 @@ def test():
     top1_accuracy = top1_correct_num / len(mnist_test_loader.dataset)
     top3_accuracy = top3_correct_num / len(mnist_test_loader.dataset)
     print('Original model has top1 accuracy: %f, top3 accuracy: %f' %(top1_accuracy, top3_accuracy))
-    original_FLOPs_num, original_para_num = profile(model, inputs = (input, ), verbose=False)
+    original_FLOPs_num, original_para_num = count_ops(model, profile_batch_size)
         
     
     # initialize the testing parameters
@@ -146,7 +147,7 @@ def test():
     top1_accuracy = top1_correct_num / len(mnist_test_loader.dataset)
     top3_accuracy = top3_correct_num / len(mnist_test_loader.dataset)
     print('Compressed Model has top1 accuracy: %f, top3 accuracy: %f' %(top1_accuracy, top3_accuracy))
-    compressed_FLOPs_num, compressed_para_num = profile(model, inputs = (input, ), verbose=False)
+    compressed_FLOPs_num, compressed_para_num = count_ops(model, profile_batch_size)
     
     # get compressed ratio
     FLOPs_compressed_ratio = compressed_FLOPs_num / original_FLOPs_num
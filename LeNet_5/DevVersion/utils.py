@@ -1,7 +1,11 @@
+import copy
+import math
+import numpy as np
+import torch
 from torch.optim.lr_scheduler import _LRScheduler
 import torchvision
 import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 
 def get_CIFAR10_training_dataloader(mean, std, batch_size=16, num_workers=2, shuffle=True):
     """ return training dataloader
@@ -89,3 +93,141 @@ class WarmUpLR(_LRScheduler):
         rate to base_lr * m / total_iters
         """
         return [base_lr * self.last_epoch / (self.total_iters + 1e-8) for base_lr in self.base_lrs]
+
+
+def extrapolate_accuracy(accuracies, epoch, confidence=2.0):
+    """ extrapolate a learning curve from the accuracies of its first epochs to epoch
+    The power law a - b * t^(-c) and the exponential a - b * exp(-c * t) are fitted to the accuracies of
+    epochs 1, 2, ...: for every c on a grid, a and b are solved by least squares and the best c is kept.
+    Args:
+        accuracies: the accuracies of epochs 1 to len(accuracies), at least 3 of them
+        epoch: the epoch to predict the accuracy at
+        confidence: how many standard errors of the residuals the upper bound adds
+    Returns: prediction, upper_bound
+        prediction is the mean of both fits at epoch, upper_bound adds the spread between the fits and
+        the confidence band of the better one
+    """
+    if len(accuracies) < 3:
+        return accuracies[-1], 1.0
+    epochs = np.arange(1, len(accuracies) + 1, dtype=float)
+    accuracies = np.asarray(accuracies, dtype=float)
+    predictions = []
+    errors = []
+    for curve in (lambda t, c: t ** -c, lambda t, c: np.exp(-c * t)):
+        best_error, best_prediction = math.inf, None
+        for c in np.linspace(0.05, 3, 60):
+            design = np.stack([np.ones_like(epochs), -curve(epochs, c)], axis=1)
+            coefficients = np.linalg.lstsq(design, accuracies, rcond=None)[0]
+            error = np.sum((design @ coefficients - accuracies) ** 2)
+            if error < best_error:
+                best_error, best_prediction = error, coefficients[0] - coefficients[1] * curve(epoch, c)
+        predictions.append(best_prediction)
+        errors.append(best_error)
+    prediction = float(np.mean(predictions))
+    standard_error = math.sqrt(min(errors) / max(1, len(accuracies) - 2))
+    upper_bound = max(predictions) + confidence * standard_error
+    return min(max(prediction, 0.0), 1.0), float(min(upper_bound, 1.0))
+
+
+def split_validation_dataloader(training_loader, test_loader, validation_size, seed=0):
+    """ carve a held-out validation set out of the training set of training_loader
+    The validation samples are a fixed random subset loaded in a fixed order with the transform of
+    test_loader, so growing prefixes of it are random samples and every model sees the same ones.
+    Returns: training_loader without the validation samples, validation_loader
+    """
+    permutation = torch.randperm(len(training_loader.dataset), generator=torch.Generator().manual_seed(seed)).tolist()
+    validation_dataset = copy.copy(training_loader.dataset)
+    validation_dataset.transform = test_loader.dataset.transform
+    validation_loader = DataLoader(
+        Subset(validation_dataset, permutation[:validation_size]), shuffle=False, num_workers=test_loader.num_workers, batch_size=test_loader.batch_size)
+    training_loader = DataLoader(
+        Subset(training_loader.dataset, permutation[validation_size:]), shuffle=True, num_workers=training_loader.num_workers, batch_size=training_loader.batch_size)
+    return training_loader, validation_loader
+
+
+def wilson_interval(correct, total, z=2.576):
+    """ return the Wilson score interval of an accuracy of correct out of total samples, z=2.576 gives 99% """
+    accuracy = correct / total
+    center = (accuracy + z * z / (2 * total)) / (1 + z * z / total)
+    half_width = z / (1 + z * z / total) * math.sqrt(accuracy * (1 - accuracy) / total + z * z / (4 * total * total))
+    return center - half_width, center + half_width
+
+
+def get_targets(dataset):
+    """ return the LongTensor of the labels of dataset, read from its targets where it has them """
+    if isinstance(dataset, Subset):
+        return get_targets(dataset.dataset)[dataset.indices]
+    if hasattr(dataset, 'targets'):
+        return torch.as_tensor(dataset.targets)
+    return torch.as_tensor([label for _, label in dataset])
+
+
+def get_stratified_subset_dataloader(training_loader, subset_size, seed=0):
+    """ return a loader over a fixed random subset of subset_size samples of the training set of training_loader
+    Every class keeps its share of the samples, so the subset has the class balance of the full set.
+    """
+    targets = get_targets(training_loader.dataset)
+    generator = torch.Generator().manual_seed(seed)
+    indices = []
+    for label in torch.unique(targets):
+        class_indices = torch.nonzero(targets == label).flatten()
+        class_size = round(subset_size * len(class_indices) / len(targets))
+        indices.extend(class_indices[torch.randperm(len(class_indices), generator=generator)[:class_size]].tolist())
+    return DataLoader(
+        Subset(training_loader.dataset, sorted(indices)), shuffle=True, num_workers=training_loader.num_workers, batch_size=training_loader.batch_size)
+
+
+def rank_correlation(x, y):
+    """ return the Spearman rank correlation of the sequences x and y, tied values share their mean rank """
+    def rank(values):
+        values = np.asarray(values, dtype=float)
+        ranks = np.empty(len(values))
+        ranks[np.argsort(values, kind='stable')] = np.arange(len(values))
+        for value in np.unique(values):
+            ranks[values == value] = ranks[values == value].mean()
+        return ranks
+    rank_x, rank_y = rank(x), rank(y)
+    if np.std(rank_x) == 0 or np.std(rank_y) == 0:
+        # the correlation is undefined when all values of one side are tied
+        return float('nan')
+    return float(np.corrcoef(rank_x, rank_y)[0, 1])
+
+
+@torch.no_grad()
+def recalibrate_batchnorm(model, data_loader, sample_num, device='cpu'):
+    """ re-estimate the running stats of every BatchNorm of model on the first sample_num samples of data_loader
+    Pruning slices the running mean and variance of the parent, which do not match the activations of the
+    pruned network anymore. They are reset and replaced by the cumulative average over forward passes in
+    which only the BatchNorm layers are in train mode, so that dropout stays off. model is left in eval mode.
+    """
+    batchnorms = [module for module in model.modules() if isinstance(module, torch.nn.BatchNorm2d) and module.track_running_stats]
+    model.eval()
+    if len(batchnorms) == 0:
+        return
+    momenta = [batchnorm.momentum for batchnorm in batchnorms]
+    for batchnorm in batchnorms:
+        batchnorm.reset_running_stats()
+        batchnorm.momentum = None
+        batchnorm.train()
+    seen_num = 0
+    for inputs, _ in data_loader:
+        model(inputs.to(device))
+        seen_num += len(inputs)
+        if seen_num >= sample_num:
+            break
+    for batchnorm, momentum in zip(batchnorms, momenta):
+        batchnorm.momentum = momentum
+        batchnorm.eval()
+
+
+def get_rng_state():
+    """ return the states of the torch, CUDA and numpy random number generators, see set_rng_state """
+    return {'torch': torch.get_rng_state(), 'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None, 'numpy': np.random.get_state()}
+
+
+def set_rng_state(state):
+    """ restore the random number generators to a state returned by get_rng_state, e.g. when a run is resumed """
+    torch.set_rng_state(state['torch'].cpu())
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([cuda_state.cpu() for cuda_state in state['cuda']])
+    np.random.set_state(state['numpy'])
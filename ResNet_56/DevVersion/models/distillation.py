@@ -0,0 +1,107 @@
+import copy
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+
+
+class Teacher:
+    """ the parent of a generation, distilled into its candidates while they recover from pruning
+    The loss of a candidate is (1 - alpha) * cross entropy + alpha * T^2 * KL(teacher || candidate) of the
+    logits softened by the temperature T, plus feature_weight times the mean squared error between the output
+    of every pruned layer and the channels it kept of the same layer of the teacher. The teacher logits of
+    a batch are cached under a key of the caller, so candidates trained on the same batches share one teacher
+    forward pass. A fingerprint of the inputs is kept with them to recompute the logits if another batch
+    comes under the same key. Feature matching needs the hidden outputs of the teacher, which are not cached.
+    Args:
+        model: the parent model, a frozen copy in eval mode is kept
+        temperature: softens the logits of the teacher and the candidate
+        alpha: weight of the distillation term against the cross entropy with the labels
+        feature_weight: weight of the feature matching, 0 distills the logits only
+        enabled: if False, the loss is the plain cross entropy and the teacher is never run
+    """
+    def __init__(self, model, temperature=4.0, alpha=0.9, feature_weight=0.0, enabled=True):
+        self.enabled = enabled
+        self.temperature = temperature
+        self.alpha = alpha
+        self.feature_weight = feature_weight
+        self.model = None
+        self.seed = None
+        if enabled:
+            self.model = copy.deepcopy(model).eval()
+            for parameter in self.model.parameters():
+                parameter.requires_grad_(False)
+            # seeds the data order of every epoch, so that all candidates meet the same batches
+            self.seed = torch.randint(2 ** 31, (1, )).item()
+        self.cache = {}
+        self.kept_channels = {}
+        self.student_features = {}
+        self.teacher_features = {}
+
+    def __getstate__(self):
+        # the cached logits stay in the process that computed them, e.g. when the teacher is sent to a worker process
+        state = dict(self.__dict__)
+        state['cache'] = {}
+        return state
+
+    @contextmanager
+    def distilling(self, student, kept_channels):
+        """ inside the with block, record the outputs of the pruned layers of student and the teacher to match them
+        kept_channels: dict mapping the name of every pruned layer to the LongTensor of the teacher channels it kept
+        """
+        if not self.enabled or self.feature_weight == 0:
+            yield
+            return
+        handles = []
+        for module_name in kept_channels:
+            handles.append(student.get_submodule(module_name).register_forward_hook(self.record(self.student_features, module_name)))
+            handles.append(self.model.get_submodule(module_name).register_forward_hook(self.record(self.teacher_features, module_name)))
+        self.kept_channels = kept_channels
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+            self.kept_channels = {}
+            self.student_features.clear()
+            self.teacher_features.clear()
+
+    @staticmethod
+    def record(features, module_name):
+        def hook(module, inputs, output):
+            features[module_name] = output
+        return hook
+
+    def logits(self, inputs, key=None):
+        """ return the logits of the teacher for inputs, None if distillation is disabled
+        key: hashable id of the batch, the logits are cached under it unless features have to be matched
+        """
+        if not self.enabled:
+            return None
+        if len(self.kept_channels) > 0:
+            # the hidden outputs of the teacher are needed as well
+            key = None
+        fingerprint = inputs.detach().flatten(1).sum(1).cpu()
+        if key in self.cache:
+            cached_fingerprint, logits = self.cache[key]
+            if torch.allclose(cached_fingerprint, fingerprint):
+                return logits.to(inputs.device).float()
+        with torch.no_grad():
+            logits = self.model(inputs)
+        if key is not None:
+            # half precision on the cpu, the logits of all epochs are kept until the generation ends
+            self.cache[key] = (fingerprint, logits.to('cpu', torch.float16))
+        return logits
+
+    def loss(self, outputs, labels, teacher_logits=None):
+        """ return the training loss of the candidate outputs, teacher_logits comes from logits() on the same inputs """
+        hard_loss = F.cross_entropy(outputs, labels)
+        if teacher_logits is None:
+            return hard_loss
+        soft_loss = F.kl_div(F.log_softmax(outputs / self.temperature, dim=1), F.softmax(teacher_logits / self.temperature, dim=1), reduction='batchmean')
+        loss = (1 - self.alpha) * hard_loss + self.alpha * self.temperature ** 2 * soft_loss
+        if len(self.kept_channels) > 0:
+            feature_loss = sum(F.mse_loss(self.student_features[module_name], self.teacher_features[module_name].index_select(1, kept))
+                               for module_name, kept in self.kept_channels.items())
+            loss = loss + self.feature_weight * feature_loss / len(self.kept_channels)
+        return loss
@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 
+from models.pruning import add_to_plan, prune_channels, ImportanceCache, align_plan
+
 class BottleNeck(nn.Module):
     """Residual block for resnet over 50 layers
 
@@ -30,104 +32,19 @@ class BottleNeck(nn.Module):
     def forward(self, x):
         return nn.ReLU(inplace=True)(self.residual_function(x) + self.shortcut(x))
     
-    def prune_mediate_kernel(self):
+    # choose which mediate conv layer of self.residual_function to prune, its output kernels only affect layers inside the block
+    def choose_mediate_kernel(self):
         layer_choices = torch.tensor([0, 3])
         target_layer = torch.randint(0, len(layer_choices), (1,)).item()
-        target_layer = layer_choices[target_layer]
-        # only need to prune self.residual_function
-        new_conv1_kernel_num = self.residual_function[target_layer].out_channels - 1
-        if new_conv1_kernel_num == 0:
-            return 
-        if target_layer == 3:
-            new_conv1 = nn.Conv2d(self.residual_function[target_layer].in_channels, new_conv1_kernel_num, stride=self.residual_function[target_layer].stride, kernel_size=self.residual_function[target_layer].kernel_size, padding=1, bias=False)
-        else:
-            new_conv1 = nn.Conv2d(self.residual_function[target_layer].in_channels, new_conv1_kernel_num, kernel_size=self.residual_function[target_layer].kernel_size, bias=False)
-        weight_variances = torch.var(self.residual_function[target_layer].weight.data, dim = [1, 2, 3])
-        target_kernel = torch.argmin(weight_variances).item()
-        with torch.no_grad():
-            new_conv1.weight.data = torch.cat([self.residual_function[target_layer].weight.data[:target_kernel], self.residual_function[target_layer].weight.data[target_kernel+1:]], dim=0)
-        self.residual_function[target_layer] = new_conv1
-
-        new_bn1 = nn.BatchNorm2d(new_conv1_kernel_num)
-        with torch.no_grad():
-            kept_indices = [i for i in range(self.residual_function[target_layer + 1].num_features) if i != target_kernel]
-            new_bn1.weight.data = self.residual_function[target_layer + 1].weight.data[kept_indices]
-            new_bn1.bias.data = self.residual_function[target_layer + 1].bias.data[kept_indices]
-            new_bn1.running_mean = self.residual_function[target_layer + 1].running_mean[kept_indices]
-            new_bn1.running_var = self.residual_function[target_layer + 1].running_var[kept_indices]
-        self.residual_function[target_layer + 1] = new_bn1
-
-        # we also need to decrement next conv layer's input inside blocks
-        if target_layer + 3 == 3:
-            new_conv2 = nn.Conv2d(self.residual_function[target_layer + 3].in_channels - 1, self.residual_function[target_layer + 3].out_channels, stride=self.residual_function[target_layer + 3].stride, kernel_size=self.residual_function[target_layer + 3].kernel_size, padding=1, bias=False)
-        else:
-            new_conv2 = nn.Conv2d(self.residual_function[target_layer + 3].in_channels - 1, self.residual_function[target_layer + 3].out_channels, kernel_size=self.residual_function[target_layer + 3].kernel_size, bias=False)
-        with torch.no_grad():
-            kept_indices = [i for i in range(self.residual_function[target_layer + 3].in_channels) if i != target_kernel]
-            new_conv2.weight.data = self.residual_function[target_layer + 3].weight.data[:, kept_indices, :, :]
-        self.residual_function[target_layer + 3] = new_conv2
-        
-        return 
-    
-    def prune_output_kernel(self):
-        # need to prune self.residual_function and self.shortcut at the same time
-        target_layer = 6
-        new_conv1_kernel_num = self.residual_function[target_layer].out_channels - 1
-        if new_conv1_kernel_num == 0:
-            return
-        new_conv1 = nn.Conv2d(self.residual_function[target_layer].in_channels, new_conv1_kernel_num, kernel_size=self.residual_function[target_layer].kernel_size, bias=False)
-        weight_variances = torch.var(self.residual_function[target_layer].weight.data, dim = [1, 2, 3])
-        target_kernel = torch.argmin(weight_variances).item()
-        with torch.no_grad():
-            new_conv1.weight.data = torch.cat([self.residual_function[target_layer].weight.data[:target_kernel], self.residual_function[target_layer].weight.data[target_kernel+1:]], dim=0)
-        self.residual_function[target_layer] = new_conv1
-
-        new_bn1 = nn.BatchNorm2d(new_conv1_kernel_num)
-        with torch.no_grad():
-            kept_indices = [i for i in range(self.residual_function[target_layer + 1].num_features) if i != target_kernel]
-            new_bn1.weight.data = self.residual_function[target_layer + 1].weight.data[kept_indices]
-            new_bn1.bias.data = self.residual_function[target_layer + 1].bias.data[kept_indices]
-            new_bn1.running_mean = self.residual_function[target_layer + 1].running_mean[kept_indices]
-            new_bn1.running_var = self.residual_function[target_layer + 1].running_var[kept_indices]
-        self.residual_function[target_layer + 1] = new_bn1
-
-        if len(list(self.shortcut.children())) != 0:
-            # use the same target kernel as self.residual_function
-            new_conv2 = nn.Conv2d(self.shortcut[0].in_channels, new_conv1_kernel_num, stride=self.shortcut[0].stride, kernel_size=self.shortcut[0].kernel_size, bias=False)
-            with torch.no_grad():
-                new_conv2.weight.data = torch.cat([self.shortcut[0].weight.data[:target_kernel], self.shortcut[0].weight.data[target_kernel+1:]], dim=0)
-            self.shortcut[0] = new_conv2
-            new_bn2 = nn.BatchNorm2d(new_conv1_kernel_num)
-            with torch.no_grad():
-                kept_indices = [i for i in range(self.shortcut[1].num_features) if i != target_kernel]
-                new_bn2.weight.data = self.shortcut[1].weight.data[kept_indices]
-                new_bn2.bias.data = self.shortcut[1].bias.data[kept_indices]
-                new_bn2.running_mean = self.shortcut[1].running_mean[kept_indices]
-                new_bn2.running_var = self.shortcut[1].running_var[kept_indices]
-            self.shortcut[1] = new_bn2
-        # call decre_input in ResNet to prune next layer's input
-        return target_kernel
-    
-    def decre_input(self, target_kernel):
-        new_conv1 = nn.Conv2d(self.residual_function[0].in_channels - 1, self.residual_function[0].out_channels, kernel_size=self.residual_function[0].kernel_size, bias=False)
-        with torch.no_grad():
-            kept_indices = [i for i in range(self.residual_function[0].in_channels) if i != target_kernel]
-            new_conv1.weight.data = self.residual_function[0].weight.data[:, kept_indices, :, :]
-        self.residual_function[0] = new_conv1
-
-        # if self.shortcut is empty, directly return
-        if len(list(self.shortcut.children())) == 0:
-            return
-        new_conv2 = nn.Conv2d(self.shortcut[0].in_channels - 1, self.shortcut[0].out_channels, stride=self.shortcut[0].stride, kernel_size=self.shortcut[0].kernel_size, bias=False)
-        with torch.no_grad():
-            kept_indices = [i for i in range(self.shortcut[0].in_channels) if i != target_kernel]
-            new_conv2.weight.data = self.shortcut[0].weight.data[:, kept_indices, :, :]
-        self.shortcut[0] = new_conv2
+        return 'residual_function.' + str(layer_choices[target_layer].item())
 
 class ResNet(nn.Module):
+    input_size = (3, 32, 32)
 
     def __init__(self, num_class=100):
         super().__init__()
+        # kept for ArchitectureSpec to rebuild the model
+        self.num_class = num_class
 
         self.in_channels = 16
 
@@ -168,56 +85,59 @@ class ResNet(nn.Module):
 
         return output
 
-    def update_architecture(self, modification_num):
+    def update_architecture(self, modification_num, bulk=False, importance=None, criterion='variance', optimizer=None, align=1, plan=None):
         update_times = int(modification_num + 1)
+        # channel scores of the parent, shared by all candidates of a generation
+        importance = ImportanceCache(self, criterion) if importance is None else importance.copy()
+        if plan is not None:
+            # drawn beforehand, e.g. picked among many plans by the surrogate
+            prune_channels(self, plan, importance, optimizer)
+            return importance
+        if bulk or align > 1:
+            # draw the whole pruning plan first, then rebuild every affected layer only once
+            # widths are aligned over the whole plan, single channel steps would all round to a multiple
+            prune_channels(self, align_plan(self, self.draw_pruning_plan(update_times), align), importance, optimizer)
+            return importance
         decre_num = 0
         for update_id in range(update_times):
             if decre_num > 0:
                 decre_num -= 1
                 continue
-            if torch.rand(1).item() < 0.00:
-                self.prune_kernel()
-            else:
-                if torch.rand(1).item() <= 0.99:
-                    self.prune_mediate_blocks()
-                else:
-                    decre_num = self.prune_output_blocks()
-
-    def prune_kernel(self):
-        target_branch = self.conv1
-        target_layer = 0
-        
-        # prune target branch
-        new_conv1_kernel_num = target_branch[target_layer].out_channels - 1
-        if new_conv1_kernel_num == 0:
-            return
-        new_conv1 = nn.Conv2d(target_branch[target_layer].in_channels, new_conv1_kernel_num, kernel_size=target_branch[target_layer].kernel_size, padding=1, bias=False)
-        weight_variances = torch.var(target_branch[target_layer].weight.data, dim = [1, 2, 3])
-        target_kernel = torch.argmin(weight_variances).item()
-        with torch.no_grad():
-            new_conv1.weight.data = torch.cat([target_branch[target_layer].weight.data[:target_kernel], target_branch[target_layer].weight.data[target_kernel+1:]], dim=0)
-        target_branch[target_layer] = new_conv1
+            plan = {}
+            decre_num = self.draw_update(plan)
+            prune_channels(self, plan, importance, optimizer)
+        # the cache knows which channels of the parent the pruned model kept
+        return importance
+
+    # draw the random choices of update_architecture, and count how many channels each layer loses
+    def draw_pruning_plan(self, update_times):
+        plan = {}
+        decre_num = 0
+        for update_id in range(update_times):
+            if decre_num > 0:
+                decre_num -= 1
+                continue
+            decre_num = self.draw_update(plan)
+        return plan
 
-        new_bn1 = nn.BatchNorm2d(new_conv1_kernel_num)
-        with torch.no_grad():
-            kept_indices = [i for i in range(target_branch[target_layer + 1].num_features) if i != target_kernel]
-            new_bn1.weight.data = target_branch[target_layer + 1].weight.data[kept_indices]
-            new_bn1.bias.data = target_branch[target_layer + 1].bias.data[kept_indices]
-            new_bn1.running_mean = target_branch[target_layer + 1].running_mean[kept_indices]
-            new_bn1.running_var = target_branch[target_layer + 1].running_var[kept_indices]
-        target_branch[target_layer + 1] = new_bn1
+    # draw one modification into plan, return how many following modifications it replaces
+    def draw_update(self, plan):
+        if torch.rand(1).item() < 0.00:
+            self.prune_kernel(plan)
+        else:
+            if torch.rand(1).item() <= 0.99:
+                self.prune_mediate_blocks(plan)
+            else:
+                return self.prune_output_blocks(plan)
+        return 0
 
-        # we also need to modify first layer's input in conv2_x
-        self.conv2_x[0].decre_input(target_kernel)
+    # add one kernel of the first conv layer to plan, the least important kernel is chosen by prune_channels
+    def prune_kernel(self, plan):
+        add_to_plan(self, plan, 'conv1.0')
 
-    def prune_mediate_blocks(self):
+    def prune_mediate_blocks(self, plan):
         target_branch = torch.randint(1, 4, (1,)).item()
-        if target_branch == 1:
-            target_branch = self.conv2_x
-        elif target_branch == 2:
-            target_branch = self.conv3_x
-        else:
-            target_branch = self.conv4_x
+        target_branch = 'conv%d_x' %(target_branch + 1)
         if torch.rand(1).item() < 0.02:
             # low probabilit to prune sensitive layer
             block_choices =  torch.tensor([1, 8])
@@ -225,45 +145,18 @@ class ResNet(nn.Module):
             block_choices =  torch.tensor([2, 3, 4, 5, 6, 7])
         target_block = torch.randint(0, len(block_choices), (1,)).item()
         target_block = block_choices[target_block].item()
-        target_block = target_branch[target_block]
-        target_block.prune_mediate_kernel()
+        target_layer = getattr(self, target_branch)[target_block].choose_mediate_kernel()
+        add_to_plan(self, plan, '%s.%d.%s' %(target_branch, target_block, target_layer))
     
-    def prune_output_blocks(self):
+    def prune_output_blocks(self, plan):
         # we must prune all output conv2d layer at the same time
         target_branch = torch.randint(1, 28, (1,)).item()
         if target_branch <= 9:
-            target_branch = self.conv2_x
-            next_branch = self.conv3_x
+            target_branch = 'conv2_x'
         elif target_branch <= 18:
-            target_branch = self.conv3_x
-            next_branch = self.conv4_x
-        else:
-            target_branch = self.conv4_x
-            next_branch = None
-        
-        for block_index in range(len(list(target_branch.children()))):
-            target_block = target_branch[block_index]
-            target_kernel = target_block.prune_output_kernel()
-            next_block_idx = block_index + 1
-            if next_block_idx == len(list(target_branch.children())):
-                break
-            next_block = target_branch[next_block_idx]
-            next_block.decre_input(target_kernel)
-        
-        if next_branch != None:
-            next_block = next_branch[0]
-            next_block.decre_input(target_kernel)
+            target_branch = 'conv3_x'
         else:
-            # decre FC input
-            new_fc1_intput_features = self.fc.in_features - 1
-            # update fc1
-            new_fc1 = nn.Linear(new_fc1_intput_features, self.fc.out_features)
-            output_length = 1 # gained by printing "output"
-            # prune the neuron with least variance weights
-            with torch.no_grad():
-                start_index = target_kernel * output_length ** 2
-                end_index = start_index + output_length ** 2
-                new_fc1.weight.data = torch.cat([self.fc.weight.data[:, :start_index], self.fc.weight.data[:, end_index:]], dim=1)
-                new_fc1.bias.data = self.fc.bias.data
-            self.fc = new_fc1
-        return len(list(target_branch.children()))
+            target_branch = 'conv4_x'
+        # the residual adds tie the output kernels of every block in the branch into one channel group
+        add_to_plan(self, plan, target_branch + '.0.residual_function.6')
+        return len(list(getattr(self, target_branch).children()))
@@ -0,0 +1,86 @@
+import hashlib
+import inspect
+import json
+from collections import namedtuple
+
+import torch.nn as nn
+
+from models.pruning import get_width, get_input_width, set_submodule
+from models.profiler import get_removed_widths
+
+
+# the activation functions change_activation_function may swap in
+activation_types = (nn.ReLU, nn.LeakyReLU, nn.ELU, nn.Tanh, nn.Sigmoid)
+
+
+def get_arguments(module):
+    """ return the (name, value) of every constructor argument of module that it keeps as an attribute of the same name """
+    return tuple((name, getattr(module, name)) for name in inspect.signature(type(module).__init__).parameters if name != 'self' and hasattr(module, name))
+
+
+class ArchitectureSpec(namedtuple('ArchitectureSpec', ['model_class', 'arguments', 'layers', 'activations'])):
+    """ hashable description of everything the search changes in a model, which identifies its architecture
+    Two models with equal specs have the same layer shapes, so the same FLOPs, parameter number, latency and memory,
+    whatever their weights. get_spec extracts it from any of the models, build makes a fresh model from it.
+    Args:
+        model_class: the name of the model's class, e.g. 'VGG'
+        arguments: tuple of (name, value) of the constructor arguments of the model, e.g. num_class, see get_arguments
+        layers: tuple of (module_name, input width, output width) of every Conv2d, BatchNorm2d and Linear,
+            in the order of model.named_modules(), a BatchNorm2d has equal widths
+        activations: tuple of (module_name, class name, arguments) of every activation module, the arguments such as
+            inplace are kept so that the rebuilt model frees its activations like the original one
+    """
+    __slots__ = ()
+
+    def digest(self):
+        """ return the sha1 hex digest of the spec, stable across runs unlike hash() """
+        return hashlib.sha1(self.to_json().encode()).hexdigest()
+
+    def to_json(self):
+        return json.dumps(self)
+
+    @classmethod
+    def from_json(cls, text):
+        model_class, arguments, layers, activations = json.loads(text)
+        return cls(model_class, tuple(map(tuple, arguments)), tuple(map(tuple, layers)),
+                   tuple((module_name, activation, tuple(map(tuple, activation_arguments))) for module_name, activation, activation_arguments in activations))
+
+    def build(self, model_class):
+        """ return a freshly initialized model_class with the layer widths and activations of the spec """
+        if model_class.__name__ != self.model_class:
+            raise ValueError('the spec describes a %s, not a %s' %(self.model_class, model_class.__name__))
+        model = model_class(**dict(self.arguments))
+        for module_name, in_width, out_width in self.layers:
+            module = model.get_submodule(module_name)
+            if isinstance(module, nn.Conv2d) and (module.in_channels, module.out_channels) != (in_width, out_width):
+                set_submodule(model, module_name, nn.Conv2d(in_width, out_width, kernel_size=module.kernel_size, stride=module.stride, padding=module.padding,
+                                                            dilation=module.dilation, bias=module.bias is not None, padding_mode=module.padding_mode))
+            elif isinstance(module, nn.BatchNorm2d) and module.num_features != out_width:
+                set_submodule(model, module_name, nn.BatchNorm2d(out_width, eps=module.eps, momentum=module.momentum, affine=module.affine,
+                                                                 track_running_stats=module.track_running_stats))
+            elif isinstance(module, nn.Linear) and (module.in_features, module.out_features) != (in_width, out_width):
+                set_submodule(model, module_name, nn.Linear(in_width, out_width, bias=module.bias is not None))
+        for module_name, activation, activation_arguments in self.activations:
+            module = model.get_submodule(module_name)
+            if type(module).__name__ != activation or get_arguments(module) != activation_arguments:
+                set_submodule(model, module_name, getattr(nn, activation)(**dict(activation_arguments)))
+        return model
+
+
+def get_spec(model, removals=None):
+    """ return the ArchitectureSpec of model
+    removals: dict mapping a channel group name to the LongTensor of channels to remove, the spec is that of the
+        model once they are pruned, e.g. for a ChannelMask candidate
+    """
+    removed_widths = get_removed_widths(model, removals)
+    layers = []
+    activations = []
+    for module_name, module in model.named_modules():
+        if isinstance(module, (nn.Conv2d, nn.Linear)):
+            layers.append((module_name, get_input_width(module) - removed_widths.get((module_name, 1), 0), get_width(module) - removed_widths.get((module_name, 0), 0)))
+        elif isinstance(module, nn.BatchNorm2d):
+            width = module.num_features - removed_widths.get((module_name, 0), 0)
+            layers.append((module_name, width, width))
+        elif isinstance(module, activation_types):
+            activations.append((module_name, type(module).__name__, get_arguments(module)))
+    return ArchitectureSpec(type(model).__name__, get_arguments(model), tuple(layers), tuple(activations))
@@ -9,35 +9,45 @@ import torch.nn as nn
 import torch.optim as optim
 
 from conf import settings
-from utils import get_CIFAR10_training_dataloader, get_CIFAR10_test_dataloader, get_CIFAR100_training_dataloader, get_CIFAR100_test_dataloader, WarmUpLR
+from utils import get_CIFAR10_training_dataloader, get_CIFAR10_test_dataloader, get_CIFAR100_training_dataloader, get_CIFAR100_test_dataloader, WarmUpLR, extrapolate_accuracy, wilson_interval, split_validation_dataloader, get_stratified_subset_dataloader, rank_correlation, recalibrate_batchnorm, get_rng_state, set_rng_state
 
 import copy
 import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from models.resnet import ResNet
-from thop import profile
+from models.pruning import select_channels, ChannelMask, ImportanceCache, ChannelStatistics, statistics_criteria, load_optimizer_state, align_plan
+from models.profiler import count_ops, estimate_memory, LatencyTable
+from models.distillation import Teacher
+from models.surrogate import AccuracySurrogate, get_widths, get_planned_widths
+from models.proxies import proxies
+from models.archive import ArchitectureArchive, hash_model, get_signature, hash_config, get_model_key
+from models.spec import get_spec
 
 def train(epoch):
 
     start = time.time()
     net.train()
-    for batch_index, (images, labels) in enumerate(cifar10_training_loader):
-        labels = labels.to(device)
-        images = images.to(device)
-        optimizer.zero_grad()
-        outputs = net(images)
-        loss = loss_function(outputs, labels)
-        loss.backward()
-        optimizer.step()
+    with channel_statistics.recording(net):
+        for batch_index, (images, labels) in enumerate(cifar10_training_loader):
+            labels = labels.to(device)
+            images = images.to(device)
+            optimizer.zero_grad()
+            outputs = net(images)
+            loss = loss_function(outputs, labels)
+            loss.backward()
+            optimizer.step()
 
-        if epoch <= warm:
-            warmup_scheduler.step()
+            if epoch <= warm:
+                warmup_scheduler.step()
 
     finish = time.time()
 
     print('epoch {} training time consumed: {:.2f}s'.format(epoch, finish - start))
 
 @torch.no_grad()
-def eval_training(epoch=0, tb=True):
+def eval_training(epoch=0, tb=True, full=True):
+    """ evaluate net on the validation set, full=False stops once the top1 accuracy is known within VALIDATION_MARGIN """
 
     start = time.time()
     net.eval()
@@ -45,8 +55,9 @@ def eval_training(epoch=0, tb=True):
     test_loss = 0.0 # cost function error
     correct_1 = 0.0
     correct_5 = 0.0
+    sample_num = 0
 
-    for (images, labels) in cifar10_test_loader:
+    for (images, labels) in validation_loader:
 
         images = images.to(device)
         labels = labels.to(device)
@@ -61,22 +72,367 @@ def eval_training(epoch=0, tb=True):
         #compute top 5
         top5_correct = labels.view(-1, 1).expand_as(preds) == preds
         correct_5 += top5_correct.any(dim=1).sum().item()
+        sample_num += len(labels)
+        if not full:
+            lower_bound, upper_bound = wilson_interval(correct_1, sample_num, settings.VALIDATION_CONFIDENCE)
+            if upper_bound - lower_bound <= 2 * settings.VALIDATION_MARGIN:
+                break
 
     finish = time.time()
     print('Evaluating Network.....')
-    print('Test set: Epoch: {}, Average loss: {:.4f}, Top1 Accuracy: {:.4f}, Top5 Accuracy: {:.4f}, Time consumed:{:.2f}s'.format(
+    print('Validation set: Epoch: {}, Average loss: {:.4f}, Top1 Accuracy: {:.4f}, Top5 Accuracy: {:.4f}, Time consumed:{:.2f}s'.format(
         epoch,
-        test_loss / len(cifar10_test_loader.dataset),
-        correct_1 / len(cifar10_test_loader.dataset),
-        correct_5 / len(cifar10_test_loader.dataset),
+        test_loss / sample_num,
+        correct_1 / sample_num,
+        correct_5 / sample_num,
         finish - start
     ))
 
-    return correct_1 / len(cifar10_test_loader.dataset), correct_5 / len(cifar10_test_loader.dataset)
+    return correct_1 / sample_num, correct_5 / sample_num
+
+
+@torch.no_grad()
+def evaluate_model(dev_model, bar=None):
+    """ evaluate dev_model on the validation set
+    bar: top1 accuracy the model has to reach, the evaluation stops as soon as the upper bound of the Wilson
+        interval of the samples seen so far falls below it
+    Returns: (top1 accuracy, top5 accuracy, rejected), rejected tells the evaluation stopped below bar, the accuracies
+        are then those of the samples seen so far, a pessimistic estimate that is only good to rank the model last
+    """
+    # initialize the testing parameters
+    correct_1 = 0.0
+    correct_5 = 0.0
+    sample_num = 0
+    # begin testing
+    dev_model.eval()
+    for test_x, test_label in validation_loader:
+        # move test data to device
+        test_x = test_x.to(device)
+        test_label = test_label.to(device)
+        # get predict y and predict its class
+        outputs = dev_model(test_x)
+        _, preds = outputs.topk(5, 1, largest=True, sorted=True)
+        #compute top1
+        correct_1 += (preds[:, :1] == test_label.unsqueeze(1)).sum().item()
+        #compute top 5
+        top5_correct = test_label.view(-1, 1).expand_as(preds) == preds
+        correct_5 += top5_correct.any(dim=1).sum().item()
+        sample_num += len(test_label)
+        if bar is not None and wilson_interval(correct_1, sample_num, settings.VALIDATION_CONFIDENCE)[1] < bar:
+            return correct_1 / sample_num, correct_5 / sample_num, True
+    # calculate the accuracy
+    top1_accuracy = correct_1 / sample_num
+    top5_accuracy = correct_5 / sample_num
+    return top1_accuracy, top5_accuracy, False
+
+
+def get_rejection_bar(top1_accuracies):
+    """ return the top1 accuracy a candidate needs to compete with architectures of the given final accuracies
+    Once one is above accuracy_threshold, compute_score gives 0 to all below accuracy_threshold - 0.005,
+    before that the top1 accuracy decides the score.
+    """
+    if max(top1_accuracies) > accuracy_threshold:
+        return accuracy_threshold - 0.005
+    return max(top1_accuracies)
+
+
+# which epochs of a candidate's training are evaluated besides its last one, chosen by settings.EVALUATION_POLICY
+evaluation_policies = {
+    'final': lambda dev_id, dev_num: False,
+    'interval': lambda dev_id, dev_num: dev_id % settings.EVALUATION_INTERVAL == 0,
+    # discard the first half data as model need retraining
+    'half': lambda dev_id, dev_num: (dev_id + 1) % dev_num >= math.ceil(dev_num / 2),
+}
+
+def needs_evaluation(dev_id, last_epoch, dev_num):
+    """ return whether a candidate is evaluated after epoch dev_id of a training that stops at last_epoch
+    compute_score only reads the last accuracy, so the last epoch of every training is always evaluated,
+    also when it stops before dev_num to be ranked, and EVALUATION_POLICY may add more epochs for the logs
+    """
+    return dev_id == last_epoch or evaluation_policies[settings.EVALUATION_POLICY](dev_id, dev_num)
+
+
+def estimate_latency(model, removals=None):
+    # layers are only timed when compute_score uses the latency
+    if settings.LATENCY_WEIGHT == 0:
+        return 0.0
+    return latency_table.estimate(model, removals)
+
+
+# FLOPs and parameter number of every ArchitectureSpec counted so far
+spec_ops_cache = {}
+
+def count_candidate_ops(model, removals=None):
+    """ return the FLOPs and parameter number of model pruned by removals, memoized on its ArchitectureSpec and read
+    from the archive if it holds an architecture of the same widths, the costs do not depend on the weights
+    """
+    spec = get_spec(model, removals)
+    if spec not in spec_ops_cache:
+        row = None
+        if archive is not None:
+            widths = get_widths(model) if removals is None else get_planned_widths(model, {group: len(channels) for group, channels in removals.items()})
+            row = archive.lookup_widths(widths, get_model_key(model))
+        spec_ops_cache[spec] = (row['FLOPs'], row['parameter_num']) if row is not None else count_ops(model, profile_batch_size, removals)
+    return spec_ops_cache[spec]
+
+
+def get_training_config():
+    """ return the settings the accuracies of a fine-tuned candidate depend on, archived results are only reused under the same ones """
+    return {'dev_num': dev_num, 'lr': lr, 'gamma': gamma, 'warm': warm, 'milestones': settings.DYNAMIC_MILESTONES, 'batch_size': candidate_training_loader.batch_size,
+            'virtual_candidates': settings.VIRTUAL_CANDIDATES, 'keep_optimizer_state': settings.KEEP_OPTIMIZER_STATE, 'proxy_subset_size': settings.PROXY_SUBSET_SIZE,
+            'bn_recalibration_size': settings.BN_RECALIBRATION_SIZE, 'validation_size': settings.VALIDATION_SIZE, 'distillation': settings.DISTILLATION,
+            'distillation_temperature': settings.DISTILLATION_TEMPERATURE, 'distillation_alpha': settings.DISTILLATION_ALPHA,
+            'feature_distillation_weight': settings.FEATURE_DISTILLATION_WEIGHT}
+
+
+def is_reusable(row):
+    """ return whether the archived results row stand for a training of all dev_num epochs under the settings of this run """
+    return row is not None and row['epochs'] == dev_num and not row['rejected'] and row['config_hash'] == config_hash
+
+
+def prepare_candidate(original_model, importance, plan=None):
+    """ return a pruned copy of the parent, its optimizer and the channels of the parent it kept, ready to be trained
+    plan: the pruning plan to apply, drawn by update_architecture if None
+    """
+    dev_model = copy.deepcopy(original_model)
+    dev_optimizer = optim.SGD(dev_model.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4)
+    if settings.KEEP_OPTIMIZER_STATE:
+        # start from the momentum of the parent, it is pruned along with the channels
+        load_optimizer_state(dev_optimizer, optimizer.state_dict())
+    dev_importance = ResNet.update_architecture(dev_model, modification_num, bulk=settings.BULK_PRUNING, importance=importance, optimizer=dev_optimizer, align=settings.CHANNEL_ALIGNMENT, plan=plan)
+    dev_model = dev_model.to(device)
+    print(dev_model)
+    if settings.BN_RECALIBRATION_SIZE > 0:
+        # the sliced BatchNorm stats of the parent do not fit the pruned network
+        recalibrate_batchnorm(dev_model, candidate_training_loader, settings.BN_RECALIBRATION_SIZE, device)
+    return dev_model, dev_optimizer, dev_importance.kept_channels(original_model)
+
+
+def train_candidate(dev_model, dev_optimizer, dev_statistics, kept_channels, first_epoch, last_epoch, bar=None):
+    """ train a candidate from epoch first_epoch to last_epoch, return the accuracies evaluated in between and
+    whether the evaluation of the last epoch was cut short
+    The learning rate follows DYNAMIC_MILESTONES as if the candidate had been trained from the first
+    epoch, so its training can be split into several calls. The warm up has to end in the first call.
+    bar: top1 accuracy below which the evaluation of the last epoch is cut short, see evaluate_model
+    """
+    dev_lr = lr * gamma ** len([milestone for milestone in settings.DYNAMIC_MILESTONES if milestone < first_epoch])
+    for param_group in dev_optimizer.param_groups:
+        param_group['lr'] = dev_lr
+    if first_epoch <= warm:
+        dev_warmup_scheduler = WarmUpLR(dev_optimizer, len(candidate_training_loader) * warm)
+    dev_top1_accuracies = []
+    dev_top5_accuracies = []
+    rejected = False
+    # train the architecture from first_epoch to last_epoch
+    for dev_id in range(first_epoch, last_epoch + 1):
+        if dev_id in settings.DYNAMIC_MILESTONES:
+            dev_lr *= gamma
+            for param_group in dev_optimizer.param_groups:
+                param_group['lr'] = dev_lr
+        # begin training
+        dev_model.train()               # set model into training
+        # with distillation all candidates meet the same batches in this epoch and share the cached teacher logits, the
+        # seed is set on a fork of the random generators, so the data order of everything trained afterwards is left alone
+        with torch.random.fork_rng(enabled=teacher.enabled), dev_statistics.recording(dev_model), teacher.distilling(dev_model, kept_channels):
+            if teacher.enabled:
+                torch.manual_seed(teacher.seed + dev_id)
+            for batch_index, (train_x, train_label) in enumerate(candidate_training_loader):
+                # move train data to device
+                train_x = train_x.to(device)
+                train_label = train_label.to(device)
+                # clear the gradient data and update parameters based on error
+                dev_optimizer.zero_grad()
+                # get predict y and compute the error
+                predict_y = dev_model(train_x)
+                loss = teacher.loss(predict_y, train_label, teacher.logits(train_x, (id(candidate_training_loader), dev_id, batch_index)))
+                # update visualization
+                loss.backward()
+                dev_optimizer.step()
+
+                if dev_id <= warm:
+                    dev_warmup_scheduler.step()
+
+        # the early stopping extrapolates the learning curve of the first CURVE_EPOCH epochs
+        if needs_evaluation(dev_id, last_epoch, dev_num) or (settings.EARLY_STOPPING and dev_id <= settings.CURVE_EPOCH):
+            top1_accuracy, top5_accuracy, rejected = evaluate_model(dev_model, bar if dev_id == last_epoch else None)
+            dev_top1_accuracies.append(top1_accuracy)
+            dev_top5_accuracies.append(top5_accuracy)
+    return dev_top1_accuracies, dev_top5_accuracies, rejected
+
+
+def init_worker(threads, worker_globals):
+    """ set up a worker process of train_candidates, which is spawned from a fresh interpreter
+    threads: the share of the CPU threads of the worker, set before it runs any operator
+    worker_globals: the module globals train_candidate reads, e.g. the data loaders and the teacher
+    """
+    torch.set_num_threads(threads)
+    globals().update(worker_globals)
+
+
+def train_candidate_in_worker(spec, model_state, optimizer_state_dict, dev_statistics, kept_channels, seed, first_epoch, last_epoch, bar):
+    """ rebuild a candidate from its ArchitectureSpec and state_dicts inside a worker process and train it
+    Only the trained state_dicts, the statistics and the accuracies are sent back.
+    """
+    torch.manual_seed(seed)
+    start = time.time()
+    dev_model = spec.build(ResNet).to(device)
+    dev_model.load_state_dict(model_state)
+    dev_optimizer = optim.SGD(dev_model.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4)
+    dev_optimizer.load_state_dict(optimizer_state_dict)
+    dev_top1_accuracies, dev_top5_accuracies, rejected = train_candidate(dev_model, dev_optimizer, dev_statistics, kept_channels, first_epoch, last_epoch, bar)
+    return dev_model.state_dict(), dev_optimizer.state_dict(), dev_statistics, dev_top1_accuracies, dev_top5_accuracies, time.time() - start, rejected
+
+
+def train_candidates(candidates, first_epoch, last_epoch, known_accuracies=None, finished=None):
+    """ train every (dev_model, dev_optimizer, dev_statistics, kept_channels) of candidates from first_epoch to last_epoch
+    With CANDIDATE_WORKERS above 1, the candidates are trained at the same time by spawned worker processes
+    that split the CPU threads between them, and each is loaded back as soon as it finishes. The workers are
+    spawned rather than forked, forking after the OpenMP / MKL thread pools of the parent ran can deadlock them.
+    known_accuracies: final top1 accuracies the candidates compete with, if given the last evaluation of a
+        candidate is cut short once it surely can not reach them, or those of the candidates trained before it
+    finished: called with the index and the result of every candidate as soon as it is trained, e.g. to checkpoint
+    Returns: (dev_statistics, top1 accuracies, top5 accuracies, training seconds, rejected) of each candidate, rejected
+        tells the last evaluation was cut short, so the last accuracies are no real estimate
+    """
+    start = time.time()
+    workers = min(settings.CANDIDATE_WORKERS, len(candidates))
+    if workers <= 1 or device != 'cpu':
+        results = []
+        for dev_model, dev_optimizer, dev_statistics, kept_channels in candidates:
+            bar = get_rejection_bar(known_accuracies + [result[1][-1] for result in results if not result[4]]) if known_accuracies is not None else None
+            candidate_start = time.time()
+            dev_top1_accuracies, dev_top5_accuracies, rejected = train_candidate(dev_model, dev_optimizer, dev_statistics, kept_channels, first_epoch, last_epoch, bar)
+            results.append((dev_statistics, dev_top1_accuracies, dev_top5_accuracies, time.time() - candidate_start, rejected))
+            if finished is not None:
+                finished(len(results) - 1, results[-1])
+        print('%d candidates trained one after another in %.2fs' %(len(candidates), time.time() - start))
+        return results
+    threads = max(1, torch.get_num_threads() // workers)
+    # everything train_candidate reads besides the candidate, sent once to every worker
+    worker_globals = {'device': device, 'lr': lr, 'gamma': gamma, 'warm': warm, 'dev_num': dev_num, 'teacher': teacher,
+                      'candidate_training_loader': candidate_training_loader, 'validation_loader': validation_loader}
+    bar = get_rejection_bar(known_accuracies) if known_accuracies is not None else None
+    seeds = torch.randint(2 ** 31, (len(candidates),)).tolist()
+    results = [None] * len(candidates)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker, initargs=(threads, worker_globals)) as executor:
+        futures = {}
+        for model_id, (dev_model, dev_optimizer, dev_statistics, kept_channels) in enumerate(candidates):
+            future = executor.submit(train_candidate_in_worker, get_spec(dev_model), dev_model.state_dict(), dev_optimizer.state_dict(), dev_statistics, kept_channels,
+                                     seeds[model_id], first_epoch, last_epoch, bar)
+            futures[future] = model_id
+        for future in as_completed(futures):
+            model_id = futures[future]
+            model_state, optimizer_state_dict, dev_statistics, dev_top1_accuracies, dev_top5_accuracies, train_seconds, rejected = future.result()
+            dev_model, dev_optimizer, _, _ = candidates[model_id]
+            dev_model.load_state_dict(model_state)
+            dev_optimizer.load_state_dict(optimizer_state_dict)
+            results[model_id] = (dev_statistics, dev_top1_accuracies, dev_top5_accuracies, train_seconds, rejected)
+            if finished is not None:
+                finished(model_id, results[model_id])
+    # compare with CANDIDATE_WORKERS = 1 for the speed-up, the sum is what the workers spent with their share of the threads
+    print('%d candidates trained by %d workers in %.2fs, %.2fs of training summed over the workers' %(len(candidates), workers, time.time() - start, sum(result[3] for result in results)))
+    return results
+
+
+def check_proxy(full_candidates, proxy_top1_accuracies):
+    """ fine-tune the untrained copies full_candidates on the full training set and report how the rank of
+    their accuracies correlates with that of the proxy_top1_accuracies the candidates reached on the subset
+    """
+    global candidate_training_loader
+    proxy_training_loader = candidate_training_loader
+    candidate_training_loader = cifar10_training_loader
+    results = train_candidates(full_candidates, 1, dev_num)
+    candidate_training_loader = proxy_training_loader
+    full_top1_accuracies = [dev_top1_accuracies[-1] for dev_statistics, dev_top1_accuracies, _, _, _ in results]
+    print('proxy top1 accuracies: %s, full training set: %s' %(proxy_top1_accuracies, full_top1_accuracies))
+    print('rank correlation of the proxy fine-tuning: %f' %rank_correlation(proxy_top1_accuracies, full_top1_accuracies))
+
+
+def screen_candidate(dev_model, screen_batch):
+    """ return the (top1, top5) accuracy of the freshly pruned dev_model on the validation set, or if PRESCREEN_PROXY
+    names a zero-cost proxy, its score from one forward / backward pass on the training minibatch screen_batch
+    """
+    if settings.PRESCREEN_PROXY == 'accuracy':
+        return evaluate_model(dev_model)[:2]
+    return proxies[settings.PRESCREEN_PROXY](dev_model, *screen_batch)
+
+
+def prescreen(model_list, screen_list, FLOPs_list, parameter_num_list, latency_list, memory_list, keep_num):
+    """ return the sorted indices of the keep_num best scored models of model_list, which are freshly pruned
+    screen_list: what screen_candidate returned for each model. The accuracy right after pruning and recalibrating
+        BatchNorm is far from the fine-tuned one, but cheap and telling enough to pick the candidates worth fine-tuning
+    """
+    if settings.PRESCREEN_PROXY == 'accuracy':
+        score_list = compute_score(model_list, [[top1_accuracy] for top1_accuracy, _ in screen_list], [[top5_accuracy] for _, top5_accuracy in screen_list],
+                                   FLOPs_list, parameter_num_list, latency_list, memory_list)
+    else:
+        # the proxies are not accuracies, they only rank the candidates of a generation, which are about the same size
+        score_list = screen_list
+    kept = sorted(np.argsort(score_list, kind='stable')[::-1][:keep_num].tolist())
+    print('candidates %s pass the pre-screen' %[model_id + 1 for model_id in kept])
+    return kept
+
+
+def propose_plans(model, importance, local_top1_accuracy, local_top5_accuracy, plan_num):
+    """ return the pruning plans of plan_num candidates of model, None lets update_architecture draw the plan itself
+    Once the surrogate has learned from enough fine-tuned candidates, SURROGATE_SAMPLES plans are drawn and scored
+    by compute_score from the accuracies it predicts and their analytic costs, and the best scored are returned.
+    """
+    if settings.SURROGATE_SAMPLES <= plan_num or not surrogate.ready():
+        return [None] * plan_num
+    plans = [align_plan(model, model.draw_pruning_plan(int(modification_num + 1)), settings.CHANNEL_ALIGNMENT) for plan_id in range(settings.SURROGATE_SAMPLES)]
+    predictions = surrogate.predict([get_planned_widths(model, plan) for plan in plans], get_widths(model)).tolist()
+    FLOPs_list = []
+    parameter_num_list = []
+    latency_list = []
+    memory_list = []
+    for plan in plans:
+        removals = select_channels(model, plan, importance.copy())
+        plan_FLOPs, plan_parameter_num = count_candidate_ops(model, removals)
+        FLOPs_list.append(plan_FLOPs)
+        parameter_num_list.append(plan_parameter_num)
+        latency_list.append(estimate_latency(model, removals))
+        memory_list.append(estimate_memory(model, settings.MEMORY_BATCH_SIZE, removals))
+    score_list = compute_score(plans, [[local_top1_accuracy[-1] + top1_change] for top1_change, _ in predictions], [[local_top5_accuracy[-1] + top5_change] for _, top5_change in predictions],
+                               FLOPs_list, parameter_num_list, latency_list, memory_list)
+    kept = np.argsort(score_list, kind='stable')[::-1][:plan_num].tolist()
+    print('the surrogate picks plans %s of %d' %(kept, len(plans)))
+    return [plans[plan_id] for plan_id in kept]
+
+
+def get_halving_schedule(generate_num, dev_num):
+    """ return how many candidates successive halving starts with and the epochs each of its rungs ends at
+    The first rung trains HALVING_MIN_EPOCH epochs (at least the warm up), every following one HALVING_ETA
+    times as many in total, and the last ends at dev_num. Each rung keeps 1 / HALVING_ETA of the candidates,
+    and the pool is as large as fits in the generate_num * dev_num epochs of training every candidate fully.
+    """
+    rung_epochs = []
+    epoch = max(settings.HALVING_MIN_EPOCH, warm)
+    while epoch < dev_num:
+        rung_epochs.append(epoch)
+        epoch *= settings.HALVING_ETA
+    rung_epochs.append(dev_num)
+
+    def get_cost(candidate_num):
+        cost = 0
+        for rung_id, epoch in enumerate(rung_epochs):
+            survivor_num = max(1, math.ceil(candidate_num / settings.HALVING_ETA ** rung_id))
+            cost += survivor_num * (epoch - ([0] + rung_epochs)[rung_id])
+        return cost
+
+    candidate_num = generate_num
+    while get_cost(candidate_num + 1) <= generate_num * dev_num:
+        candidate_num += 1
+    return candidate_num, rung_epochs
 
 
 def generate_architecture(model, local_top1_accuracy, local_top5_accuracy):
-    loss_function = nn.CrossEntropyLoss()
+    global channel_statistics, optimizer_state, teacher, resumed_generation
+    if settings.VIRTUAL_CANDIDATES:
+        return generate_virtual_architecture(model, local_top1_accuracy, local_top5_accuracy)
+
+    # the generation the resumed run was interrupted in
+    progress, resumed_generation = resumed_generation, None
 
     # initialize all evaluating variables
     model_list = []
@@ -84,95 +440,390 @@ def generate_architecture(model, local_top1_accuracy, local_top5_accuracy):
     top5_accuracy_list = []
     FLOPs_list = []
     parameter_num_list = []
+    latency_list = []
+    memory_list = []
     model_list.append(model)
     top1_accuracy_list.append(local_top1_accuracy)
     top5_accuracy_list.append(local_top5_accuracy)
-    local_FLOPs, local_parameter_num = profile(model, inputs = (input, ), verbose=False)
+    local_FLOPs, local_parameter_num = count_ops(model, profile_batch_size)
     FLOPs_list.append(local_FLOPs)
     parameter_num_list.append(local_parameter_num)
+    latency_list.append(estimate_latency(model))
+    memory_list.append(estimate_memory(model, settings.MEMORY_BATCH_SIZE))
+    # score the channels of the parent once for all candidates
+    importance = ImportanceCache(model, settings.IMPORTANCE_CRITERION, channel_statistics)
+    statistics_list = [channel_statistics]
+    optimizer_list = [optimizer]
 
     original_model = copy.deepcopy(model)
-    for model_id in range(generate_num):
-        # generate architecture
-        dev_model = copy.deepcopy(original_model)
-        ResNet.update_architecture(dev_model, modification_num)
-        dev_model = dev_model.to(device)
-        print(dev_model)
-        dev_lr = lr
-        dev_optimizer = optim.SGD(dev_model.parameters(), lr=dev_lr, momentum=0.9, weight_decay=5e-4)
-        dev_warmup_scheduler = WarmUpLR(dev_optimizer, iter_per_epoch * warm)
-        dev_top1_accuracies = []
-        dev_top5_accuracies = []
-        # train the architecture for dev_num times
-        for dev_id in range(1, dev_num + 1):
-            if dev_id in settings.DYNAMIC_MILESTONES:
-                dev_lr *= gamma
-                for param_group in dev_optimizer.param_groups:
-                    param_group['lr'] = dev_lr
-            # begin training
-            dev_model.train()               # set model into training
-            for (train_x, train_label) in cifar10_training_loader:
-                # move train data to device
-                train_x = train_x.to(device)
-                train_label = train_label.to(device)
-                # clear the gradient data and update parameters based on error
-                dev_optimizer.zero_grad()
-                # get predict y and compute the error
-                predict_y = dev_model(train_x)
-                loss = loss_function(predict_y, train_label)
-                # update visualization
-                loss.backward()
-                dev_optimizer.step()
+    # the archive knows the architectures already trained from this very parent
+    parent_hash = hash_model(original_model) if archive is not None else None
+    # the candidates recover from pruning by distilling their parent
+    teacher = Teacher(original_model, settings.DISTILLATION_TEMPERATURE, settings.DISTILLATION_ALPHA, settings.FEATURE_DISTILLATION_WEIGHT, settings.DISTILLATION)
+    # prune all candidates first, then train them one after another or in parallel worker processes
+    if settings.SUCCESSIVE_HALVING:
+        candidate_num, rung_epochs = get_halving_schedule(generate_num, dev_num)
+    else:
+        candidate_num, rung_epochs = generate_num, [dev_num]
 
-                if dev_id <= warm:
-                    dev_warmup_scheduler.step()
+    def checkpoint_progress():
+        save_checkpoint({'top1_accuracy': local_top1_accuracy[-1], 'top5_accuracy': local_top5_accuracy[-1], 'teacher_seed': teacher.seed, 'rng_state': get_rng_state(),
+                         'candidate_num': candidate_num, 'candidates': candidates, 'full_candidates': full_candidates, 'FLOPs_list': dev_FLOPs_list,
+                         'parameter_num_list': dev_parameter_num_list, 'latency_list': dev_latency_list, 'memory_list': dev_memory_list,
+                         'top1_accuracy_list': dev_top1_accuracy_list, 'top5_accuracy_list': dev_top5_accuracy_list, 'epoch_list': dev_epoch_list,
+                         'seconds_list': dev_seconds_list, 'rejected_list': dev_rejected_list, 'signatures': signatures, 'restored': restored, 'survivors': survivors,
+                         'trained_epoch': trained_epoch, 'rung_results': rung_results})
 
-            # begin testing
-            if (dev_id + 1) % dev_num >= math.ceil(dev_num / 2):
-                # initialize the testing parameters
-                correct_1 = 0.0
-                correct_5 = 0.0
-                dev_model.eval()
-                with torch.no_grad():
-                    for (test_x, test_label) in cifar10_test_loader:
-                        # move test data to device
-                        test_x = test_x.to(device)
-                        test_label = test_label.to(device)
-                        # get predict y and predict its class
-                        outputs = dev_model(test_x)
-                        _, preds = outputs.topk(5, 1, largest=True, sorted=True)
-                        #compute top1
-                        correct_1 += (preds[:, :1] == test_label.unsqueeze(1)).sum().item()
-                        #compute top 5
-                        top5_correct = test_label.view(-1, 1).expand_as(preds) == preds
-                        correct_5 += top5_correct.any(dim=1).sum().item()
-                    # calculate the accuracy and print it
-                    top1_accuracy = correct_1 / len(cifar10_test_loader.dataset)
-                    top5_accuracy = correct_5 / len(cifar10_test_loader.dataset)
-                    # discard the first half data as model need retraining
-                    dev_top1_accuracies.append(top1_accuracy)
-                    dev_top5_accuracies.append(top5_accuracy)
+    if progress is None:
+        candidates = []
+        dev_FLOPs_list = []
+        dev_parameter_num_list = []
+        dev_latency_list = []
+        dev_memory_list = []
+        plans = propose_plans(original_model, importance, local_top1_accuracy, local_top5_accuracy, candidate_num * settings.PRESCREEN_FACTOR)
+        specs = set()
+        for plan in plans:
+            for attempt in range(settings.DUPLICATE_RETRIES + 1):
+                dev_model, dev_optimizer, kept_channels = prepare_candidate(original_model, importance, plan)
+                spec = get_spec(dev_model)
+                if spec not in specs:
+                    break
+                # the same architecture as a candidate pruned before, it would only be trained twice
+                plan = None
+            else:
+                print('a candidate duplicating another one is dropped')
+                continue
+            specs.add(spec)
+            # the statistics of the winner are used to prune it in the next generation
+            candidates.append((dev_model, dev_optimizer, ChannelStatistics(channel_statistics.enabled), kept_channels))
+            dev_FLOPs, dev_parameter_num = count_candidate_ops(dev_model)
+            dev_FLOPs_list.append(dev_FLOPs)
+            dev_parameter_num_list.append(dev_parameter_num)
+            dev_latency_list.append(estimate_latency(dev_model))
+            dev_memory_list.append(estimate_memory(dev_model, settings.MEMORY_BATCH_SIZE))
+        candidate_num = min(candidate_num, len(candidates))
+        if len(candidates) > candidate_num:
+            # only the candidates that score best right after pruning are fine-tuned
+            screen_batch = [tensor.to(device) for tensor in next(iter(candidate_training_loader))]
+            kept = prescreen([dev_model for dev_model, _, _, _ in candidates], [screen_candidate(dev_model, screen_batch) for dev_model, _, _, _ in candidates],
+                             dev_FLOPs_list, dev_parameter_num_list, dev_latency_list, dev_memory_list, candidate_num)
+            candidates = [candidates[model_id] for model_id in kept]
+            dev_FLOPs_list = [dev_FLOPs_list[model_id] for model_id in kept]
+            dev_parameter_num_list = [dev_parameter_num_list[model_id] for model_id in kept]
+            dev_latency_list = [dev_latency_list[model_id] for model_id in kept]
+            dev_memory_list = [dev_memory_list[model_id] for model_id in kept]
+        # untrained copies of the candidates, fine-tuned on the full training set to check the proxy
+        full_candidates = copy.deepcopy(candidates) if settings.PROXY_SUBSET_SIZE > 0 and settings.PROXY_CHECK else None
+        dev_top1_accuracy_list = [[] for model_id in range(candidate_num)]
+        dev_top5_accuracy_list = [[] for model_id in range(candidate_num)]
+        survivors = list(range(candidate_num))
+        dev_epoch_list = [0] * candidate_num
+        dev_seconds_list = [0.0] * candidate_num
+        # the candidates whose final evaluation was cut short by the sequential rejection
+        dev_rejected_list = [False] * candidate_num
+        signatures = [get_signature(get_widths(dev_model), parent_hash) for dev_model, _, _, _ in candidates] if archive is not None else [None] * candidate_num
+        restored = []
+        for model_id, signature in enumerate(signatures):
+            row = archive.lookup(signature) if signature is not None else None
+            state = archive.load_weights(signature, device) if is_reusable(row) else None
+            if state is not None:
+                # trained from this very parent before, the weights and results are taken over instead of training it again
+                dev_model, dev_optimizer, _, kept_channels = candidates[model_id]
+                dev_model.load_state_dict(state['model'])
+                dev_optimizer.load_state_dict(state['optimizer'])
+                candidates[model_id] = (dev_model, dev_optimizer, state['statistics'], kept_channels)
+                dev_top1_accuracy_list[model_id] = row['top1_accuracies']
+                dev_top5_accuracy_list[model_id] = row['topk_accuracies']
+                restored.append(model_id)
+        if len(restored) > 0:
+            print('candidates %s are restored from the archive' %[model_id + 1 for model_id in restored])
+            survivors = [model_id for model_id in survivors if model_id not in restored]
+        trained_epoch = 0
+        # the results of the candidates already trained in the current rung
+        rung_results = {}
+        checkpoint_progress()
+    else:
+        # go on with the candidates of the interrupted run, their generators are back where they were
+        teacher.seed = progress['teacher_seed']
+        set_rng_state(progress['rng_state'])
+        candidate_num, candidates, full_candidates = progress['candidate_num'], progress['candidates'], progress['full_candidates']
+        dev_FLOPs_list, dev_parameter_num_list, dev_latency_list, dev_memory_list = progress['FLOPs_list'], progress['parameter_num_list'], progress['latency_list'], progress['memory_list']
+        dev_top1_accuracy_list, dev_top5_accuracy_list = progress['top1_accuracy_list'], progress['top5_accuracy_list']
+        dev_epoch_list, dev_seconds_list, dev_rejected_list, signatures = progress['epoch_list'], progress['seconds_list'], progress['rejected_list'], progress['signatures']
+        restored, survivors, trained_epoch, rung_results = progress['restored'], progress['survivors'], progress['trained_epoch'], progress['rung_results']
+        print('resume the generation at epoch %d of candidates %s' %(trained_epoch, [model_id + 1 for model_id in survivors]))
+    stop_epochs = list(rung_epochs)
+    if settings.EARLY_STOPPING and settings.CURVE_EPOCH not in rung_epochs and settings.CURVE_EPOCH < dev_num:
+        stop_epochs = sorted(stop_epochs + [settings.CURVE_EPOCH])
+    for rung_epoch in stop_epochs:
+        if rung_epoch <= trained_epoch:
+            # trained before the run was resumed
+            continue
+        if len(survivors) == 0:
+            break
+        # the final evaluations are cut short for candidates that surely lose against the parent
+        known_accuracies = [local_top1_accuracy[-1]] if settings.SEQUENTIAL_REJECTION and rung_epoch == dev_num else None
+        if known_accuracies is not None:
+            known_accuracies += [rung_results[model_id][1][-1] for model_id in survivors if model_id in rung_results and not rung_results[model_id][4]]
+        pending = [model_id for model_id in survivors if model_id not in rung_results]
+
+        def finished(index, result):
+            rung_results[pending[index]] = result
+            checkpoint_progress()
+
+        train_candidates([candidates[model_id] for model_id in pending], trained_epoch + 1, rung_epoch, known_accuracies, finished)
+        results = [rung_results[model_id] for model_id in survivors]
+        for model_id, (dev_statistics, dev_top1_accuracies, dev_top5_accuracies, train_seconds, rejected) in zip(survivors, results):
+            dev_epoch_list[model_id] = rung_epoch
+            dev_seconds_list[model_id] += train_seconds
+            dev_rejected_list[model_id] = rejected
+            dev_model, dev_optimizer, _, kept_channels = candidates[model_id]
+            candidates[model_id] = (dev_model, dev_optimizer, dev_statistics, kept_channels)
+            dev_top1_accuracy_list[model_id].extend(dev_top1_accuracies)
+            dev_top5_accuracy_list[model_id].extend(dev_top5_accuracies)
+        trained_epoch = rung_epoch
+        if settings.EARLY_STOPPING and rung_epoch == settings.CURVE_EPOCH and rung_epoch < dev_num:
+            # stop the candidates whose learning curve can not reach the best predicted accuracy, all follow the same
+            # learning rate schedule, so the milestones the fits can not foresee do not change the comparison, fully
+            # trained candidates are compared by their measured accuracies instead
+            predictions = {model_id: extrapolate_accuracy(dev_top1_accuracy_list[model_id][:settings.CURVE_EPOCH], dev_num, settings.CURVE_CONFIDENCE) for model_id in survivors}
+            best_prediction = max(prediction for prediction, upper_bound in predictions.values())
+            stopped = [model_id for model_id in survivors if predictions[model_id][1] < best_prediction]
+            survivors = [model_id for model_id in survivors if model_id not in stopped]
+            if len(stopped) > 0:
+                print('candidates %s stop at epoch %d, their predicted top1 accuracy can not reach %f' %([model_id + 1 for model_id in stopped], rung_epoch, best_prediction))
+        if rung_epoch in rung_epochs and rung_epoch < dev_num:
+            # successive halving: only the most accurate 1 / HALVING_ETA of the candidates are trained further, ranked
+            # among themselves, compute_score would give 0 to all of them against the parent after a few recovery epochs
+            survivor_num = max(1, math.ceil(len(survivors) / settings.HALVING_ETA))
+            survivors = sorted(survivors, key=lambda model_id: (dev_top1_accuracy_list[model_id][-1], dev_top5_accuracy_list[model_id][-1]), reverse=True)[:survivor_num]
+            survivors.sort()
+            print('candidates %s survive epoch %d' %([model_id + 1 for model_id in survivors], rung_epoch))
+        rung_results = {}
+        checkpoint_progress()
+    if archive is not None:
+        for model_id, (dev_model, dev_optimizer, dev_statistics, _) in enumerate(candidates):
+            if model_id in restored:
+                continue
+            archive.record(signatures[model_id], widths=get_widths(dev_model), parent_hash=parent_hash, parent_widths=get_widths(original_model),
+                           parent_top1_accuracy=local_top1_accuracy[-1], parent_topk_accuracy=local_top5_accuracy[-1], FLOPs=dev_FLOPs_list[model_id],
+                           parameter_num=dev_parameter_num_list[model_id], latency=dev_latency_list[model_id], memory=dev_memory_list[model_id],
+                           top1_accuracies=dev_top1_accuracy_list[model_id], topk_accuracies=dev_top5_accuracy_list[model_id], epochs=dev_epoch_list[model_id],
+                           train_seconds=dev_seconds_list[model_id], rejected=dev_rejected_list[model_id], config_hash=config_hash,
+                           model_class=get_model_key(original_model)[0], num_class=get_model_key(original_model)[1])
+            if settings.ARCHIVE_WEIGHTS and dev_epoch_list[model_id] == dev_num and not dev_rejected_list[model_id]:
+                archive.save_weights(signatures[model_id], {'model': dev_model.state_dict(), 'optimizer': dev_optimizer.state_dict(), 'statistics': dev_statistics})
+    for model_id in sorted(survivors + restored):
         # store the model and score
+        dev_model, dev_optimizer, dev_statistics, _ = candidates[model_id]
+        if settings.SURROGATE_SAMPLES > 0 and not dev_rejected_list[model_id]:
+            # the accuracy of a rejected candidate is measured on part of the validation set only, it would bias the surrogate
+            surrogate.add(get_widths(dev_model), get_widths(original_model), (local_top1_accuracy[-1], local_top5_accuracy[-1]), (dev_top1_accuracy_list[model_id][-1], dev_top5_accuracy_list[model_id][-1]))
         model_list.append(dev_model)
-        top1_accuracy_list.append(dev_top1_accuracies)
-        top5_accuracy_list.append(dev_top5_accuracies)
-        dev_FLOPs, dev_parameter_num = profile(dev_model, inputs = (input, ), verbose=False)
-        FLOPs_list.append(dev_FLOPs)
-        parameter_num_list.append(dev_parameter_num)
+        statistics_list.append(dev_statistics)
+        optimizer_list.append(dev_optimizer)
+        top1_accuracy_list.append(dev_top1_accuracy_list[model_id])
+        top5_accuracy_list.append(dev_top5_accuracy_list[model_id])
+        FLOPs_list.append(dev_FLOPs_list[model_id])
+        parameter_num_list.append(dev_parameter_num_list[model_id])
+        latency_list.append(dev_latency_list[model_id])
+        memory_list.append(dev_memory_list[model_id])
+    if full_candidates is not None and len(survivors) > 1:
+        check_proxy([full_candidates[model_id] for model_id in survivors], [dev_top1_accuracy_list[model_id][-1] for model_id in survivors])
+    # drop the teacher and its cached logits
+    teacher = None
     global Para_compressed_ratio
-    score_list = compute_score(model_list, top1_accuracy_list, top5_accuracy_list, FLOPs_list, parameter_num_list)
+    score_list = compute_score(model_list, top1_accuracy_list, top5_accuracy_list, FLOPs_list, parameter_num_list, latency_list, memory_list)
     best_model_index = np.argmax(score_list)
     best_model_FLOPs = FLOPs_list[best_model_index]
     best_model_Params = parameter_num_list[best_model_index]
     FLOPs_compressed_ratio = best_model_FLOPs / original_FLOPs_num
     Para_compressed_ratio = best_model_Params / original_para_num
     model = copy.deepcopy(model_list[best_model_index])
+    channel_statistics = statistics_list[best_model_index]
+    optimizer_state = optimizer_list[best_model_index].state_dict()
+    print("model %d wins" %best_model_index)
+    print("Current compression ratio: FLOPs: %f, Parameter number: %f" %(FLOPs_compressed_ratio, Para_compressed_ratio))
+    return model, best_model_index
+
+
+def generate_virtual_architecture(model, local_top1_accuracy, local_top5_accuracy):
+    global channel_statistics, optimizer_state, teacher, resumed_generation
+
+    # the generation the resumed run was interrupted in
+    progress, resumed_generation = resumed_generation, None
+
+    # initialize all evaluating variables
+    candidate_list = []
+    top1_accuracy_list = []
+    top5_accuracy_list = []
+    FLOPs_list = []
+    parameter_num_list = []
+    latency_list = []
+    memory_list = []
+    top1_accuracy_list.append(local_top1_accuracy)
+    top5_accuracy_list.append(local_top5_accuracy)
+    local_FLOPs, local_parameter_num = count_ops(model, profile_batch_size)
+    FLOPs_list.append(local_FLOPs)
+    parameter_num_list.append(local_parameter_num)
+    latency_list.append(estimate_latency(model))
+    memory_list.append(estimate_memory(model, settings.MEMORY_BATCH_SIZE))
+    # score the channels of the parent once for all candidates
+    importance = ImportanceCache(model, settings.IMPORTANCE_CRITERION, channel_statistics)
+
+    if progress is None:
+        # every candidate is a set of channel masks over one shared copy of the parent
+        shared_model = copy.deepcopy(model).to(device)
+        plans = propose_plans(shared_model, importance, local_top1_accuracy, local_top5_accuracy, generate_num * settings.PRESCREEN_FACTOR)
+        specs = set()
+        for plan in plans:
+            for attempt in range(settings.DUPLICATE_RETRIES + 1):
+                if plan is None:
+                    plan = align_plan(shared_model, shared_model.draw_pruning_plan(int(modification_num + 1)), settings.CHANNEL_ALIGNMENT)
+                removals = select_channels(shared_model, plan, importance.copy())
+                spec = get_spec(shared_model, removals)
+                if spec not in specs:
+                    break
+                # the same architecture as a candidate masked before, it would only be trained twice
+                plan = None
+            else:
+                print('a candidate duplicating another one is dropped')
+                continue
+            specs.add(spec)
+            candidate = ChannelMask(shared_model, removals)
+            candidate_list.append(candidate)
+            if settings.BN_RECALIBRATION_SIZE > 0:
+                # every candidate keeps its own BatchNorm stats, re-estimated for its masks
+                with candidate.applied(shared_model):
+                    recalibrate_batchnorm(shared_model, candidate_training_loader, settings.BN_RECALIBRATION_SIZE, device)
+            top1_accuracy_list.append([])
+            top5_accuracy_list.append([])
+            # the candidate is counted from its removals, no compacted copy is needed
+            dev_FLOPs, dev_parameter_num = count_candidate_ops(shared_model, candidate.removals)
+            FLOPs_list.append(dev_FLOPs)
+            parameter_num_list.append(dev_parameter_num)
+            latency_list.append(estimate_latency(shared_model, candidate.removals))
+            memory_list.append(estimate_memory(shared_model, settings.MEMORY_BATCH_SIZE, candidate.removals))
+
+        if len(candidate_list) > generate_num:
+            # only the candidates that score best right after pruning are trained
+            screen_batch = [tensor.to(device) for tensor in next(iter(candidate_training_loader))]
+            screen_list = []
+            for candidate in candidate_list:
+                with candidate.applied(shared_model):
+                    screen_list.append(screen_candidate(shared_model, screen_batch))
+            kept = prescreen(candidate_list, screen_list, FLOPs_list[1:], parameter_num_list[1:], latency_list[1:], memory_list[1:], generate_num)
+            candidate_list = [candidate_list[model_id] for model_id in kept]
+            top1_accuracy_list = top1_accuracy_list[:generate_num + 1]
+            top5_accuracy_list = top5_accuracy_list[:generate_num + 1]
+            FLOPs_list = FLOPs_list[:1] + [FLOPs_list[model_id + 1] for model_id in kept]
+            parameter_num_list = parameter_num_list[:1] + [parameter_num_list[model_id + 1] for model_id in kept]
+            latency_list = latency_list[:1] + [latency_list[model_id + 1] for model_id in kept]
+            memory_list = memory_list[:1] + [memory_list[model_id + 1] for model_id in kept]
+        # the candidates whose final evaluation was cut short by the sequential rejection
+        rejected_list = [False] * len(candidate_list)
+    else:
+        # go on with the candidates of the interrupted run
+        shared_model, candidate_list = progress['shared_model'], progress['candidates']
+        top1_accuracy_list, top5_accuracy_list, rejected_list = progress['top1_accuracy_list'], progress['top5_accuracy_list'], progress['rejected_list']
+        FLOPs_list, parameter_num_list, latency_list, memory_list = progress['FLOPs_list'], progress['parameter_num_list'], progress['latency_list'], progress['memory_list']
+
+    dev_lr = lr
+    dev_optimizer = optim.SGD(shared_model.parameters(), lr=dev_lr, momentum=0.9, weight_decay=5e-4)
+    if settings.KEEP_OPTIMIZER_STATE:
+        load_optimizer_state(dev_optimizer, optimizer.state_dict())
+    # the candidates recover from pruning by distilling the parent, its logits are computed once per batch for all of them
+    teacher = Teacher(model, settings.DISTILLATION_TEMPERATURE, settings.DISTILLATION_ALPHA, settings.FEATURE_DISTILLATION_WEIGHT, settings.DISTILLATION)
+    dev_warmup_scheduler = WarmUpLR(dev_optimizer, len(candidate_training_loader) * warm)
+    first_dev_id = 1
+    train_seconds = 0.0
+    if progress is not None:
+        dev_optimizer.load_state_dict(progress['optimizer'])
+        dev_warmup_scheduler.load_state_dict(progress['warmup_scheduler'])
+        dev_lr, first_dev_id, train_seconds = progress['dev_lr'], progress['dev_id'] + 1, progress['train_seconds']
+        teacher.seed = progress['teacher_seed']
+        set_rng_state(progress['rng_state'])
+        print('resume the generation at epoch %d' %progress['dev_id'])
+    # train all candidates together for dev_num times
+    train_start = time.time() - train_seconds
+    for dev_id in range(first_dev_id, dev_num + 1):
+        if dev_id in settings.DYNAMIC_MILESTONES:
+            dev_lr *= gamma
+            for param_group in dev_optimizer.param_groups:
+                param_group['lr'] = dev_lr
+        # begin training
+        shared_model.train()
+        for train_x, train_label in candidate_training_loader:
+            # move train data to device
+            train_x = train_x.to(device)
+            train_label = train_label.to(device)
+            # average the masked gradients of all candidates on the shared parameters
+            dev_optimizer.zero_grad()
+            teacher_logits = teacher.logits(train_x)
+            for candidate in candidate_list:
+                with candidate.applied(shared_model):
+                    predict_y = shared_model(train_x)
+                loss = teacher.loss(predict_y, train_label, teacher_logits) / len(candidate_list)
+                loss.backward()
+            dev_optimizer.step()
+
+            if dev_id <= warm:
+                dev_warmup_scheduler.step()
+
+        if needs_evaluation(dev_id, dev_num, dev_num):
+            for candidate_id, candidate in enumerate(candidate_list):
+                with candidate.applied(shared_model):
+                    # the final evaluation is cut short for a candidate that surely loses against the parent or the candidates before it
+                    known_accuracies = [top1_accuracy_list[0][-1]] + [top1_accuracy_list[model_id + 1][-1] for model_id in range(candidate_id) if not rejected_list[model_id]]
+                    bar = get_rejection_bar(known_accuracies) if settings.SEQUENTIAL_REJECTION and dev_id == dev_num else None
+                    top1_accuracy, top5_accuracy, rejected_list[candidate_id] = evaluate_model(shared_model, bar)
+                top1_accuracy_list[candidate_id + 1].append(top1_accuracy)
+                top5_accuracy_list[candidate_id + 1].append(top5_accuracy)
+        save_checkpoint({'top1_accuracy': local_top1_accuracy[-1], 'top5_accuracy': local_top5_accuracy[-1], 'teacher_seed': teacher.seed, 'rng_state': get_rng_state(),
+                         'shared_model': shared_model, 'candidates': candidate_list, 'top1_accuracy_list': top1_accuracy_list, 'top5_accuracy_list': top5_accuracy_list,
+                         'rejected_list': rejected_list, 'FLOPs_list': FLOPs_list, 'parameter_num_list': parameter_num_list, 'latency_list': latency_list, 'memory_list': memory_list,
+                         'optimizer': dev_optimizer.state_dict(), 'warmup_scheduler': dev_warmup_scheduler.state_dict(), 'dev_lr': dev_lr, 'dev_id': dev_id,
+                         'train_seconds': time.time() - train_start})
+    if settings.SURROGATE_SAMPLES > 0:
+        for candidate_id, candidate in enumerate(candidate_list):
+            if rejected_list[candidate_id]:
+                # only measured on part of the validation set, it would bias the surrogate
+                continue
+            candidate_widths = get_planned_widths(shared_model, {group: len(channels) for group, channels in candidate.removals.items()})
+            surrogate.add(candidate_widths, get_widths(shared_model), (local_top1_accuracy[-1], local_top5_accuracy[-1]), (top1_accuracy_list[candidate_id + 1][-1], top5_accuracy_list[candidate_id + 1][-1]))
+    if archive is not None:
+        parent_hash = hash_model(model)
+        for candidate_id, candidate in enumerate(candidate_list):
+            candidate_widths = get_planned_widths(shared_model, {group: len(channels) for group, channels in candidate.removals.items()})
+            # the candidates are trained together, each is charged an even share of the time
+            archive.record(get_signature(candidate_widths, parent_hash), widths=candidate_widths, parent_hash=parent_hash, parent_widths=get_widths(model),
+                           parent_top1_accuracy=local_top1_accuracy[-1], parent_topk_accuracy=local_top5_accuracy[-1], FLOPs=FLOPs_list[candidate_id + 1],
+                           parameter_num=parameter_num_list[candidate_id + 1], latency=latency_list[candidate_id + 1], memory=memory_list[candidate_id + 1],
+                           top1_accuracies=top1_accuracy_list[candidate_id + 1], topk_accuracies=top5_accuracy_list[candidate_id + 1], epochs=dev_num,
+                           train_seconds=(time.time() - train_start) / len(candidate_list), rejected=rejected_list[candidate_id], config_hash=config_hash,
+                           model_class=get_model_key(model)[0], num_class=get_model_key(model)[1])
+    teacher = None
+    global Para_compressed_ratio
+    score_list = compute_score([model] + candidate_list, top1_accuracy_list, top5_accuracy_list, FLOPs_list, parameter_num_list, latency_list, memory_list)
+    best_model_index = np.argmax(score_list)
+    best_model_FLOPs = FLOPs_list[best_model_index]
+    best_model_Params = parameter_num_list[best_model_index]
+    FLOPs_compressed_ratio = best_model_FLOPs / original_FLOPs_num
+    Para_compressed_ratio = best_model_Params / original_para_num
+    optimizer_state = optimizer.state_dict()
+    if best_model_index != 0:
+        # only the winner is physically compacted
+        candidate_list[best_model_index - 1].compact(shared_model, dev_optimizer)
+        model = shared_model
+        optimizer_state = dev_optimizer.state_dict()
+        # the parent's statistics do not describe the compacted channels
+        channel_statistics = ChannelStatistics(channel_statistics.enabled)
     print("model %d wins" %best_model_index)
     print("Current compression ratio: FLOPs: %f, Parameter number: %f" %(FLOPs_compressed_ratio, Para_compressed_ratio))
     return model, best_model_index
 
 
-def compute_score(model_list, top1_accuracy_list, top3_accuracy_list, FLOPs_list, parameter_num_list):
+def compute_score(model_list, top1_accuracy_list, top3_accuracy_list, FLOPs_list, parameter_num_list, latency_list, memory_list):
     print(top1_accuracy_list)
     score_list = []
     # extract the last element (converged) accuracy to denote that architecture's accuracy
@@ -183,21 +834,67 @@ def compute_score(model_list, top1_accuracy_list, top3_accuracy_list, FLOPs_list
     parameter_num_tensor = torch.tensor(parameter_num_list)
     FLOPs_scaled = (FLOPs_tensor - torch.min(FLOPs_tensor)) / (torch.max(FLOPs_tensor) - torch.min(FLOPs_tensor))
     parameter_num_scaled = (parameter_num_tensor - torch.min(parameter_num_tensor)) / (torch.max(parameter_num_tensor) - torch.min(parameter_num_tensor))
+    latency_tensor = torch.tensor(latency_list)
+    latency_scaled = torch.zeros_like(latency_tensor)
+    if torch.max(latency_tensor) > torch.min(latency_tensor):
+        latency_scaled = (latency_tensor - torch.min(latency_tensor)) / (torch.max(latency_tensor) - torch.min(latency_tensor))
+    memory_tensor = torch.tensor(memory_list, dtype=torch.float)
+    memory_scaled = torch.zeros_like(memory_tensor)
+    if torch.max(memory_tensor) > torch.min(memory_tensor):
+        memory_scaled = (memory_tensor - torch.min(memory_tensor)) / (torch.max(memory_tensor) - torch.min(memory_tensor))
     for model_id in range(len(model_list)):
         top1_accuracy = top1_accuracies[model_id]
         top3_accuracy = top3_accuracies[model_id]
         if np.max(top1_accuracies) >= accuracy_threshold:
             # if there exists architecture that is higher than accuracy_threshold, only pick the simplest one and discard other
             if (top1_accuracy > accuracy_threshold - 0.005):
-                score_list.append(top1_accuracy * 0.5 +  0.5 - FLOPs_scaled[model_id].item() * 0.25 - parameter_num_scaled[model_id].item() * 0.25)
+                # LATENCY_WEIGHT and MEMORY_WEIGHT move their share of the compression term from FLOPs and parameter number to the latency and peak memory
+                compression_score = (FLOPs_scaled[model_id].item() * 0.25 + parameter_num_scaled[model_id].item() * 0.25) * (1 - settings.LATENCY_WEIGHT - settings.MEMORY_WEIGHT) + latency_scaled[model_id].item() * 0.5 * settings.LATENCY_WEIGHT + memory_scaled[model_id].item() * 0.5 * settings.MEMORY_WEIGHT
+                score_list.append(top1_accuracy * 0.5 +  0.5 - compression_score)
             else:
                 score_list.append(0)
         else:
             score_list.append(top1_accuracy * 0.9 +  top3_accuracy * 0.1)
+        if settings.MEMORY_BUDGET > 0 and memory_list[model_id] > settings.MEMORY_BUDGET * 2 ** 20:
+            # architectures over the memory budget rank below all others, the one needing the least memory first
+            score_list[-1] = -memory_list[model_id] / (settings.MEMORY_BUDGET * 2 ** 20)
     print(FLOPs_scaled)
     print(score_list)
     return score_list
 
+# the progress of the generation the resumed run was interrupted in, picked up by generate_architecture
+resumed_generation = None
+# where save_checkpoint writes, None disables the checkpoints
+checkpoint_path = None
+
+def save_checkpoint(generation=None, finished=False):
+    """ save everything the search needs to go on after a crash to checkpoint_path, --resume picks it up
+    The file is replaced atomically, so a crash while saving keeps the previous checkpoint. The random number
+    generators are saved too, so a resumed run draws what the interrupted one would have drawn.
+    generation: the progress of the generation running at epoch, None if epoch is finished
+    finished: whether the search is over, a resumed run then only saves the final model again
+    """
+    if checkpoint_path is None:
+        return
+    state = {'epoch': epoch, 'current_time': current_time, 'criteria': args.criteria, 'accuracy_threshold': accuracy_threshold,
+             'compression_threshold': compression_threshold, 'tolerance_times': tolerance_times, 'modification_num': modification_num,
+             'generate_num': generate_num, 'Para_compressed_ratio': Para_compressed_ratio, 'net': net, 'optimizer': optimizer.state_dict(),
+             'warmup_scheduler': warmup_scheduler.state_dict(), 'channel_statistics': channel_statistics, 'surrogate': surrogate,
+             'rng_state': get_rng_state(), 'virtual_candidates': settings.VIRTUAL_CANDIDATES, 'generation': generation,
+             'finished': finished}
+    torch.save(state, checkpoint_path + '.tmp')
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def check_settings():
+    """ warn about the settings that the virtual candidates, trained together over one shared model, do not support """
+    if settings.VIRTUAL_CANDIDATES:
+        ignored = [name for name, value in [('SUCCESSIVE_HALVING', settings.SUCCESSIVE_HALVING), ('EARLY_STOPPING', settings.EARLY_STOPPING),
+                                            ('CANDIDATE_WORKERS', settings.CANDIDATE_WORKERS > 1), ('PROXY_CHECK', settings.PROXY_CHECK)] if value]
+        if len(ignored) > 0:
+            print('Warning: %s are ignored with VIRTUAL_CANDIDATES' %', '.join(ignored))
+
+
 def check_args(args):
     if args.criteria == 'accuracy':
         if args.compression_threshold is not None:
@@ -217,6 +914,7 @@ def get_args():
     parser.add_argument('--criteria', '-c', type=str, default='accuracy', help='Compressed the model with accuracy_threshold or compression_threshold')
     parser.add_argument('--accuracy_threshold', '-A', metavar='A', type=float, default=None, help='The final accuracy the architecture will achieve')
     parser.add_argument('--compression_threshold', '-C', metavar='C', type=float, default=None, help='The final compression ratio the architecture will achieve')
+    parser.add_argument('--resume', '-r', type=str, default=None, help='The checkpoint of an interrupted run to resume, e.g. models/ResNet_Checkpoint_<seed>.pkl')
 
     args = parser.parse_args()
     check_args(args)
@@ -226,6 +924,7 @@ def get_args():
 
 if __name__ == '__main__':
     args = get_args()
+    check_settings()
     # move the LeNet Module into the corresponding device
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     lr = 0.1
@@ -246,14 +945,20 @@ if __name__ == '__main__':
 
     # reinitialize random seed
     current_time = int(time.time())
+    checkpoint = torch.load(args.resume, map_location=device, weights_only=False) if args.resume is not None else None
+    if checkpoint is not None:
+        # keep the seed, and so the file names, of the interrupted run
+        current_time = checkpoint['current_time']
     torch.manual_seed(current_time)
     print('Start with random seed %d' %current_time)
 
     net = torch.load('models/ResNet_Original_1710645767.pkl')     # replace it with the model gained by train_original.py
     net = net.to(device)
 
-    input = torch.rand(128, 3, 32, 32).to(device)
-    original_FLOPs_num, original_para_num = profile(net, inputs = (input, ), verbose=False)
+    # FLOPs are counted analytically for a batch of this size
+    profile_batch_size = 128
+    latency_table = LatencyTable(settings.LATENCY_TABLE_PATH, settings.LATENCY_BATCH_SIZE)
+    original_FLOPs_num, original_para_num = count_ops(net, profile_batch_size)
     Para_compressed_ratio = 1.000
 
     #data preprocessing:
@@ -273,14 +978,75 @@ if __name__ == '__main__':
         shuffle=True
     )
 
+    # candidates are compared on a held-out part of the training set instead of the test set
+    validation_loader = cifar10_test_loader
+    if settings.VALIDATION_SIZE > 0:
+        cifar10_training_loader, validation_loader = split_validation_dataloader(cifar10_training_loader, cifar10_test_loader, settings.VALIDATION_SIZE)
+    # candidates are fine-tuned on a stratified subset of the training set picked once, only the winner trains on all of it
+    candidate_training_loader = cifar10_training_loader
+    if settings.PROXY_SUBSET_SIZE > 0:
+        candidate_training_loader = get_stratified_subset_dataloader(cifar10_training_loader, settings.PROXY_SUBSET_SIZE)
+
+    # archived results are only taken over from runs with the same training settings
+    config_hash = hash_config(get_training_config())
+
     loss_function = nn.CrossEntropyLoss()
+    # hooks recording the channel statistics are only attached when the criterion needs them
+    channel_statistics = ChannelStatistics(settings.IMPORTANCE_CRITERION in statistics_criteria)
+    # every candidate trained by this and earlier runs, with its results
+    archive = ArchitectureArchive(settings.ARCHIVE_PATH) if settings.ARCHIVE_PATH else None
+    # learns from every fine-tuned candidate which pruning plans are worth fine-tuning, starting from those of earlier runs
+    surrogate = AccuracySurrogate(get_widths(net), settings.SURROGATE_MIN_SAMPLES)
+    if archive is not None and settings.SURROGATE_SAMPLES > 0:
+        for row in archive.history():
+            if is_reusable(row) and (row['model_class'], row['num_class']) == get_model_key(net) and len(row['top1_accuracies']) > 0 and row['widths'].keys() == surrogate.reference_widths.keys():
+                surrogate.add(row['widths'], row['parent_widths'], (row['parent_top1_accuracy'], row['parent_topk_accuracy']), (row['top1_accuracies'][-1], row['topk_accuracies'][-1]))
     optimizer = optim.SGD(net.parameters(), lr=current_lr, momentum=0.9, weight_decay=5e-4)
     iter_per_epoch = len(cifar10_training_loader)
     warmup_scheduler = WarmUpLR(optimizer, iter_per_epoch * warm)
+    if settings.CHECKPOINT:
+        if not os.path.isdir("models"):
+            os.mkdir("models")
+        checkpoint_path = 'models/ResNet_Checkpoint_{:d}.pkl'.format(current_time)
+    start_epoch = 1
+    if checkpoint is not None:
+        # go on where the interrupted run saved its last checkpoint
+        if checkpoint.get('virtual_candidates') != settings.VIRTUAL_CANDIDATES:
+            # the progress of a generation is kept differently for virtual candidates
+            print("Error: the checkpoint was saved with VIRTUAL_CANDIDATES = %s, resume it with the same setting" %checkpoint.get('virtual_candidates'))
+            sys.exit(1)
+        args.criteria = checkpoint['criteria']
+        accuracy_threshold, compression_threshold = checkpoint['accuracy_threshold'], checkpoint['compression_threshold']
+        tolerance_times, modification_num, generate_num = checkpoint['tolerance_times'], checkpoint['modification_num'], checkpoint['generate_num']
+        Para_compressed_ratio = checkpoint['Para_compressed_ratio']
+        net = checkpoint['net'].to(device)
+        optimizer = optim.SGD(net.parameters(), lr=current_lr, momentum=0.9, weight_decay=5e-4)
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        warmup_scheduler = WarmUpLR(optimizer, iter_per_epoch * warm)
+        warmup_scheduler.load_state_dict(checkpoint['warmup_scheduler'])
+        channel_statistics, surrogate = checkpoint['channel_statistics'], checkpoint['surrogate']
+        set_rng_state(checkpoint['rng_state'])
+        resumed_generation = checkpoint['generation']
+        start_epoch = checkpoint['epoch'] if resumed_generation is not None else checkpoint['epoch'] + 1
+        if checkpoint.get('finished', False) or start_epoch > settings.DYNAMIC_EPOCH:
+            # the search was over when the checkpoint was saved, no more epochs are trained
+            if not os.path.isdir("models"):
+                os.mkdir("models")
+            torch.save(net, 'models/ResNet_Compressed_{:d}.pkl'.format(current_time))
+            print('The search of the checkpoint is finished, its final model is saved')
+            start_epoch = settings.DYNAMIC_EPOCH + 1
+        else:
+            print('Resume from epoch %d' %start_epoch)
+        checkpoint = None
 
-    for epoch in range(1, settings.DYNAMIC_EPOCH + 1):
-        train(epoch)
-        top1_acc, top5_acc = eval_training(epoch)
+    for epoch in range(start_epoch, settings.DYNAMIC_EPOCH + 1):
+        if resumed_generation is not None:
+            # the run was interrupted in the generation of this epoch, which starts from the saved accuracies
+            top1_acc, top5_acc = resumed_generation['top1_accuracy'], resumed_generation['top5_accuracy']
+        else:
+            train(epoch)
+            # the accuracy is only needed exactly when a generation starts
+            top1_acc, top5_acc = eval_training(epoch, full=epoch % 10 == 0)
 
         # dynamic generate architecture
         if epoch % 10 == 0:
@@ -292,10 +1058,16 @@ if __name__ == '__main__':
                     modification_num /= 2
                     generate_num += 1
                 optimizer = optim.SGD(net.parameters(), lr=current_lr, momentum=0.9, weight_decay=5e-4)
+                if settings.KEEP_OPTIMIZER_STATE:
+                    # keep training with the momentum of the winner instead of starting from zero
+                    load_optimizer_state(optimizer, optimizer_state)
                 # save the module
                 if not os.path.isdir("models"):
                     os.mkdir("models")
                 torch.save(net, 'models/ResNet_Compressed_{:d}.pkl'.format(current_time))
+                # the architecture alone, ArchitectureSpec.from_json(...).build(ResNet) rebuilds it without replaying the search
+                with open('models/ResNet_Compressed_{:d}.json'.format(current_time), 'w') as spec_file:
+                    spec_file.write(get_spec(net).to_json())
             else:
                 if args.criteria == 'compression' and Para_compressed_ratio >= compression_threshold:
                     # decrement accuracy_threshold and reinitialize hyperparameter if criteria is compression ratio
@@ -309,6 +1081,8 @@ if __name__ == '__main__':
                     if not os.path.isdir("models"):
                         os.mkdir("models")
                     torch.save(net, 'models/ResNet_Compressed_{:d}.pkl'.format(current_time))
+                    # the checkpoint at the end of the loop is skipped
+                    save_checkpoint(finished=True)
                     break
 
         # save the model when training end
@@ -317,3 +1091,6 @@ if __name__ == '__main__':
             if not os.path.isdir("models"):
                 os.mkdir("models")
             torch.save(net, 'models/ResNet_Compressed_{:d}.pkl'.format(current_time))
+
+        # everything needed to go on from the next epoch after a crash
+        save_checkpoint(finished=epoch == settings.DYNAMIC_EPOCH)
@@ -0,0 +1,64 @@
+import argparse
+import copy
+import sys
+import time
+
+import torch
+
+from conf import settings
+from models.vgg import VGG
+
+
+def measure_latency(model, batch_size, repeat):
+    """ return the median wall time of one CPU forward pass of model in milliseconds """
+    model.eval()
+    input = torch.rand((batch_size, ) + tuple(model.input_size))
+    latencies = []
+    with torch.no_grad():
+        # the first passes pick the kernels and warm up the caches
+        for warmup_id in range(3):
+            model(input)
+        for run_id in range(repeat):
+            start = time.perf_counter()
+            model(input)
+            latencies.append(time.perf_counter() - start)
+    return sorted(latencies)[len(latencies) // 2] * 1000
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='CPU latency of VGG16 pruned with different channel alignments')
+    parser.add_argument('--net', '-n', type=str, default=None, help='The model to be pruned, a freshly initialized VGG16 by default')
+    parser.add_argument('--modification_num', '-m', type=int, default=settings.MAX_MODIFICATION_NUM, help='How many modifications update_architecture makes')
+    parser.add_argument('--alignments', '-a', type=int, nargs='+', default=[1, 8, 16, 32], help='The channel multiples to compare')
+    parser.add_argument('--batch_size', '-b', type=int, default=1, help='The batch size of the timed forward passes')
+    parser.add_argument('--repeat', '-r', type=int, default=50, help='How many forward passes are timed')
+    parser.add_argument('--seed', '-s', type=int, default=0, help='The random seed of the pruning plan, shared by all alignments')
+    parser.add_argument('--tolerance', '-t', type=float, default=0.05, help='How much slower than the unaligned model an aligned one may run before the benchmark fails')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    net = torch.load(args.net, map_location='cpu') if args.net is not None else VGG()
+    original_latency = measure_latency(net, args.batch_size, args.repeat)
+    original_para_num = sum(parameter.numel() for parameter in net.parameters())
+    print('Original model: parameter number %d, latency %.3f ms' %(original_para_num, original_latency))
+
+    latencies = {}
+    for alignment in args.alignments:
+        # the same random choices are drawn for every alignment, only the rounding differs
+        torch.manual_seed(args.seed)
+        model = copy.deepcopy(net)
+        VGG.update_architecture(model, args.modification_num, bulk=True, align=alignment)
+        para_num = sum(parameter.numel() for parameter in model.parameters())
+        latency = measure_latency(model, args.batch_size, args.repeat)
+        print('Alignment %d: parameter number %d (%.4f), latency %.3f ms (%.4f)' %(alignment, para_num, para_num / original_para_num, latency, latency / original_latency))
+        latencies[alignment] = latency
+
+    # the aligned widths have to pay off, not only be reported
+    if 1 in latencies:
+        slower = [alignment for alignment, latency in latencies.items() if alignment > 1 and latency > latencies[1] * (1 + args.tolerance)]
+        if len(slower) > 0:
+            print('Error: alignments %s run slower than the unaligned model' %slower)
+            sys.exit(1)
+        print('No alignment runs more than %.0f%% slower than the unaligned model' %(args.tolerance * 100))
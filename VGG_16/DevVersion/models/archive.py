@@ -0,0 +1,104 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import time
+
+import torch
+import torch.nn as nn
+
+
+def hash_model(model):
+    """ return the sha1 hex digest of the state_dict of model, which identifies the checkpoint candidates are pruned from """
+    digest = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+def get_signature(widths, parent_hash):
+    """ return the canonical signature of the architecture with the channel group widths, pruned from parent_hash """
+    return hashlib.sha1(json.dumps([sorted(widths.items()), parent_hash]).encode()).hexdigest()
+
+def get_model_key(model):
+    """ return (class name, number of classes) of model, widths of different models are only comparable when they agree """
+    return type(model).__name__, [module for module in model.modules() if isinstance(module, nn.Linear)][-1].out_features
+
+def hash_config(config):
+    """ return the sha1 hex digest of config, a JSON serializable dict of the settings a candidate's training results depend on """
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+class ArchitectureArchive:
+    """ SQLite store of every candidate architecture trained so far and its results, shared across runs
+    A row is keyed by the signature of the architecture, see get_signature, and keeps its widths, its parent, the
+    profiled costs, the accuracy curves and how many epochs and seconds of training they took. It also keeps whether
+    the final evaluation was cut short by the sequential rejection, which leaves its last accuracies pessimistic, and
+    the hash_config of the training settings, as results are only comparable under the same ones, and the class and
+    number of classes of the model, see get_model_key, as the widths alone do not tell the models apart. The trained weights
+    are stored only on request, they let a later run with the same parent skip training the architecture again.
+    Args:
+        path: the database file, created with its directory if missing
+    """
+    columns = ['widths', 'parent_hash', 'parent_widths', 'parent_top1_accuracy', 'parent_topk_accuracy', 'FLOPs', 'parameter_num',
+               'latency', 'memory', 'top1_accuracies', 'topk_accuracies', 'epochs', 'train_seconds', 'rejected', 'config_hash',
+               'model_class', 'num_class']
+    json_columns = {'widths', 'parent_widths', 'top1_accuracies', 'topk_accuracies'}
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('CREATE TABLE IF NOT EXISTS architectures (signature TEXT PRIMARY KEY, widths TEXT, parent_hash TEXT, parent_widths TEXT, '
+                                'parent_top1_accuracy REAL, parent_topk_accuracy REAL, FLOPs INTEGER, parameter_num INTEGER, latency REAL, memory INTEGER, '
+                                'top1_accuracies TEXT, topk_accuracies TEXT, epochs INTEGER, train_seconds REAL, created REAL, rejected INTEGER, config_hash TEXT, model_class TEXT, num_class INTEGER)')
+        # archives of earlier versions lack the newer columns, their rows then never match a config_hash or model
+        existing_columns = {row['name'] for row in self.connection.execute('PRAGMA table_info(architectures)')}
+        for column, column_type in [('rejected', 'INTEGER'), ('config_hash', 'TEXT'), ('model_class', 'TEXT'), ('num_class', 'INTEGER')]:
+            if column not in existing_columns:
+                self.connection.execute('ALTER TABLE architectures ADD COLUMN %s %s' %(column, column_type))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS weights (signature TEXT PRIMARY KEY, state BLOB)')
+        self.connection.commit()
+
+    def decode(self, row):
+        return {key: json.loads(row[key]) if key in self.json_columns and row[key] is not None else row[key] for key in row.keys()}
+
+    def lookup(self, signature):
+        """ return the dict of the stored results of signature, None if it was never trained """
+        row = self.connection.execute('SELECT * FROM architectures WHERE signature = ?', (signature, )).fetchone()
+        return self.decode(row) if row is not None else None
+
+    def lookup_widths(self, widths, model_key):
+        """ return the dict of the stored results of any architecture of the model_key model with the channel group widths, whatever its parent """
+        row = self.connection.execute('SELECT * FROM architectures WHERE widths = ? AND model_class = ? AND num_class = ? LIMIT 1',
+                                      (json.dumps(widths, sort_keys=True), ) + tuple(model_key)).fetchone()
+        return self.decode(row) if row is not None else None
+
+    def history(self):
+        """ return the dicts of all stored results, oldest first """
+        return [self.decode(row) for row in self.connection.execute('SELECT * FROM architectures ORDER BY created')]
+
+    def record(self, signature, **results):
+        """ store the results of signature, given by the names of columns, replacing those of an earlier training """
+        values = [json.dumps(results.get(column), sort_keys=True) if column in self.json_columns else results.get(column) for column in self.columns]
+        self.connection.execute('INSERT OR REPLACE INTO architectures (signature, %s, created) VALUES (?, %s, ?)' %(', '.join(self.columns), ', '.join('?' * len(self.columns))),
+                                [signature] + values + [time.time()])
+        # weights of an earlier training do not belong to these results
+        self.connection.execute('DELETE FROM weights WHERE signature = ?', (signature, ))
+        self.connection.commit()
+
+    def save_weights(self, signature, state):
+        """ store state, any object torch.save takes, as the trained weights of signature """
+        buffer = io.BytesIO()
+        torch.save(state, buffer)
+        self.connection.execute('INSERT OR REPLACE INTO weights VALUES (?, ?)', (signature, buffer.getvalue()))
+        self.connection.commit()
+
+    def load_weights(self, signature, map_location=None):
+        """ return what save_weights stored for signature, None if nothing was """
+        row = self.connection.execute('SELECT state FROM weights WHERE signature = ?', (signature, )).fetchone()
+        if row is None:
+            return None
+        return torch.load(io.BytesIO(row[0]), map_location=map_location, weights_only=False)
@@ -0,0 +1,220 @@
+import copy
+import json
+import math
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from models.pruning import get_channel_graph, get_channel_dependencies, get_width
+
+
+def get_removed_widths(model, removals):
+    """ return the dict mapping (module_name, dim) to how many of its channels removals takes away
+    dim 0 counts the module's output channels, dim 1 its input channels
+    """
+    removed_widths = {}
+    for group, channels in (removals or {}).items():
+        for module_name, dim, offset, repeat in get_channel_dependencies(model, group):
+            removed_widths[(module_name, dim)] = removed_widths.get((module_name, dim), 0) + len(channels) * repeat
+    return removed_widths
+
+def get_layout_channels(model, graph, layout, removed_widths):
+    """ return the number of channels of a tensor with the given channel layout, read from the widths of its groups """
+    return sum((get_width(model.get_submodule(graph.producers[group])) - removed_widths.get((graph.producers[group], 0), 0)) * repeat for group, repeat in layout)
+
+def get_input_channels(model, graph, module_name, removed_widths):
+    """ return the number of channels entering module_name, read from the widths of the groups of its input """
+    layout = graph.input_layouts[module_name]
+    if layout is None:
+        return graph.shapes[module_name][0][1]
+    return get_layout_channels(model, graph, layout, removed_widths)
+
+def count_ops(model, batch_size=1, removals=None):
+    """ count the FLOPs and parameter number of model from its layer shapes, without any forward pass
+    The counting rules are those of thop.profile: multiply-accumulates of Conv2d and Linear, 2 (4 if
+    affine) operations per BatchNorm2d element and the pooling averages. The spatial size of every
+    layer comes from the shape propagation cached with the model's channel graph, which pruning does
+    not change, so counting a pruned model only reads the current channel widths.
+    Args:
+        model: the model to be counted
+        batch_size: the number of samples the FLOPs are counted for
+        removals: dict mapping a channel group name to the LongTensor of channels to remove, the
+            model is counted as if they were already pruned, e.g. for a ChannelMask candidate
+    Returns: FLOPs, parameter_num
+    """
+    graph = get_channel_graph(model)
+    removed_widths = get_removed_widths(model, removals)
+    FLOPs = 0
+    parameter_num = 0
+    for module_name, module in model.named_modules():
+        if module_name not in graph.shapes:
+            parameter_num += sum(parameter.numel() for parameter in module.parameters(recurse=False))
+            continue
+        input_shape, output_shape = graph.shapes[module_name]
+        output_size = math.prod(output_shape[2:])
+        if isinstance(module, (nn.Conv2d, nn.Linear)):
+            groups = module.groups if isinstance(module, nn.Conv2d) else 1
+            in_channels = module.weight.shape[1] * groups - removed_widths.get((module_name, 1), 0)
+            out_channels = module.weight.shape[0] - removed_widths.get((module_name, 0), 0)
+            kernel_size = math.prod(module.weight.shape[2:])
+            FLOPs += out_channels * output_size * in_channels // groups * kernel_size
+            parameter_num += out_channels * in_channels // groups * kernel_size
+            if module.bias is not None:
+                parameter_num += out_channels
+        elif isinstance(module, nn.BatchNorm2d):
+            channels = module.num_features - removed_widths.get((module_name, 0), 0)
+            FLOPs += 2 * channels * output_size * (2 if module.affine else 1)
+            if module.affine:
+                parameter_num += 2 * channels
+        elif isinstance(module, nn.AvgPool2d):
+            FLOPs += get_input_channels(model, graph, module_name, removed_widths) * output_size
+        elif isinstance(module, nn.AdaptiveAvgPool2d):
+            kernel_size = math.prod(input_size // size for input_size, size in zip(input_shape[2:], output_shape[2:]))
+            FLOPs += get_input_channels(model, graph, module_name, removed_widths) * output_size * (kernel_size + 1)
+        else:
+            parameter_num += sum(parameter.numel() for parameter in module.parameters(recurse=False))
+    return FLOPs * batch_size, parameter_num
+
+
+def estimate_memory(model, batch_size=1, removals=None):
+    """ estimate the peak memory of the activations and workspaces of one forward pass of model in bytes
+    The tensors of the traced forward pass are walked in execution order. Each is allocated when it is
+    computed and freed after the last operation reading it, in-place operations and views share the
+    memory of their input, and the model outputs are kept to the end. While a Conv2d that is not a plain
+    1x1 convolution runs, the im2col buffer of the reference CPU kernel is added as its workspace. Like
+    count_ops, the widths are read from the channel groups, so no forward pass is needed.
+    Args:
+        model: the model to be estimated
+        batch_size: the number of samples in one forward pass
+        removals: dict mapping a channel group name to the LongTensor of channels to remove, the
+            model is estimated as if they were already pruned, e.g. for a ChannelMask candidate
+    Returns: peak memory in bytes
+    """
+    graph = get_channel_graph(model)
+    removed_widths = get_removed_widths(model, removals)
+    element_size = next(model.parameters()).element_size()
+    storages = []           # tensor id -> id of the memory it is stored in
+    sizes = []              # memory id -> number of elements
+    allocations = []        # memory id -> step it is allocated at
+    last_uses = []          # memory id -> last step reading it
+    workspaces = []         # step -> number of elements of the workspace
+    for step, (module_name, shape, layout, input_ids, reuses_input) in enumerate(graph.tensors):
+        for input_id in input_ids:
+            last_uses[storages[input_id]] = step
+        workspace = 0
+        module = model.get_submodule(module_name) if module_name is not None else None
+        if isinstance(module, nn.Conv2d) and (module.kernel_size != (1, 1) or module.stride != (1, 1) or module.padding != (0, 0)):
+            in_channels = module.weight.shape[1] * module.groups - removed_widths.get((module_name, 1), 0)
+            workspace = in_channels // module.groups * math.prod(module.kernel_size) * math.prod(shape[2:])
+        workspaces.append(workspace)
+        if reuses_input:
+            storages.append(storages[input_ids[0]])
+            continue
+        channels = shape[1] if layout is None else get_layout_channels(model, graph, layout, removed_widths)
+        storages.append(len(sizes))
+        sizes.append(channels * math.prod(shape[2:]))
+        allocations.append(step)
+        last_uses.append(step)
+    for tensor_id in graph.output_tensors:
+        last_uses[storages[tensor_id]] = len(graph.tensors)
+
+    # sweep the steps, adding each memory when allocated and dropping it after its last use
+    changes = [0] * (len(graph.tensors) + 2)
+    for size, allocation, last_use in zip(sizes, allocations, last_uses):
+        changes[allocation] += size
+        changes[last_use + 1] -= size
+    live = 0
+    peak = 0
+    for step, workspace in enumerate(workspaces):
+        live += changes[step]
+        peak = max(peak, live + workspace)
+    return peak * batch_size * element_size
+
+class LatencyTable:
+    """ CPU latency of single layers, measured once on this machine and persisted as json
+    Layers are keyed by their type and configuration, input / output channels, input spatial size and
+    batch size. Estimating a model sums the entries of its layers, so only layer shapes never seen
+    before are timed. The table is saved whenever new entries are measured.
+    Args:
+        path: the json file the table is loaded from and saved to
+        batch_size: the batch size the latencies are measured for
+        repeat: how many timed forward passes each new entry takes the median of
+    """
+    def __init__(self, path, batch_size=1, repeat=20):
+        self.path = path
+        self.batch_size = batch_size
+        self.repeat = repeat
+        self.latencies = {}
+        if os.path.isfile(path):
+            with open(path) as table_file:
+                self.latencies = json.load(table_file)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path, 'w') as table_file:
+            json.dump(self.latencies, table_file, indent=0, sort_keys=True)
+
+    def build_layer(self, module, in_channels, out_channels):
+        """ return a copy of module with the given widths for timing, None if it can not be timed alone """
+        if isinstance(module, nn.Conv2d):
+            return nn.Conv2d(in_channels, out_channels, kernel_size=module.kernel_size, stride=module.stride, padding=module.padding,
+                             dilation=module.dilation, groups=module.groups, bias=module.bias is not None, padding_mode=module.padding_mode)
+        if isinstance(module, nn.Linear):
+            return nn.Linear(in_channels, out_channels, bias=module.bias is not None)
+        if isinstance(module, nn.BatchNorm2d):
+            return nn.BatchNorm2d(out_channels, eps=module.eps, affine=module.affine, track_running_stats=module.track_running_stats)
+        if len(list(module.parameters())) > 0 or len(list(module.children())) > 0:
+            return None
+        return copy.deepcopy(module)
+
+    def get_key(self, module, in_channels, out_channels, input_shape):
+        layer_type = repr(module) if not isinstance(module, (nn.Conv2d, nn.Linear, nn.BatchNorm2d)) else type(module).__name__
+        if isinstance(module, nn.Conv2d):
+            layer_type += '(kernel_size=%s, stride=%s, padding=%s, dilation=%s, groups=%d)' %(module.kernel_size, module.stride, module.padding, module.dilation, module.groups)
+        spatial_size = 'x'.join(str(size) for size in input_shape[2:])
+        return '%s|%d|%d|%s|%d' %(layer_type, in_channels, out_channels, spatial_size, self.batch_size)
+
+    def measure(self, layer, in_channels, input_shape):
+        """ return the median latency of one forward pass of layer in milliseconds """
+        layer.eval()
+        input = torch.rand((self.batch_size, in_channels) + tuple(input_shape[2:]))
+        latencies = []
+        with torch.no_grad():
+            layer(input)
+            for run_id in range(self.repeat):
+                start = time.perf_counter()
+                layer(input)
+                latencies.append(time.perf_counter() - start)
+        return sorted(latencies)[len(latencies) // 2] * 1000
+
+    def estimate(self, model, removals=None):
+        """ return the estimated CPU latency of model in milliseconds
+        removals: dict mapping a channel group name to the LongTensor of channels to remove, the
+            model is estimated as if they were already pruned, e.g. for a ChannelMask candidate
+        """
+        graph = get_channel_graph(model)
+        removed_widths = get_removed_widths(model, removals)
+        latency = 0.0
+        new_entries = False
+        for module_name, (input_shape, output_shape) in graph.shapes.items():
+            module = model.get_submodule(module_name)
+            in_channels = get_input_channels(model, graph, module_name, removed_widths)
+            if isinstance(module, (nn.Conv2d, nn.Linear, nn.BatchNorm2d)):
+                out_channels = get_width(module) - removed_widths.get((module_name, 0), 0)
+            else:
+                out_channels = in_channels
+            key = self.get_key(module, in_channels, out_channels, input_shape)
+            if key not in self.latencies:
+                layer = self.build_layer(module, in_channels, out_channels)
+                if layer is None:
+                    continue
+                self.latencies[key] = self.measure(layer, in_channels, input_shape)
+                new_entries = True
+            latency += self.latencies[key]
+        if new_entries:
+            self.save()
+        return latency
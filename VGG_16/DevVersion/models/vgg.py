@@ -1,9 +1,15 @@
 import torch
 import torch.nn as nn
 
+from models.pruning import add_to_plan, remaining_width, prune_channels, ImportanceCache, align_plan
+
 class VGG(nn.Module):
+    input_size = (3, 32, 32)
+
     def __init__(self, num_class=100):
         super().__init__()
+        # kept for ArchitectureSpec to rebuild the model
+        self.num_class = num_class
         self.features = nn.ModuleDict({
             'Conv1': nn.Conv2d(3, 64, kernel_size=3, padding=1, bias=False),
             'bn1': nn.BatchNorm2d(64),
@@ -113,19 +119,40 @@ class VGG(nn.Module):
 
 
     # define the function to resize the architecture kernel number
-    def update_architecture(self, modification_num):
+    def update_architecture(self, modification_num, bulk=False, importance=None, criterion='variance', optimizer=None, align=1, plan=None):
         update_times = int(modification_num + 1)
+        # channel scores of the parent, shared by all candidates of a generation
+        importance = ImportanceCache(self, criterion) if importance is None else importance.copy()
         print(update_times)
+        if plan is not None:
+            # drawn beforehand, e.g. picked among many plans by the surrogate
+            prune_channels(self, plan, importance, optimizer)
+        elif bulk or align > 1:
+            # draw the whole pruning plan first, then rebuild every affected layer only once
+            # widths are aligned over the whole plan, single channel steps would all round to a multiple
+            prune_channels(self, align_plan(self, self.draw_pruning_plan(update_times), align), importance, optimizer)
+        else:
+            for update_id in range(update_times):
+                prune_channels(self, self.draw_pruning_plan(1), importance, optimizer)
+        if torch.rand(1).item() < 0:
+            self.change_activation_function()
+        # the cache knows which channels of the parent the pruned model kept
+        return importance
+
+
+    # draw the random choices of update_architecture, and count how many channels each layer loses
+    def draw_pruning_plan(self, update_times):
+        plan = {}
         for update_id in range(update_times):
             if torch.rand(1).item() < 0.5:
-                self.prune_kernel()
+                self.prune_kernel(plan)
             else:
-                self.prune_neuron()
-        if torch.rand(1).item() < 0:
-            self.change_activation_function()
+                self.prune_neuron(plan)
+        return plan
 
 
-    def prune_kernel(self):
+    # add one kernel of a conv layer to plan, the least important kernel is chosen by prune_channels
+    def prune_kernel(self, plan):
         if torch.rand(1).item() < 0.02:
             # low probabilit to prune sensitive layer
             layer_choices =  torch.tensor([1, 2, 3, 4, 5])
@@ -133,90 +160,15 @@ class VGG(nn.Module):
             layer_choices =  torch.tensor([6, 7, 8, 9, 10, 11, 12, 13])
         target_layer = torch.randint(0, len(layer_choices), (1,)).item()
         target_layer = layer_choices[target_layer].item()
-
-        new_conv1_kernel_num = self.features['Conv' + str(target_layer)].out_channels - 1
-        if new_conv1_kernel_num == 0:
-            return
-        # update conv1
-        new_conv1 = nn.Conv2d(self.features['Conv' + str(target_layer)].in_channels, new_conv1_kernel_num, kernel_size=3, padding=1, bias=False)
-        # prone the kernel with least variance weights
-        weight_variances = torch.var(self.features['Conv' + str(target_layer)].weight.data, dim = [1, 2, 3])
-        target_kernel = torch.argmin(weight_variances).item()
-        with torch.no_grad():
-            new_conv1.weight.data = torch.cat([self.features['Conv' + str(target_layer)].weight.data[:target_kernel], self.features['Conv' + str(target_layer)].weight.data[target_kernel+1:]], dim=0)
-        self.features['Conv' + str(target_layer)] = new_conv1
-
-        # update bn1
-        new_bn1 = nn.BatchNorm2d(new_conv1_kernel_num)
-        with torch.no_grad():
-            kept_indices = [i for i in range(self.features['bn' + str(target_layer)].num_features) if i != target_kernel]
-            new_bn1.weight.data = self.features['bn' + str(target_layer)].weight.data[kept_indices]
-            new_bn1.bias.data = self.features['bn' + str(target_layer)].bias.data[kept_indices]
-            new_bn1.running_mean = self.features['bn' + str(target_layer)].running_mean[kept_indices]
-            new_bn1.running_var = self.features['bn' + str(target_layer)].running_var[kept_indices]
-        self.features['bn' + str(target_layer)] = new_bn1
-
-        if target_layer < 13:
-            # if not last Conv layer, update conv2
-            new_conv2 = nn.Conv2d(self.features['Conv' + str(target_layer)].out_channels, self.features['Conv' + str(target_layer + 1)].out_channels, kernel_size=3, padding=1, bias=False)
-            with torch.no_grad():
-                kept_indices = [i for i in range(self.features['Conv' + str(target_layer + 1)].in_channels) if i != target_kernel]
-                new_conv2.weight.data = self.features['Conv' + str(target_layer + 1)].weight.data[:, kept_indices, :, :]
-            self.features['Conv' + str(target_layer + 1)] = new_conv2
-        else:
-            # if so, update first FC layer
-            output_length = 1 # gained by printing "output"
-            new_fc1_intput_features = self.features['Conv' + str(target_layer)].out_channels * output_length ** 2
-            # update fc1
-            new_fc1 = nn.Linear(new_fc1_intput_features, self.classifier[0].out_features)
-            # prune the neuron with least variance weights
-            with torch.no_grad():
-                start_index = target_kernel * output_length ** 2
-                end_index = start_index + output_length ** 2
-                new_fc1.weight.data = torch.cat([self.classifier[0].weight.data[:, :start_index], self.classifier[0].weight.data[:, end_index:]], dim=1)
-                new_fc1.bias.data = self.classifier[0].bias.data
-            self.classifier[0] = new_fc1
+        add_to_plan(self, plan, 'features.Conv' + str(target_layer))
     
 
-    def prune_neuron(self):
-        if torch.rand(1).item() < 0.5 and self.classifier[0].out_features - 1 > 0:
-            new_fc1_output_features = self.classifier[0].out_features - 1
-            # update fc1
-            new_fc1 = nn.Linear(self.classifier[0].in_features, new_fc1_output_features)
-            # prune the neuron with least variance weights
-            weight_variances = torch.var(self.classifier[0].weight.data, dim = 1)
-            target_neuron = torch.argmin(weight_variances).item()
-            with torch.no_grad():
-                new_fc1.weight.data = torch.cat([self.classifier[0].weight.data[:target_neuron], self.classifier[0].weight.data[target_neuron+1:]], dim=0)
-                new_fc1.bias.data = torch.cat([self.classifier[0].bias.data[:target_neuron], self.classifier[0].bias.data[target_neuron+1:]])
-            self.classifier[0] = new_fc1
-
-            # update fc2
-            new_fc2 = nn.Linear(self.classifier[0].out_features, self.classifier[3].out_features)
-            with torch.no_grad():
-                new_fc2.weight.data = torch.cat([self.classifier[3].weight.data[:, :target_neuron], self.classifier[3].weight.data[:, target_neuron+1:]], dim=1)
-                new_fc2.bias.data = self.classifier[3].bias.data
-            self.classifier[3] = new_fc2
+    # add one neuron of fc1 or fc2 to plan
+    def prune_neuron(self, plan):
+        if torch.rand(1).item() < 0.5 and remaining_width(self, plan, 'classifier.0') - 1 > 0:
+            add_to_plan(self, plan, 'classifier.0')
         else:
-            new_fc2_output_features = self.classifier[3].out_features - 1
-            if new_fc2_output_features == 0:
-                return
-            # update fc2
-            new_fc2 = nn.Linear(self.classifier[3].in_features, new_fc2_output_features)
-            # prune the neuron with least variance weights
-            weight_variances = torch.var(self.classifier[3].weight.data, dim = 1)
-            target_neuron = torch.argmin(weight_variances).item()
-            with torch.no_grad():
-                new_fc2.weight.data = torch.cat([self.classifier[3].weight.data[:target_neuron], self.classifier[3].weight.data[target_neuron+1:]], dim=0)
-                new_fc2.bias.data = torch.cat([self.classifier[3].bias.data[:target_neuron], self.classifier[3].bias.data[target_neuron+1:]])
-            self.classifier[3] = new_fc2
-
-            # update fc3
-            new_fc3 = nn.Linear(self.classifier[3].out_features, self.classifier[6].out_features)
-            with torch.no_grad():
-                new_fc3.weight.data = torch.cat([self.classifier[6].weight.data[:, :target_neuron], self.classifier[6].weight.data[:, target_neuron+1:]], dim=1)
-                new_fc3.bias.data = self.classifier[6].bias.data
-            self.classifier[6] = new_fc3
+            add_to_plan(self, plan, 'classifier.3')
 
     # update the conv1 activation function
     def change_activation_function(self):
@@ -2,7 +2,7 @@ import torch
 from conf import settings
 from utils import get_CIFAR10_test_dataloader, get_CIFAR100_test_dataloader
 
-from thop import profile
+from models.profiler import count_ops
 
 # move the LeNet Module into the corresponding device
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -20,7 +20,8 @@ def test():
     original_FLOPs_num = 0.0
     compressed_para_num = 0.0
     compressed_FLOPs_num = 0.0
-    input = torch.rand(128, 3, 32, 32).to(device)
+    # FLOPs are counted analytically for a batch of this size
+    profile_batch_size = 128
 
     # initialize the testing parameters
     top1_correct_num = 0.0
@@ -45,7 +46,7 @@ def test():
     top1_accuracy = top1_correct_num / len(cifar100_test_loader.dataset)
     top5_accuracy = top5_correct_num / len(cifar100_test_loader.dataset)
     print('Original model has top1 accuracy: %f, top5 accuracy: %f' %(top1_accuracy, top5_accuracy))
-    original_FLOPs_num, original_para_num = profile(model, inputs = (input, ), verbose=False)
+    original_FLOPs_num, original_para_num = count_ops(model, profile_batch_size)
         
     
     # initialize the testing parameters
@@ -72,7 +73,7 @@ def test():
     top1_accuracy = top1_correct_num / len(cifar100_test_loader.dataset)
     top5_accuracy = top5_correct_num / len(cifar100_test_loader.dataset)
     print('Compressed Model has top1 accuracy: %f, top5 accuracy: %f' %(top1_accuracy, top5_accuracy))
-    compressed_FLOPs_num, compressed_para_num = profile(model, inputs = (input, ), verbose=False)
+    compressed_FLOPs_num, compressed_para_num = count_ops(model, profile_batch_size)
     
     # get compressed ratio
     FLOPs_compressed_ratio = compressed_FLOPs_num / original_FLOPs_num